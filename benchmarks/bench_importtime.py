@@ -0,0 +1,98 @@
+"""
+Cold-start cost of main.py, each sample in a fresh interpreter:
+  - import:        `import main` (what every GCF cold start pays before the first request)
+  - build:         _ensure_application() (persistence object, Application, handlers; no network)
+  - first update:  telegram_webhook() with a private text message, end to end (--first-update,
+                   needs the Firestore emulator; getMe is answered from BOT_IDENTITY_JSON)
+plus the slowest modules from `python -X importtime -c "import main"`.
+
+    python benchmarks/bench_importtime.py --runs 5
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/bench_importtime.py --runs 5 --first-update
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BOT_ID = 123456
+
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main._ensure_application()
+built = time.perf_counter()
+result = {"import": imported - started, "build": built - imported,
+          "firestore_imported": "google.cloud.firestore" in sys.modules}
+if FIRST_UPDATE:
+    class _Request:
+        method = "POST"
+        path = "/"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET_TOKEN}
+        def get_data(self):
+            return json.dumps({"update_id": 1, "message": {"message_id": 1, "date": int(time.time()),
+                "chat": {"id": 900000001, "type": "private"}, "from": {"id": 900000001, "is_bot": False, "first_name": "Bench"},
+                "text": "hello"}}).encode()
+    main.telegram_webhook(_Request())
+    result["first_update"] = time.perf_counter() - built
+print("RESULT " + json.dumps(result))
+"""
+
+
+def _child_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", f"{BOT_ID}:benchmark-token")
+    env.setdefault("GCP_PROJECT", "benchmark-project")
+    env.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    env.setdefault("BOT_IDENTITY_JSON", json.dumps({"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}))
+    env.setdefault("UPDATE_DEDUP", "false")
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def _sample(first_update: bool) -> dict:
+    code = f"FIRST_UPDATE = {first_update!r}\n" + CHILD
+    proc = subprocess.run([sys.executable, "-c", code], env=_child_env(), capture_output=True, text=True, check=True)
+    line = next(line for line in proc.stdout.splitlines() if line.startswith("RESULT "))
+    return json.loads(line[len("RESULT "):])
+
+
+def _slowest_modules(top: int) -> list:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], env=_child_env(),
+                          capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        rows.append((int(cumulative_us), int(self_us), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--first-update", action="store_true", help="also time one webhook update (Firestore emulator)")
+    args = parser.parse_args()
+
+    samples = [_sample(args.first_update) for _ in range(args.runs)]
+    print(f"{'phase':<14} {'median ms':>10} {'max ms':>8}")
+    for phase in ("import", "build", "first_update"):
+        values = [sample[phase] * 1000 for sample in samples if phase in sample]
+        if values:
+            print(f"{phase:<14} {statistics.median(values):>10.1f} {max(values):>8.1f}")
+    print(f"google.cloud.firestore imported before the first update: {samples[0]['firestore_imported']}")
+
+    print(f"\n{'cumulative ms':>13} {'self ms':>8}  module (python -X importtime -c 'import main')")
+    for cumulative_us, self_us, name in _slowest_modules(args.top):
+        print(f"{cumulative_us / 1000:>13.1f} {self_us / 1000:>8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main_cli()
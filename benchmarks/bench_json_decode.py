@@ -0,0 +1,78 @@
+"""
+Per-update JSON cost before (stdlib json, as used by request.get_json) and after (orjson) for
+webhook bodies and the order/view callback data, plus Update.de_json when python-telegram-bot
+is installed, to show how much of the parse step the JSON decoder accounts for.
+
+    pip install orjson
+    python benchmarks/bench_json_decode.py --repeat 20000
+"""
+import argparse
+import json
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CALLBACK_PAYLOAD = {"a": "order", "gid": "6f1c2a4e-9b7d-4c1e-8a51-2f0d3b9e7c61"}
+
+UPDATE_BODY = json.dumps({
+    "update_id": 812345678,
+    "callback_query": {
+        "id": "4382bfdwdsb323b2d9",
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Alice", "username": "alice", "language_code": "en"},
+        "message": {
+            "message_id": 4321,
+            "date": 1714000000,
+            "chat": {"id": -1001234567890, "type": "supergroup", "title": "Condo Group Buys"},
+            "from": {"id": 7000000000, "is_bot": True, "first_name": "Garupa", "username": "garupa_bot"},
+            "text": "New Group Buy! Item: Durian Price: $18 MOQ: 10 Closing: Sat 8pm Pickup/Delivery: Lobby A",
+            "reply_markup": {"inline_keyboard": [[
+                {"text": "Order Now", "callback_data": json.dumps(CALLBACK_PAYLOAD)},
+                {"text": "See Who Ordered", "callback_data": json.dumps({"a": "view", "gid": CALLBACK_PAYLOAD["gid"]})},
+            ]]},
+        },
+        "chat_instance": "-8123456789012345678",
+        "data": json.dumps(CALLBACK_PAYLOAD),
+    },
+}).encode("utf-8")
+
+
+def _per_call_us(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=repeat, repeat=5)) / repeat * 1e6
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args()
+
+    rows = [
+        ("webhook body loads (stdlib)", lambda: json.loads(UPDATE_BODY)),
+        ("callback data dumps (stdlib)", lambda: json.dumps(CALLBACK_PAYLOAD, separators=(",", ":"))),
+        ("callback data loads (stdlib)", lambda: json.loads('{"a":"order","gid":"6f1c2a4e-9b7d-4c1e-8a51-2f0d3b9e7c61"}')),
+    ]
+    if orjson:
+        rows += [
+            ("webhook body loads (orjson)", lambda: orjson.loads(UPDATE_BODY)),
+            ("callback data dumps (orjson)", lambda: orjson.dumps(CALLBACK_PAYLOAD).decode("utf-8")),
+            ("callback data loads (orjson)", lambda: orjson.loads('{"a":"order","gid":"6f1c2a4e-9b7d-4c1e-8a51-2f0d3b9e7c61"}')),
+        ]
+    else:
+        print("orjson is not installed; only the stdlib baseline is measured.")
+
+    try:
+        from telegram import Update
+        update_dict = json.loads(UPDATE_BODY)
+        rows.append(("Update.de_json (for scale)", lambda: Update.de_json(update_dict, None)))
+    except ImportError:
+        pass
+
+    print(f"{'operation':<32} {'us/call':>9}")
+    for name, func in rows:
+        print(f"{name:<32} {_per_call_us(func, args.repeat):>9.2f}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,98 @@
+"""
+Compares per-update persistence latency and throughput of CustomFirestorePersistence
+(sync firestore.Client, blocking calls on the FirestoreExecutor threads) and AsyncFirestorePersistence
+(firestore.AsyncClient).
+
+Each simulated update runs the same persistence calls as one webhook:
+set_update_scope -> get_bot_data/get_user_data/get_conversations -> refresh_user_data
+-> update_user_data/update_conversation -> flush.
+
+Each client/concurrency run is one asyncio.run, so the async client and its gRPC channel are reused
+by every update, as on the warm loop, polling or ASGI. In the default GCF mode (asyncio.run per
+request) AsyncFirestorePersistence builds a new AsyncClient and channel for every request and closes
+it at the end (close_client), while the sync client and its channel are shared across requests; that
+per-request setup is not included in these numbers.
+
+Run against the Firestore emulator (recommended) or a scratch database:
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/bench_persistence_clients.py --updates 500 --concurrency 1 8 32
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# main.py requires BOT_TOKEN at import; a syntactically valid dummy token is enough offline
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+os.environ.setdefault("GCP_PROJECT", "benchmark-project")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def _make_persistence(persistence_class):
+    return persistence_class(
+        project_id=os.environ["GCP_PROJECT"],
+        database_id=os.environ.get("BENCH_FIRESTORE_DATABASE", "(default)"),
+        user_bot_states_collection="benchUserBotStates",
+        bot_data_collection="benchBotGlobalData",
+        lazy_user_loading=True,
+    )
+
+
+async def _one_update(persistence_obj, user_id: int, step: int) -> float:
+    started = time.perf_counter()
+    persistence_obj.set_update_scope({user_id})
+    await persistence_obj.get_bot_data()
+    user_data = (await persistence_obj.get_user_data())[user_id]
+    await persistence_obj.get_conversations("newbuy_conversation")
+    await persistence_obj.refresh_user_data(user_id, user_data)
+    user_data[f"field_{step % 5}"] = step
+    await persistence_obj.update_user_data(user_id, user_data)
+    await persistence_obj.update_conversation("newbuy_conversation", (user_id, user_id), step % 10)
+    await persistence_obj.flush()
+    return time.perf_counter() - started
+
+
+async def _run(persistence_class, updates: int, concurrency: int):
+    # One persistence object per worker: the update-cycle state is per object, as with one webhook per instance
+    workers = [_make_persistence(persistence_class) for _ in range(concurrency)]
+    latencies = []
+    next_update = 0
+
+    async def worker(index: int):
+        nonlocal next_update
+        while next_update < updates:
+            step = next_update
+            next_update += 1
+            latencies.append(await _one_update(workers[index], 900_000_000 + step % 200, step))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return latencies, elapsed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        print("WARNING: FIRESTORE_EMULATOR_HOST is not set, this will hit a real Firestore database.")
+
+    print(f"{'persistence':<28} {'conc':>5} {'p50 ms':>8} {'p95 ms':>8} {'updates/s':>10}")
+    for persistence_class in (main.CustomFirestorePersistence, main.AsyncFirestorePersistence):
+        for concurrency in args.concurrency:
+            latencies, elapsed = asyncio.run(_run(persistence_class, args.updates, concurrency))
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000
+            p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+            print(f"{persistence_class.__name__:<28} {concurrency:>5} {p50:>8.1f} {p95:>8.1f} {len(latencies) / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main_cli()
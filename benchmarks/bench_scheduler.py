@@ -0,0 +1,60 @@
+"""
+Throughput of UserOrderedScheduler versus worker count (max_concurrency).
+
+Each simulated update "does I/O" for --io-ms (Telegram sends + Firestore round trips), spread over
+--users distinct senders. The run also checks that every user's updates completed in order.
+
+    python benchmarks/bench_scheduler.py --updates 2000 --users 200 --io-ms 40 --workers 1 2 4 8 16 32 64
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# main.py requires BOT_TOKEN at import (the Application itself is built lazily); no network is used here
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+os.environ.setdefault("GCP_PROJECT", "benchmark-project")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+async def _run(updates: int, users: int, io_seconds: float, workers: int):
+    completed_order = {}
+
+    async def fake_process_update(update_data):
+        await asyncio.sleep(io_seconds)
+        user_id = update_data["message"]["from"]["id"]
+        completed_order.setdefault(user_id, []).append(update_data["update_id"])
+        return "ok", 200
+
+    scheduler = main.UserOrderedScheduler(fake_process_update, max_concurrency=workers, max_pending=updates)
+    started = time.perf_counter()
+    futures = [
+        await scheduler.submit({"update_id": i, "message": {"from": {"id": i % users}, "text": "x"}})
+        for i in range(updates)
+    ]
+    await asyncio.gather(*futures)
+    elapsed = time.perf_counter() - started
+    in_order = all(ids == sorted(ids) for ids in completed_order.values())
+    return elapsed, scheduler.metrics(), in_order
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--io-ms", type=float, default=40.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'updates/s':>10} {'max lag s':>10} {'avg lag s':>10} {'in order':>9}")
+    for workers in args.workers:
+        elapsed, metrics, in_order = asyncio.run(_run(args.updates, args.users, args.io_ms / 1000, workers))
+        print(f"{workers:>7} {args.updates / elapsed:>10.1f} {metrics['max_lag_seconds']:>10.3f} {metrics['avg_lag_seconds']:>10.3f} {str(in_order):>9}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,92 @@
+"""
+Load benchmark for the webhook front ends: the GCF wrapper (telegram_webhook) versus the ASGI app.
+
+Start both locally with the same environment (BOT_TOKEN, GCP_PROJECT/FIRESTORE_EMULATOR_HOST,
+WEBHOOK_SECRET_TOKEN, ...):
+    functions-framework --source main.py --target telegram_webhook --port 8081
+    uvicorn main:asgi_app --port 8082
+then:
+    python benchmarks/bench_webhook_load.py --target gcf=http://localhost:8081 --target asgi=http://localhost:8082 \\
+        --requests 500 --concurrency 16
+    python benchmarks/bench_webhook_load.py --target asgi=http://localhost:8082 --batch 20   # arrays of updates
+
+The secret is read from WEBHOOK_SECRET_TOKEN (or --secret) and sent as X-Telegram-Bot-Api-Secret-Token.
+The synthetic updates are plain text messages in private chats of --users made-up users with no buy setup
+in progress: they pass the pre-router and go through dedup, the user's state load, the handlers and the
+persistence flush, but no handler replies to them, so nothing is sent to Telegram.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import time
+
+import httpx
+
+_update_ids = itertools.count(1)
+
+
+def _synthetic_update(user_id: int) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": "hello",
+        },
+    }
+
+
+async def _run_target(url: str, requests: int, concurrency: int, batch: int, users: int, secret: str):
+    latencies = []
+    statuses = {}
+    sent = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    async with httpx.AsyncClient(limits=limits, headers=headers, timeout=60.0) as client:
+        async def worker():
+            nonlocal sent
+            while sent < requests:
+                sent += 1
+                if batch > 1:
+                    body = [_synthetic_update(900_000_000 + i % users) for i in range(batch)]
+                else:
+                    body = _synthetic_update(900_000_000 + sent % users)
+                started = time.perf_counter()
+                response = await client.post(url, json=body)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, elapsed, statuses
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", required=True, help="name=url, repeatable")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=1, help="updates per request (ASGI only)")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET_TOKEN", ""), help="webhook secret token")
+    args = parser.parse_args()
+
+    print(f"{'target':<10} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>8} {'updates/s':>10}  statuses")
+    for target in args.target:
+        name, url = target.split("=", 1)
+        latencies, elapsed, statuses = asyncio.run(_run_target(url, args.requests, args.concurrency, args.batch, args.users, args.secret))
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+        rps = len(latencies) / elapsed
+        print(f"{name:<10} {p50:>8.1f} {p95:>8.1f} {rps:>8.1f} {rps * args.batch:>10.1f}  {statuses}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,20 +1,31 @@
 import os
 import telegram
 import asyncio
-import nest_asyncio # To handle asyncio loops in environments like GCF
 import logging # Use logging for better debugging
-import uuid # For generating unique IDs
 import json # For handling callback data
-import pprint # For pretty printing dictionaries in logs/messages
 import re # Import regex for escaping
+import html # Escapes names in the order list
+import copy # For bot_data snapshots
+import random # Picks the counter shard for an order
+import time # For rate-limiting periodic maintenance
+import threading # For the warm event loop thread
+import signal # For graceful shutdown of the long-polling runner
+import hmac # Constant-time webhook secret comparison
+import weakref # Per-event-loop AsyncClients
 from typing import Any, Dict, Optional, Tuple, Set, cast, DefaultDict # For type hinting
-from collections import defaultdict # For get_user_data, get_chat_data
-from functools import partial # For use with asyncio.to_thread
-from datetime import timezone # For UTC timestamps
+from collections import defaultdict, Counter, OrderedDict # For get_user_data, get_chat_data / pre-router stats / dedup LRU
+from functools import partial # For use with run_in_executor
+from concurrent.futures import ThreadPoolExecutor, Future # Dedicated pool for blocking Firestore calls
+from datetime import datetime, timedelta, timezone # For UTC timestamps
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError # Local timezone of closing times
+try:
+    import orjson # Optional: faster JSON for webhook bodies, callback data and payload logging
+except ImportError:
+    orjson = None
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, User
 # Import the error class for handling DM failures
-from telegram.error import Forbidden, TelegramError
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 # Import constants and ConversationHandler related classes
 from telegram.constants import ChatType, ParseMode
 from telegram.ext import (
@@ -26,16 +37,13 @@ from telegram.ext import (
     ConversationHandler, # Import ConversationHandler
     CallbackQueryHandler, # Import CallbackQueryHandler for buttons
     BasePersistence, # Import BasePersistence to create a custom one
-    PersistenceInput # For type hinting in persistence methods
+    PersistenceInput, # For type hinting in persistence methods
+    ExtBot, # Subclassed to cache the bot identity (getMe)
 )
-# Requires google-cloud-firestore to be installed
-from google.cloud import firestore # Using the synchronous client
+from telegram.request import HTTPXRequest
 # Import escape_markdown helper
 from telegram.helpers import escape_markdown
 
-# Apply nest_asyncio early
-nest_asyncio.apply()
-
 # Enable logging (optional but recommended)
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -45,6 +53,45 @@ logger = logging.getLogger(__name__)
 
 print("--- main.py loaded ---")
 
+# --- Lazy heavy imports ---
+# google.cloud.firestore pulls in grpc/protobuf and dominates cold-start import time, so it is only
+# imported when the first Firestore client is created (see CustomFirestorePersistence.firestore_client).
+_firestore_module = None
+
+def _firestore():
+    """Returns the google.cloud.firestore module, importing it on first use."""
+    global _firestore_module
+    if _firestore_module is None:
+        started = time.perf_counter()
+        from google.cloud import firestore # Requires google-cloud-firestore to be installed
+        _firestore_module = firestore
+        logger.info(f"Imported google.cloud.firestore in {time.perf_counter() - started:.3f}s.")
+    return _firestore_module
+
+# --- JSON helpers (orjson when installed, stdlib otherwise) ---
+def _json_loads(data: Any) -> Any:
+    """Parses JSON from str or bytes."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _json_dumps(obj: Any, default=None) -> str:
+    """Compact JSON string (no spaces), identical layout with both backends."""
+    if orjson:
+        return orjson.dumps(obj, default=default).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default)
+
+def _encode_callback_data(payload: Dict[str, Any]) -> str:
+    return _json_dumps(payload)
+
+def _decode_callback_data(data: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Decodes JSON callback data such as {'a': 'order', 'gid': ...}; None if it isn't a JSON object."""
+    if not data or not data.startswith('{'):
+        return None
+    try:
+        decoded = _json_loads(data)
+    except ValueError:
+        return None
+    return decoded if isinstance(decoded, dict) else None
+
 # --- Define Conversation States ---
 # Using integers for states
 (ASKING_ITEM, ASKING_IMAGE_CHOICE, ASKING_PRICE, ASKING_MOQ,
@@ -52,11 +99,142 @@ print("--- main.py loaded ---")
  ASKING_PAYMENT_DETAILS, ASKING_CONFIRMATION, HANDLE_IMAGE_UPLOAD) = range(10)
 
 
+class GroupBuyClosedError(Exception):
+    """Raised by order writes when the buy stopped taking orders (closed, or past its deadlineAt)."""
+
+
+# --- Dedicated Thread Pool for Blocking Firestore Calls ---
+class FirestoreExecutor:
+    """
+    ThreadPoolExecutor owned by CustomFirestorePersistence, so slow Firestore calls can only tie up
+    their own workers instead of the loop's default executor (shared, sized from the CPU count).
+    Tracks how many calls are running and waiting for a worker.
+    """
+    def __init__(self, max_workers: int, thread_name_prefix: str = "firestore"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.max_active = 0
+        self.max_queued = 0
+        self.completed = 0
+        self._total_wait_seconds = 0.0
+
+    def _run_call(self, call, submitted_at: float):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self._total_wait_seconds += time.perf_counter() - submitted_at
+        try:
+            return call()
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _on_done(self, future: Future) -> None:
+        if future.cancelled(): # never started, so _run_call didn't dequeue it
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking callable on the pool and awaits its result."""
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = self._executor.submit(self._run_call, partial(func, *args, **kwargs), time.perf_counter())
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                'max_workers': self.max_workers,
+                'active': self.active,
+                'queued': self.queued,
+                'max_active': self.max_active,
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'avg_wait_seconds': round(self._total_wait_seconds / started, 4) if started else 0.0,
+            }
+
+
+# --- Cross-Update Cache of userBotStates Snapshots (warm instances) ---
+class UserSnapshotCache:
+    """
+    Bounded LRU of userBotStates snapshots that outlives the update cycle, so an organizer going
+    through the setup steps on a warm instance isn't re-read from Firestore on every message.
+    Entries expire after ttl_seconds. Each keeps the doc's update_time, which flush() sends as a
+    last_update_time precondition: if the doc was changed elsewhere (e.g. by another instance) the
+    write is dropped with the entry, and the update can be re-run on fresh state (see pop_flush_conflict
+    and UPDATE_CONFLICT_RERUNS; a re-run repeats the handler's sends).
+    Entries are served without a freshness check, so only enable it where one process owns all
+    updates (polling, or a single ASGI worker).
+    """
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # user_id -> (snapshot dict or None if the doc is missing, update_time, cached at)
+        self._entries: "OrderedDict[int, Tuple[Optional[Dict[str, Any]], Any, float]]" = OrderedDict()
+        self._lock = threading.Lock() # concurrent GCF requests may share the persistence object
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.write_conflicts = 0
+
+    def get(self, user_id: int) -> Optional[Tuple[Optional[Dict[str, Any]], Any]]:
+        """(snapshot, update_time) if cached and fresh, else None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[2] > self.ttl_seconds:
+                del self._entries[user_id]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return copy.deepcopy(entry[0]), entry[1]
+
+    def put(self, user_id: int, snapshot: Optional[Dict[str, Any]], update_time: Any) -> None:
+        with self._lock:
+            self._entries[user_id] = (copy.deepcopy(snapshot), update_time, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'write_conflicts': self.write_conflicts,
+            }
+
+
 # === Custom Firestore Persistence Class ===
 class CustomFirestorePersistence(BasePersistence):
     """
     A custom persistence class for python-telegram-bot using Google Firestore's
-    synchronous client, with blocking calls offloaded via asyncio.to_thread.
+    synchronous client, with blocking calls offloaded to its own FirestoreExecutor.
     Aligned with the user's specified Firestore schema.
     """
     def __init__(
@@ -68,42 +246,337 @@ class CustomFirestorePersistence(BasePersistence):
         store_user_data: bool = True,
         store_chat_data: bool = False, 
         store_bot_data: bool = True,
+        lazy_user_loading: bool = False,
+        group_handoff_collection: str = "groupSetupHandoffs",
+        group_handoff_ttl_seconds: int = 3600,
+        group_handoff_sweep_interval_seconds: int = 900,
+        executor_max_workers: int = 32,
+        user_cache_max_entries: int = 0,
+        user_cache_ttl_seconds: float = 60.0,
+        counter_shard_max: int = 64,
+        counter_contention_threshold: int = 3,
+        order_totals_ttl_seconds: float = 5.0,
+        max_flush_attempts: int = 5,
+        auto_close_interval_seconds: float = 60.0,
+        auto_close_batch_size: int = 200,
     ):
         super().__init__()
         self.store_user_data = store_user_data
         self.store_chat_data = store_chat_data
         self.store_bot_data = store_bot_data
-        
-        try:
-            self.firestore_client = firestore.Client(project=project_id, database=database_id)
-            logger.info(f"Synchronous Firestore client initialized. Project: {self.firestore_client.project}, DB: {database_id}")
-        except Exception as e_client:
-            logger.error(f"Failed to initialize synchronous Firestore Client (DB: {database_id}): {e_client}", exc_info=True)
-            raise 
+        # When True, get_user_data/get_conversations only read the documents of the users
+        # in the current update (see set_update_scope) instead of streaming the whole collection.
+        self.lazy_user_loading = lazy_user_loading
+        self._update_scope_user_ids: Set[int] = set()
+        # Snapshot layer: userBotStates doc dicts (None = doc missing) read once per update cycle and
+        # shared by get_user_data, get_conversations and refresh_user_data.
+        self._user_snapshots: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._all_user_snapshots_loaded = False
+        # update_time of each snapshot (None = doc missing), the base version for flush() preconditions
+        self._user_versions: Dict[int, Any] = {}
+        # Optional cross-cycle LRU in front of the snapshot reads (0 entries = disabled)
+        self.user_cache = UserSnapshotCache(user_cache_max_entries, user_cache_ttl_seconds) if user_cache_max_entries > 0 else None
+        # Write-behind buffer per userBotStates doc (merged in memory), plus the latest bot_data.
+        # Both are committed as one WriteBatch in flush(). Each user entry holds the desired values,
+        # which flush() diffs against the committed snapshot (see _user_write):
+        #   'fields': top-level fields to write (currentState)
+        #   'pending_data': the full new pendingData map, or None if unchanged
+        #   'attempts': flushes this entry has failed in
+        self._pending_user_writes: Dict[int, Dict[str, Any]] = {}
+        self._pending_bot_data: Optional[Dict[Any, Any]] = None
+        self.max_flush_attempts = max_flush_attempts
+        # Users whose writes were dropped because their doc changed since it was read (see flush)
+        self._flush_conflicts: Set[int] = set()
+        # Users whose taken writes a running flush is still committing (see flush_user)
+        self._user_flushes_in_flight: Dict[int, asyncio.Event] = {}
+        # bot_data as last read/written in this cycle, so refresh_bot_data doesn't re-read it and
+        # unchanged bot_data is never rewritten.
+        self._bot_data_snapshot: Optional[Dict[Any, Any]] = None
+        # Group-handoff docs ({user_id} -> group the /newbuy came from), expiring after the TTL.
+        # A Firestore TTL policy on 'expiresAt' can also be enabled (gcloud firestore fields ttls update
+        # expiresAt --collection-group=groupSetupHandoffs --enable-ttl); the sweep keeps things tidy either way.
+        self.group_handoff_collection_name = group_handoff_collection
+        self.group_handoff_ttl_seconds = group_handoff_ttl_seconds
+        self.group_handoff_sweep_interval_seconds = group_handoff_sweep_interval_seconds
+        self._last_group_handoff_sweep = float('-inf')
+        # Sharded order counters: shard counts raised by this instance, contention events per buy since
+        # the last raise, and summed totals with the buy doc they were read with (totals, buy, fetched at)
+        self.counter_shard_max = counter_shard_max
+        self.counter_contention_threshold = counter_contention_threshold
+        self.order_totals_ttl_seconds = order_totals_ttl_seconds
+        self._counter_shard_counts: Dict[str, int] = {}
+        self._counter_contention: Counter = Counter()
+        self._order_totals_cache: Dict[str, Tuple[Dict[str, int], Optional[Dict[str, Any]], float]] = {}
+        # Order-list pagination: per buy, the version the cursors belong to and {page: its last order doc}
+        self._order_page_cursors: "OrderedDict[str, Tuple[int, Dict[int, Any]]]" = OrderedDict()
+        # Closing buys past their deadlineAt: how often this instance checks, and buys per batch
+        self.auto_close_interval_seconds = auto_close_interval_seconds
+        self.auto_close_batch_size = auto_close_batch_size
+        self._last_auto_close = float('-inf')
+        self._auto_close_stats: Counter = Counter()
+
+        self.project_id = project_id
+        self.database_id = database_id
+        # Created on first use, so constructing the persistence costs no Firestore import or client setup
+        self._client_lock = threading.Lock() # prewarm() may create the client from another thread
+        self.firestore_client = None
+        # Workers start on demand, so the pool costs nothing until the first blocking call
+        self.executor = FirestoreExecutor(max_workers=executor_max_workers)
 
         self.user_bot_states_collection_name = user_bot_states_collection
         self.bot_data_collection_name = bot_data_collection
         self._bot_data_doc_id = "shared_bot_data" 
 
-        logger.info(f"CustomFirestorePersistence configured. User/Conv states in: '{user_bot_states_collection}'. Bot data in: '{bot_data_collection}/{self._bot_data_doc_id}'.")
+        logger.info(f"CustomFirestorePersistence configured. User/Conv states in: '{user_bot_states_collection}'. Bot data in: '{bot_data_collection}/{self._bot_data_doc_id}'. Lazy user loading: {lazy_user_loading}.")
 
     async def _run_sync(self, func, *args, **kwargs):
-        """Helper to run synchronous Firestore methods in a thread pool."""
-        return await asyncio.to_thread(func, *args, **kwargs)
+        """Helper to run synchronous Firestore methods in the persistence's own thread pool."""
+        return await self.executor.run(func, *args, **kwargs)
+
+    @property
+    def firestore_client(self):
+        if self._firestore_client is None:
+            with self._client_lock:
+                if self._firestore_client is None:
+                    self._firestore_client = self._build_client()
+        return self._firestore_client
+
+    @firestore_client.setter
+    def firestore_client(self, client) -> None:
+        self._firestore_client = client
+
+    def _build_client(self):
+        try:
+            client = self._create_client()
+            logger.info(f"{type(self).__name__}: Firestore client initialized. Project: {client.project}, DB: {self.database_id}")
+            return client
+        except Exception as e_client:
+            logger.error(f"Failed to initialize Firestore Client (DB: {self.database_id}): {e_client}", exc_info=True)
+            raise
+
+    def prewarm(self) -> float:
+        """
+        Creates the client and opens its gRPC channel (TLS handshake + auth token fetch) with one
+        bot_data read, so the first update doesn't pay for them. Blocking: meant to run in a thread
+        while the Application is being built. Returns the seconds taken.
+        """
+        started = time.perf_counter()
+        self.firestore_client.collection(self.bot_data_collection_name).document(self._bot_data_doc_id).get()
+        return time.perf_counter() - started
+
+    # --- Firestore I/O primitives (overridden by AsyncFirestorePersistence) ---
+    def _create_client(self):
+        return _firestore().Client(project=self.project_id, database=self.database_id)
+
+    async def _get_doc(self, doc_ref):
+        return await self._run_sync(doc_ref.get)
+
+    async def _get_docs(self, doc_refs) -> list:
+        return await self._run_sync(list, self.firestore_client.get_all(doc_refs))
+
+    async def _stream(self, query) -> list:
+        return await self._run_sync(list, query.stream())
+
+    async def _set_doc(self, doc_ref, payload: Dict[str, Any], **kwargs) -> None:
+        await self._run_sync(doc_ref.set, payload, **kwargs)
+
+    async def _delete_doc(self, doc_ref) -> None:
+        await self._run_sync(doc_ref.delete)
+
+    async def _create_doc(self, doc_ref, payload: Dict[str, Any]) -> None:
+        """Raises google.api_core.exceptions.AlreadyExists if the doc exists."""
+        await self._run_sync(doc_ref.create, payload)
+
+    async def _commit(self, batch):
+        return await self._run_sync(batch.commit)
+
+    async def close_client(self) -> None:
+        """The sync client isn't bound to an event loop, so there is nothing to close when one ends."""
+
+    async def _run_transaction(self, doc_ref, apply, *extra_refs):
+        """
+        Runs apply(transaction, snapshot of doc_ref, *snapshots of extra_refs) in a transaction, retried
+        by the client on contention, and returns its result. apply may run several times and must only
+        write through the transaction.
+        """
+        @_firestore().transactional
+        def run(transaction):
+            return apply(transaction, *[ref.get(transaction=transaction) for ref in (doc_ref, *extra_refs)])
+        return await self._run_sync(run, self.firestore_client.transaction())
+
+    @staticmethod
+    def _conversation_key(user_id: int) -> Tuple[int, ...]:
+        """
+        Key used by ConversationHandler (per_chat=True, per_user=True) for a private chat,
+        where chat_id == user_id.
+        """
+        return (user_id, user_id)
+
+    def set_update_scope(self, user_ids: Set[int]) -> None:
+        """
+        Starts a new update cycle. Sets the users whose documents are loaded by the next
+        get_user_data/get_conversations call when lazy_user_loading is enabled, and drops the
+        previous cycle's snapshots. Call before `async with application`.
+        """
+        self._update_scope_user_ids = set(user_ids)
+        self._user_snapshots = {}
+        self._user_versions = {}
+        self._all_user_snapshots_loaded = False
+        self._bot_data_snapshot = None
+        logger.debug(f"CustomFirestorePersistence: update scope set to users {sorted(self._update_scope_user_ids)}.")
+
+    def begin_user_update(self, user_id: Optional[int]) -> None:
+        """
+        Per-user alternative to set_update_scope for long-lived Applications that process several
+        users' updates concurrently: only this user's snapshot is invalidated, so other in-flight
+        updates keep their snapshots and diff bases. The bot_data snapshot is kept across updates
+        (update_bot_data replaces it on every write), so refresh_bot_data doesn't re-read the doc
+        for each update; nothing but the one-off legacy handoff migration changes bot_data.
+        """
+        if user_id is not None:
+            self._user_snapshots.pop(user_id, None)
+            self._user_versions.pop(user_id, None)
+            self._all_user_snapshots_loaded = False
+
+    @staticmethod
+    def _user_id_from_doc_id(doc_id: str) -> Optional[int]:
+        try:
+            return int(doc_id)
+        except ValueError:
+            logger.warning(f"CustomFirestorePersistence: Skipping UserBotStates document with non-integer convertible ID: {doc_id}")
+            return None
+
+    async def _get_user_snapshots(self, user_ids: Set[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+        """
+        Returns the userBotStates document dicts (None if missing) for user_ids.
+        Each document is read at most once per update cycle, from the user cache when it holds a fresh
+        entry; the rest are fetched with a single get_all.
+        """
+        missing_ids = [uid for uid in user_ids if uid not in self._user_snapshots]
+        if missing_ids and not self._all_user_snapshots_loaded and self.user_cache is not None:
+            for uid in missing_ids:
+                cached = self.user_cache.get(uid)
+                if cached is not None:
+                    self._user_snapshots[uid], self._user_versions[uid] = cached
+            missing_ids = [uid for uid in missing_ids if uid not in self._user_snapshots]
+        if missing_ids and not self._all_user_snapshots_loaded:
+            users_coll_ref = self.firestore_client.collection(self.user_bot_states_collection_name)
+            doc_refs = [users_coll_ref.document(str(uid)) for uid in missing_ids]
+            docs_list = await self._get_docs(doc_refs)
+            for doc_snapshot in docs_list:
+                user_id = self._user_id_from_doc_id(doc_snapshot.id)
+                if user_id is not None:
+                    self._user_snapshots[user_id] = doc_snapshot.to_dict() if doc_snapshot.exists else None
+                    self._user_versions[user_id] = doc_snapshot.update_time if doc_snapshot.exists else None
+            for uid in missing_ids:
+                self._user_snapshots.setdefault(uid, None)
+                if self.user_cache is not None:
+                    self.user_cache.put(uid, self._user_snapshots[uid], self._user_versions.get(uid))
+            logger.debug(f"CustomFirestorePersistence: Read {len(missing_ids)} userBotStates snapshot(s) in one call.")
+        return {uid: self._user_view(uid) for uid in user_ids}
+
+    async def _get_all_user_snapshots(self) -> Dict[int, Optional[Dict[str, Any]]]:
+        """Streams the whole userBotStates collection once per update cycle (non-lazy mode)."""
+        if not self._all_user_snapshots_loaded:
+            users_coll_ref = self.firestore_client.collection(self.user_bot_states_collection_name)
+            docs_list = await self._stream(users_coll_ref)
+            self._user_snapshots = {}
+            for doc_snapshot in docs_list:
+                user_id = self._user_id_from_doc_id(doc_snapshot.id)
+                if user_id is not None:
+                    self._user_snapshots[user_id] = doc_snapshot.to_dict()
+                    self._user_versions[user_id] = doc_snapshot.update_time
+            self._all_user_snapshots_loaded = True
+            logger.debug(f"CustomFirestorePersistence: Streamed {len(self._user_snapshots)} userBotStates snapshots.")
+        return {uid: self._user_view(uid) for uid in self._user_snapshots}
+
+    async def _get_cycle_user_snapshots(self) -> Dict[int, Optional[Dict[str, Any]]]:
+        """Snapshots that back get_user_data/get_conversations for the current update cycle."""
+        if self.lazy_user_loading:
+            return await self._get_user_snapshots(self._update_scope_user_ids)
+        return await self._get_all_user_snapshots()
+
+    def _buffer_user_write(
+        self, user_id: int, fields: Optional[Dict[str, Any]] = None, pending_data: Optional[Dict[Any, Any]] = None
+    ) -> None:
+        """
+        Records a write for a userBotStates doc. `fields` are top-level fields, `pending_data` is the
+        full new pendingData map. Only the desired values are kept; flush() diffs them against the
+        committed snapshot, which advances once the write has been committed.
+        """
+        entry = self._pending_user_writes.setdefault(user_id, {'fields': {}, 'pending_data': None, 'attempts': 0})
+        entry['fields'].update(copy.deepcopy(fields or {}))
+        if pending_data is not None:
+            entry['pending_data'] = {str(k): copy.deepcopy(v) for k, v in pending_data.items()}
+
+    @staticmethod
+    def _apply_user_write(snapshot: Optional[Dict[str, Any]], entry: Dict[str, Any]) -> Dict[str, Any]:
+        """The doc as it will be once `entry` is committed on top of `snapshot`."""
+        state = dict(snapshot or {})
+        state.update(entry['fields'])
+        if entry['pending_data'] is not None:
+            state['pendingData'] = entry['pending_data']
+        return state
+
+    def _user_view(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Snapshot with the user's still-buffered writes applied, for readers in the same process."""
+        snapshot = self._user_snapshots.get(user_id)
+        entry = self._pending_user_writes.get(user_id)
+        return self._apply_user_write(snapshot, entry) if entry is not None else snapshot
+
+    def _user_write(self, user_id: int, entry: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        ('update', changed fields and pendingData.<key> paths) if the committed snapshot has the doc,
+        ('set', written fields) if not, None if nothing changed. Removed pendingData keys become DELETE_FIELD.
+        """
+        snapshot = self._user_snapshots.get(user_id)
+        if snapshot is None:
+            payload = {'telegramUserId': user_id, **entry['fields']}
+            if entry['pending_data'] is not None:
+                payload['pendingData'] = entry['pending_data']
+            return 'set', payload
+        payload = {name: value for name, value in entry['fields'].items() if name not in snapshot or snapshot[name] != value}
+        if entry['pending_data'] is not None:
+            base = snapshot.get('pendingData') if isinstance(snapshot.get('pendingData'), dict) else {}
+            for key in base.keys() - entry['pending_data'].keys():
+                payload[self.firestore_client.field_path('pendingData', key)] = _firestore().DELETE_FIELD
+            for key, value in entry['pending_data'].items():
+                if key not in base or base[key] != value:
+                    payload[self.firestore_client.field_path('pendingData', key)] = value
+        return ('update', payload) if payload else None
+
+    def _requeue_user_writes(self, failed_writes: Dict[int, Dict[str, Any]]) -> None:
+        """
+        Puts writes from a failed flush back under anything buffered since, so newer values still win.
+        Entries that already failed max_flush_attempts times are dropped, so one bad doc can't block
+        every later flush.
+        """
+        for user_id, failed in failed_writes.items():
+            failed['attempts'] += 1
+            newer = self._pending_user_writes.get(user_id)
+            if failed['attempts'] >= self.max_flush_attempts:
+                logger.error(f"CustomFirestorePersistence: Dropping userBotStates write for user {user_id} after {failed['attempts']} failed flushes.")
+                continue
+            if newer is not None:
+                failed['fields'].update(newer['fields'])
+                if newer['pending_data'] is not None:
+                    failed['pending_data'] = newer['pending_data']
+            self._pending_user_writes[user_id] = failed
 
     async def get_bot_data(self) -> Dict[Any, Any]:
         if not self.store_bot_data: 
             logger.debug("CustomFirestorePersistence: get_bot_data - store_bot_data is False.")
             return {}
+        if self._bot_data_snapshot is not None:
+            return copy.deepcopy(self._bot_data_snapshot)
         try:
             doc_ref = self.firestore_client.collection(self.bot_data_collection_name).document(self._bot_data_doc_id)
-            doc_snapshot = await self._run_sync(doc_ref.get)
-            if doc_snapshot.exists:
-                data = doc_snapshot.to_dict()
-                logger.debug(f"CustomFirestorePersistence: get_bot_data retrieved {len(data)} keys.")
-                return data if data else {}
-            logger.debug("CustomFirestorePersistence: get_bot_data - bot_data document not found.")
-            return {}
+            doc_snapshot = await self._get_doc(doc_ref)
+            data = (doc_snapshot.to_dict() or {}) if doc_snapshot.exists else {}
+            data = await self._migrate_legacy_group_handoffs(doc_ref, data)
+            self._bot_data_snapshot = data
+            logger.debug(f"CustomFirestorePersistence: get_bot_data retrieved {len(data)} keys (doc exists: {doc_snapshot.exists}).")
+            return copy.deepcopy(data)
         except Exception as e:
             logger.error(f"CustomFirestorePersistence: Error in get_bot_data: {e}", exc_info=True)
             return {}
@@ -113,41 +586,137 @@ class CustomFirestorePersistence(BasePersistence):
             logger.debug("CustomFirestorePersistence: update_bot_data - store_bot_data is False.")
             return
         try:
-            logger.debug(f"CustomFirestorePersistence: update_bot_data with {len(data)} keys.")
-            doc_ref = self.firestore_client.collection(self.bot_data_collection_name).document(self._bot_data_doc_id)
-            payload = data if data else {} 
-            if not data: 
-                 await self._run_sync(doc_ref.set, {}) 
-                 logger.info("CustomFirestorePersistence: bot_data cleared (set to empty map).")
-            else:
-                await self._run_sync(doc_ref.set, payload) 
-            logger.debug(f"CustomFirestorePersistence: update_bot_data - bot_data updated.")
+            if self._bot_data_snapshot is not None and data == self._bot_data_snapshot:
+                logger.debug("CustomFirestorePersistence: update_bot_data - bot_data unchanged, not writing.")
+                return
+            logger.debug(f"CustomFirestorePersistence: update_bot_data with {len(data)} keys (buffered until flush).")
+            self._pending_bot_data = copy.deepcopy(data) if data else {}
+            self._bot_data_snapshot = copy.deepcopy(self._pending_bot_data)
         except Exception as e:
             logger.error(f"CustomFirestorePersistence: Error in update_bot_data: {e}", exc_info=True)
 
+    # --- Group handoff documents (/newbuy in a group -> "Start Setup" in DM) ---
+    async def save_group_handoff(self, user_id: int, group_chat_id: int, group_name: str) -> None:
+        """Stores which group a user's /newbuy came from, in their own expiring handoff doc."""
+        doc_ref = self.firestore_client.collection(self.group_handoff_collection_name).document(str(user_id))
+        payload = {
+            'telegramUserId': user_id,
+            'groupChatId': group_chat_id,
+            'groupName': group_name,
+            'createdAt': _firestore().SERVER_TIMESTAMP,
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=self.group_handoff_ttl_seconds),
+        }
+        await self._set_doc(doc_ref, payload)
+        logger.debug(f"CustomFirestorePersistence: Saved group handoff for user {user_id} (group {group_chat_id}).")
+
+    async def _migrate_legacy_group_handoffs(self, bot_data_ref, data: Dict[Any, Any]) -> Dict[Any, Any]:
+        """
+        Moves the group_info_{user_id} keys older versions kept in the bot_data doc to handoff docs
+        (unless the user already has a newer one) and deletes them from bot_data, in one batch.
+        Returns bot_data without the moved keys; on failure it is returned unchanged and retried on the next read.
+        """
+        legacy = {key: value for key, value in data.items() if str(key).startswith('group_info_') and isinstance(value, dict)}
+        if not legacy:
+            return data
+        try:
+            handoffs_ref = self.firestore_client.collection(self.group_handoff_collection_name)
+            handoff_refs = {key: handoffs_ref.document(key[len('group_info_'):]) for key in legacy}
+            existing = {doc_snapshot.id for doc_snapshot in await self._get_docs(list(handoff_refs.values())) if doc_snapshot.exists}
+            firestore = _firestore()
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.group_handoff_ttl_seconds)
+            batch = self.firestore_client.batch()
+            for key, group_info in legacy.items():
+                user_id = self._user_id_from_doc_id(handoff_refs[key].id)
+                if user_id is None or handoff_refs[key].id in existing:
+                    continue
+                batch.set(handoff_refs[key], {
+                    'telegramUserId': user_id,
+                    'groupChatId': group_info.get('group_chat_id'),
+                    'groupName': group_info.get('group_name'),
+                    'createdAt': firestore.SERVER_TIMESTAMP,
+                    'expiresAt': expires_at,
+                })
+            batch.update(bot_data_ref, {self.firestore_client.field_path(key): firestore.DELETE_FIELD for key in legacy})
+            await self._commit(batch)
+        except Exception as e:
+            logger.error(f"CustomFirestorePersistence: Could not migrate legacy group handoffs out of bot_data: {e}", exc_info=True)
+            return data
+        logger.info(f"CustomFirestorePersistence: Moved {len(legacy)} legacy group handoff(s) out of bot_data.")
+        return {key: value for key, value in data.items() if key not in legacy}
+
+    async def pop_group_handoff(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns {'group_chat_id', 'group_name'} for the user's pending handoff and deletes it.
+        Expired handoffs are deleted and treated as missing.
+        """
+        doc_ref = self.firestore_client.collection(self.group_handoff_collection_name).document(str(user_id))
+        try:
+            doc_snapshot = await self._get_doc(doc_ref)
+            if not doc_snapshot.exists:
+                return None
+            doc_data = doc_snapshot.to_dict() or {}
+            await self._delete_doc(doc_ref)
+            expires_at = doc_data.get('expiresAt')
+            if expires_at and expires_at <= datetime.now(timezone.utc):
+                logger.info(f"CustomFirestorePersistence: Group handoff for user {user_id} expired at {expires_at}.")
+                return None
+            return {'group_chat_id': doc_data.get('groupChatId'), 'group_name': doc_data.get('groupName')}
+        except Exception as e:
+            logger.error(f"CustomFirestorePersistence: Error in pop_group_handoff for user {user_id}: {e}", exc_info=True)
+            return None
+
+    async def delete_group_handoff(self, user_id: int) -> None:
+        doc_ref = self.firestore_client.collection(self.group_handoff_collection_name).document(str(user_id))
+        try:
+            await self._delete_doc(doc_ref)
+        except Exception as e:
+            logger.error(f"CustomFirestorePersistence: Error in delete_group_handoff for user {user_id}: {e}", exc_info=True)
+
+    async def sweep_expired_group_handoffs(self, limit: int = 200) -> int:
+        """Deletes up to `limit` expired handoff docs (single-field index on expiresAt). Returns the count."""
+        FieldFilter = _firestore().FieldFilter
+        query = (
+            self.firestore_client.collection(self.group_handoff_collection_name)
+            .where(filter=FieldFilter('expiresAt', '<=', datetime.now(timezone.utc)))
+            .limit(limit)
+        )
+        expired_docs = await self._stream(query)
+        if not expired_docs:
+            return 0
+        batch = self.firestore_client.batch()
+        for doc_snapshot in expired_docs:
+            batch.delete(doc_snapshot.reference)
+        await self._commit(batch)
+        logger.info(f"CustomFirestorePersistence: Swept {len(expired_docs)} expired group handoff(s).")
+        return len(expired_docs)
+
+    async def maybe_sweep_expired_group_handoffs(self) -> None:
+        """Runs sweep_expired_group_handoffs at most once per sweep interval on this instance."""
+        now = time.monotonic()
+        if now - self._last_group_handoff_sweep < self.group_handoff_sweep_interval_seconds:
+            return
+        self._last_group_handoff_sweep = now
+        try:
+            await self.sweep_expired_group_handoffs()
+        except Exception as e:
+            logger.error(f"CustomFirestorePersistence: Error sweeping expired group handoffs: {e}", exc_info=True)
+
     async def get_user_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         if not self.store_user_data: 
             logger.debug("CustomFirestorePersistence: get_user_data - store_user_data is False.")
             return defaultdict(dict)
         all_user_data: DefaultDict[int, Dict[Any, Any]] = defaultdict(dict)
         try:
-            logger.debug(f"CustomFirestorePersistence: get_user_data called. Fetching from '{self.user_bot_states_collection_name}'.")
-            users_coll_ref = self.firestore_client.collection(self.user_bot_states_collection_name)
-            docs_list = await self._run_sync(list, users_coll_ref.stream())
-
-            for doc_snapshot in docs_list:
+            logger.debug(f"CustomFirestorePersistence: get_user_data called (lazy: {self.lazy_user_loading}).")
+            snapshots = await self._get_cycle_user_snapshots()
+            for user_id, doc_data in snapshots.items():
                 try:
-                    user_id_str = doc_snapshot.id
-                    user_id = int(user_id_str)
-                    doc_data = doc_snapshot.to_dict()
-                    if doc_data and 'pendingData' in doc_data and isinstance(doc_data['pendingData'], dict):
-                         all_user_data[user_id] = doc_data['pendingData']
-                    elif doc_data: 
-                         all_user_data[user_id] = {} 
-                except ValueError:
-                    logger.warning(f"CustomFirestorePersistence: Skipping UserBotStates document with non-integer convertible ID: {doc_snapshot.id}")
+                    if doc_data and isinstance(doc_data.get('pendingData'), dict):
+                        all_user_data[user_id] = dict(doc_data['pendingData'])
+                    elif doc_data:
+                        all_user_data[user_id] = {}
                 except Exception as e_doc:
-                    logger.error(f"CustomFirestorePersistence: Error processing UserBotStates document {doc_snapshot.id}: {e_doc}", exc_info=True)
+                    logger.error(f"CustomFirestorePersistence: Error processing UserBotStates document {user_id}: {e_doc}", exc_info=True)
             logger.debug(f"CustomFirestorePersistence: get_user_data retrieved data for {len(all_user_data)} users.")
             return all_user_data
         except Exception as e:
@@ -159,40 +728,24 @@ class CustomFirestorePersistence(BasePersistence):
         try:
             user_id_str = str(user_id)
             logger.debug(f"CustomFirestorePersistence: update_user_data for user_id {user_id_str}. Has data: {bool(data)}.")
-            doc_ref = self.firestore_client.collection(self.user_bot_states_collection_name).document(user_id_str)
-            
-            update_payload: Dict[str, Any] = {'telegramUserId': user_id} 
-            if not data: 
-                update_payload['pendingData'] = {}
-            else:
-                update_payload['pendingData'] = data
-            
-            await self._run_sync(doc_ref.set, update_payload, merge=True)
-            logger.debug(f"CustomFirestorePersistence: user_data (pendingData) for user_id {user_id_str} updated.")
+            self._buffer_user_write(user_id, pending_data=data or {})
+            logger.debug(f"CustomFirestorePersistence: user_data (pendingData) for user_id {user_id_str} buffered.")
         except Exception as e:
             logger.error(f"CustomFirestorePersistence: Error in update_user_data for user_id {user_id}: {e}", exc_info=True)
 
+    async def get_user_conversation_state(self, user_id: int) -> Optional[object]:
+        """currentState of a single user, served from the update cycle's snapshot."""
+        doc_data = (await self._get_user_snapshots({user_id})).get(user_id)
+        return doc_data.get('currentState') if doc_data else None
+
     async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], Any]:
         logger.debug(f"CustomFirestorePersistence: get_conversations for ConversationHandler name '{name}' called.")
         conversations: Dict[Tuple[int, ...], Any] = {}
         try:
-            user_states_coll_ref = self.firestore_client.collection(self.user_bot_states_collection_name)
-            docs_list = await self._run_sync(list, user_states_coll_ref.stream())
-            for doc_snapshot in docs_list:
-                try:
-                    user_id_str = doc_snapshot.id
-                    user_id = int(user_id_str)
-                    doc_data = doc_snapshot.to_dict()
-                    
-                    if doc_data and 'currentState' in doc_data:
-                        conv_key = (user_id,) 
-                        state_from_db = doc_data['currentState']
-                        conversations[conv_key] = state_from_db 
-                        # logger.debug(f"Loaded conversation state for user {user_id}, key {conv_key}: {state_from_db}") # Can be noisy
-                except ValueError:
-                    logger.warning(f"CustomFirestorePersistence: Skipping UserBotStates document for conversations with non-integer ID: {doc_snapshot.id}")
-                except Exception as e_doc:
-                    logger.error(f"Error processing UserBotStates document {doc_snapshot.id} for conversations '{name}': {e_doc}", exc_info=True)
+            snapshots = await self._get_cycle_user_snapshots()
+            for user_id, doc_data in snapshots.items():
+                if doc_data and doc_data.get('currentState') is not None:
+                    conversations[self._conversation_key(user_id)] = doc_data['currentState']
             logger.debug(f"CustomFirestorePersistence: get_conversations for '{name}' retrieved {len(conversations)} entries.")
             return conversations
         except Exception as e:
@@ -211,17 +764,10 @@ class CustomFirestorePersistence(BasePersistence):
         
         logger.debug(f"CustomFirestorePersistence: update_conversation for name '{name}', user_id {user_id_str}, new_state {new_state}")
         try:
-            doc_ref = self.firestore_client.collection(self.user_bot_states_collection_name).document(user_id_str)
-            
-            update_payload: Dict[str, Any] = {'telegramUserId': user_id}
             if new_state is None:
                 logger.info(f"CustomFirestorePersistence: Setting currentState to None for user {user_id_str}, conversation '{name}'.")
-                update_payload['currentState'] = None 
-            else:
-                update_payload['currentState'] = new_state
-            
-            await self._run_sync(doc_ref.set, update_payload, merge=True) 
-            logger.debug(f"CustomFirestorePersistence: Conversation state for '{name}', user {user_id_str} updated.")
+            self._buffer_user_write(user_id, fields={'currentState': new_state})
+            logger.debug(f"CustomFirestorePersistence: Conversation state for '{name}', user {user_id_str} buffered.")
         except Exception as e:
             logger.error(f"CustomFirestorePersistence: Error in update_conversation for '{name}', user {user_id_str}: {e}", exc_info=True)
 
@@ -229,13 +775,11 @@ class CustomFirestorePersistence(BasePersistence):
         logger.debug(f"CustomFirestorePersistence: refresh_user_data for user_id {user_id}.")
         if not self.store_user_data: user_data.clear(); return
         try:
-            doc_ref = self.firestore_client.collection(self.user_bot_states_collection_name).document(str(user_id))
-            doc_snapshot = await self._run_sync(doc_ref.get)
+            # Served from the update cycle's snapshot; only reads Firestore if the user wasn't loaded yet
+            doc_dict = (await self._get_user_snapshots({user_id})).get(user_id)
             user_data.clear() 
-            if doc_snapshot.exists:
-                doc_dict = doc_snapshot.to_dict()
-                if doc_dict and 'pendingData' in doc_dict and isinstance(doc_dict['pendingData'], dict):
-                    user_data.update(doc_dict['pendingData'])
+            if doc_dict and isinstance(doc_dict.get('pendingData'), dict):
+                user_data.update(doc_dict['pendingData'])
             # else: user_data remains empty
         except Exception as e:
             logger.error(f"Error in refresh_user_data for user_id {user_id}: {e}", exc_info=True)
@@ -256,16 +800,374 @@ class CustomFirestorePersistence(BasePersistence):
         if not self.store_user_data: return
         logger.info(f"CustomFirestorePersistence: drop_user_data for user_id {user_id} (clearing pendingData and currentState).")
         try:
-            doc_ref = self.firestore_client.collection(self.user_bot_states_collection_name).document(str(user_id))
-            update_payload = {
-                'telegramUserId': user_id, 
-                'pendingData': {}, 
-                'currentState': None
-            }
-            await self._run_sync(doc_ref.set, update_payload, merge=True)
+            self._buffer_user_write(user_id, fields={'currentState': None}, pending_data={})
         except Exception as e:
             logger.error(f"CustomFirestorePersistence: Error in drop_user_data for user_id {user_id}: {e}", exc_info=True)
 
+    async def get_bot_identity(self) -> Optional[Dict[str, Any]]:
+        """Cached getMe result stored next to bot_data (see BotIdentityCache)."""
+        doc_ref = self.firestore_client.collection(self.bot_data_collection_name).document("bot_identity")
+        doc_snapshot = await self._get_doc(doc_ref)
+        return doc_snapshot.to_dict() if doc_snapshot.exists else None
+
+    async def save_bot_identity(self, identity: Dict[str, Any]) -> None:
+        doc_ref = self.firestore_client.collection(self.bot_data_collection_name).document("bot_identity")
+        await self._set_doc(doc_ref, identity)
+
+    # --- Processed update markers (webhook retry deduplication) ---
+    # processedUpdates/{update_id}: {'status': 'processing' | 'done', 'leaseUntil', 'expiresAt'}. Markers
+    # are only deleted by a TTL policy on 'expiresAt', enabled once per database with
+    #   gcloud firestore fields ttls update expiresAt --collection-group=processedUpdates --enable-ttl
+    async def claim_update_id(self, update_id: int, lease_seconds: int, ttl_seconds: int) -> bool:
+        """
+        Atomically creates processedUpdates/{update_id} as 'processing' for lease_seconds. Returns False
+        if the update is done or another instance holds an unexpired lease on it. A lease left behind
+        by an instance that died mid-update is taken over once it expires, so the redelivery is processed.
+        """
+        from google.api_core import exceptions as gcp_exceptions # Already loaded with google.cloud.firestore
+        doc_ref = self.firestore_client.collection("processedUpdates").document(str(update_id))
+        now = datetime.now(timezone.utc)
+        marker = {
+            'updateId': update_id,
+            'status': 'processing',
+            'leaseUntil': now + timedelta(seconds=lease_seconds),
+            'createdAt': _firestore().SERVER_TIMESTAMP,
+            'expiresAt': now + timedelta(seconds=ttl_seconds),
+        }
+        try:
+            await self._create_doc(doc_ref, marker)
+            return True
+        except gcp_exceptions.AlreadyExists:
+            pass
+
+        def apply(transaction, marker_snapshot):
+            existing = (marker_snapshot.to_dict() or {}) if marker_snapshot.exists else None
+            # Markers without a status predate leases and count as done
+            if existing is not None and (existing.get('status', 'done') != 'processing' or existing.get('leaseUntil', now) > now):
+                return False
+            transaction.set(doc_ref, marker)
+            return True
+
+        return await self._run_transaction(doc_ref, apply)
+
+    async def confirm_update_id(self, update_id: int) -> None:
+        """Marks the update done, so redeliveries are acked until the marker's TTL removes it."""
+        doc_ref = self.firestore_client.collection("processedUpdates").document(str(update_id))
+        await self._set_doc(doc_ref, {'status': 'done'}, merge=True)
+
+    async def release_update_id(self, update_id: int) -> None:
+        """Removes the marker so a redelivery of a failed update is processed again."""
+        doc_ref = self.firestore_client.collection("processedUpdates").document(str(update_id))
+        await self._delete_doc(doc_ref)
+
+    async def add_group_buy(self, group_buy_id: str, group_buy_details: Dict[str, Any]) -> None:
+        """Creates the groupBuys/{group_buy_id} document."""
+        doc_ref = self.firestore_client.collection("groupBuys").document(group_buy_id)
+        await self._set_doc(doc_ref, group_buy_details)
+
+    # --- Orders (groupBuys/{group_buy_id}/orders/{user_id}) ---
+    # Buys created with a counterShardCount keep their counters in groupBuys/{id}/counterShards/{n}
+    # ({'participants', 'quantity'}): each order increments one random shard, so a burst of orders
+    # spreads over N docs instead of hitting the buy doc's per-document write limit. Older buys
+    # (no counterShardCount) still increment currentParticipantCount/currentQuantityCount on the buy doc;
+    # get_order_totals adds both. Every order write also bumps a write counter ('writes' on the shard,
+    # 'orderVersion' on older buy docs), whose sum is the buy's version for cached order lists. The sum
+    # comes from the same shard read as the totals, so it costs no extra reads, and a single version
+    # field would put every order back on one document.
+    async def get_group_buy(self, group_buy_id: str) -> Optional[Dict[str, Any]]:
+        doc_snapshot = await self._get_doc(self.firestore_client.collection("groupBuys").document(group_buy_id))
+        return doc_snapshot.to_dict() if doc_snapshot.exists else None
+
+    @staticmethod
+    def accepts_orders(group_buy: Dict[str, Any], now: Optional[datetime] = None) -> bool:
+        """Open and not past its deadlineAt (which auto-close may not have caught up with yet)."""
+        deadline_at = group_buy.get('deadlineAt')
+        return group_buy.get('status') == 'open' and not (deadline_at and deadline_at <= (now or datetime.now(timezone.utc)))
+
+    def _order_refs(self, group_buy_id: str, user_id: int):
+        buy_ref = self.firestore_client.collection("groupBuys").document(group_buy_id)
+        return buy_ref, buy_ref.collection("orders").document(str(user_id))
+
+    def get_counter_shard_count(self, group_buy_id: str, group_buy: Dict[str, Any]) -> int:
+        """Shard count of a buy: the stored one, or a higher one this instance has already raised it to."""
+        return max(int(group_buy.get('counterShardCount') or 0), self._counter_shard_counts.get(group_buy_id, 0))
+
+    def _increment_order_counters(self, transaction, buy_ref, participants: int, quantity: int, shard_count: int) -> None:
+        """Moves the buy's participant/quantity counters by the given deltas within the transaction."""
+        firestore = _firestore()
+        if shard_count > 0:
+            changes = {'participants': firestore.Increment(participants), 'quantity': firestore.Increment(quantity), 'writes': firestore.Increment(1)}
+            shard_ref = buy_ref.collection("counterShards").document(str(random.randrange(shard_count)))
+            transaction.set(shard_ref, changes, merge=True) # creates the shard on first use
+            return
+        changes = {'orderVersion': firestore.Increment(1)}
+        if participants:
+            changes['currentParticipantCount'] = firestore.Increment(participants)
+        if quantity:
+            changes['currentQuantityCount'] = firestore.Increment(quantity)
+        transaction.update(buy_ref, changes)
+
+    async def _run_order_transaction(self, group_buy_id: str, order_ref, apply, shard_count: int):
+        """
+        _run_transaction for order writes. The buy doc is read in the same transaction and the write
+        is refused with GroupBuyClosedError unless the buy accepts orders, so an order can't land
+        after a concurrent close. The buy doc only changes when it is closed or re-sharded, so this
+        read doesn't make concurrent orders contend. Every extra attempt (and a transaction that fails
+        on contention) counts towards raising the buy's shard count.
+        """
+        from google.api_core import exceptions as gcp_exceptions # Already loaded with google.cloud.firestore
+        attempts = 0
+
+        def counted_apply(transaction, order_snapshot, buy_snapshot):
+            nonlocal attempts
+            attempts += 1
+            if not buy_snapshot.exists or not self.accepts_orders(buy_snapshot.to_dict() or {}):
+                raise GroupBuyClosedError(group_buy_id)
+            return apply(transaction, order_snapshot)
+
+        try:
+            result = await self._run_transaction(order_ref, counted_apply, self.firestore_client.collection("groupBuys").document(group_buy_id))
+        except (gcp_exceptions.Aborted, gcp_exceptions.ResourceExhausted, ValueError) as e:
+            # ValueError after several attempts: the client gave up retrying the transaction
+            if not isinstance(e, ValueError) or attempts > 1:
+                await self._note_counter_contention(group_buy_id, shard_count, max(attempts, 1))
+            raise
+        if attempts > 1:
+            await self._note_counter_contention(group_buy_id, shard_count, attempts - 1)
+        return result
+
+    async def _note_counter_contention(self, group_buy_id: str, shard_count: int, events: int) -> None:
+        if shard_count <= 0 or shard_count >= self.counter_shard_max:
+            return
+        self._counter_contention[group_buy_id] += events
+        if self._counter_contention[group_buy_id] < self.counter_contention_threshold:
+            return
+        self._counter_contention.pop(group_buy_id, None)
+        try:
+            await self.raise_counter_shards(group_buy_id, min(shard_count * 2, self.counter_shard_max))
+        except Exception as e:
+            logger.error(f"CustomFirestorePersistence: Could not raise counter shards of group buy {group_buy_id}: {e}", exc_info=True)
+
+    async def raise_counter_shards(self, group_buy_id: str, shard_count: int) -> int:
+        """Raises counterShardCount to at least shard_count (never lowers it). Returns the stored count."""
+        buy_ref = self.firestore_client.collection("groupBuys").document(group_buy_id)
+
+        def apply(transaction, buy_snapshot):
+            current = int((buy_snapshot.to_dict() or {}).get('counterShardCount') or 0) if buy_snapshot.exists else 0
+            if buy_snapshot.exists and current < shard_count:
+                transaction.update(buy_ref, {'counterShardCount': shard_count})
+                return shard_count
+            return current
+
+        stored = await self._run_transaction(buy_ref, apply)
+        self._counter_shard_counts[group_buy_id] = max(stored, self._counter_shard_counts.get(group_buy_id, 0))
+        logger.info(f"CustomFirestorePersistence: Counter shards of group buy {group_buy_id} raised to {stored} after contention.")
+        return stored
+
+    async def get_order_totals(self, group_buy_id: str, group_buy: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+        """
+        {'participants', 'quantity', 'version'} of a buy: the shard sums plus the legacy buy-doc counters.
+        Cached for order_totals_ttl_seconds; this instance's own orders are applied to the cached total.
+        """
+        return (await self.get_group_buy_with_totals(group_buy_id, group_buy))[1]
+
+    async def get_group_buy_with_totals(self, group_buy_id: str, group_buy: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], Dict[str, int]]:
+        """
+        The buy doc (None if it doesn't exist) and its get_order_totals, cached together so callers
+        that need both read the buy doc once per order_totals_ttl_seconds.
+        """
+        cached = self._order_totals_cache.get(group_buy_id)
+        if cached is not None and time.monotonic() - cached[2] <= self.order_totals_ttl_seconds:
+            return cached[1], dict(cached[0])
+        if group_buy is None:
+            group_buy = await self.get_group_buy(group_buy_id)
+        stored = group_buy or {}
+        totals = {
+            'participants': int(stored.get('currentParticipantCount') or 0),
+            'quantity': int(stored.get('currentQuantityCount') or 0),
+            'version': int(stored.get('orderVersion') or 0),
+        }
+        shards_ref = self.firestore_client.collection("groupBuys").document(group_buy_id).collection("counterShards")
+        for shard_snapshot in await self._stream(shards_ref):
+            shard = shard_snapshot.to_dict() or {}
+            totals['participants'] += int(shard.get('participants') or 0)
+            totals['quantity'] += int(shard.get('quantity') or 0)
+            totals['version'] += int(shard.get('writes') or 0)
+        self._order_totals_cache[group_buy_id] = (dict(totals), group_buy, time.monotonic())
+        return group_buy, totals
+
+    def _adjust_cached_order_totals(self, group_buy_id: str, participants: int, quantity: int) -> None:
+        cached = self._order_totals_cache.get(group_buy_id)
+        if cached is not None:
+            cached[0]['participants'] += participants
+            cached[0]['quantity'] += quantity
+            cached[0]['version'] += 1
+
+    async def get_order_page(self, group_buy_id: str, page: int, page_size: int, version: int) -> Tuple[list, bool]:
+        """
+        Orders on page `page` (0-based, by createdAt) as dicts, and whether another page follows.
+        Each page's last doc is kept as the cursor for the next one (per buy version, since orders
+        placed or cancelled since shift the pages), so paging forward reads only the requested page.
+        """
+        cursors_version, cursors = self._order_page_cursors.get(group_buy_id, (None, {}))
+        if cursors_version != version:
+            cursors = {}
+        self._order_page_cursors[group_buy_id] = (version, cursors)
+        self._order_page_cursors.move_to_end(group_buy_id)
+        while len(self._order_page_cursors) > 256:
+            self._order_page_cursors.popitem(last=False)
+
+        orders_query = self.firestore_client.collection("groupBuys").document(group_buy_id).collection("orders").order_by("createdAt")
+        # Walk forward from the closest page whose predecessor's cursor is known
+        current = page
+        while current > 0 and (current - 1) not in cursors:
+            current -= 1
+        while True:
+            query = orders_query.start_after(cursors[current - 1]) if current > 0 else orders_query
+            docs = await self._stream(query.limit(page_size + 1))
+            page_docs = docs[:page_size]
+            if page_docs:
+                cursors[current] = page_docs[-1]
+            if current == page or len(docs) <= page_size:
+                if current != page: # the requested page is past the end
+                    return [], False
+                return [doc_snapshot.to_dict() for doc_snapshot in page_docs], len(docs) > page_size
+            current += 1
+
+    async def place_order(
+        self, group_buy_id: str, user_id: int, quantity: int, order_details: Dict[str, Any], shard_count: int = 0
+    ) -> Optional[int]:
+        """
+        Creates or replaces the user's order and moves the buy's counters by the difference, atomically.
+        Besides the buy's status, only the user's own order doc is read in the transaction, so concurrent
+        orders on a popular buy don't invalidate each other; the counters are server-side Increments on
+        one random shard. Returns the previous quantity, or None for a new order.
+        Raises GroupBuyClosedError if the buy no longer accepts orders.
+        """
+        buy_ref, order_ref = self._order_refs(group_buy_id, user_id)
+        firestore = _firestore()
+
+        def apply(transaction, order_snapshot):
+            previous_quantity = int(order_snapshot.to_dict().get('quantity', 0)) if order_snapshot.exists else None
+            payload = {**order_details, 'userId': str(user_id), 'quantity': quantity, 'updatedAt': firestore.SERVER_TIMESTAMP}
+            if previous_quantity is None:
+                payload['createdAt'] = firestore.SERVER_TIMESTAMP
+            transaction.set(order_ref, payload, merge=True)
+            self._increment_order_counters(transaction, buy_ref, 0 if previous_quantity is not None else 1, quantity - (previous_quantity or 0), shard_count)
+            return previous_quantity
+
+        previous_quantity = await self._run_order_transaction(group_buy_id, order_ref, apply, shard_count)
+        self._adjust_cached_order_totals(group_buy_id, 0 if previous_quantity is not None else 1, quantity - (previous_quantity or 0))
+        return previous_quantity
+
+    async def cancel_order(self, group_buy_id: str, user_id: int, shard_count: int = 0) -> Optional[int]:
+        """
+        Deletes the user's order and takes it off the counters. Returns its quantity, or None if there was none.
+        Raises GroupBuyClosedError if the buy no longer accepts orders.
+        """
+        buy_ref, order_ref = self._order_refs(group_buy_id, user_id)
+
+        def apply(transaction, order_snapshot):
+            if not order_snapshot.exists:
+                return None
+            quantity = int(order_snapshot.to_dict().get('quantity', 0))
+            transaction.delete(order_ref)
+            self._increment_order_counters(transaction, buy_ref, -1, -quantity, shard_count)
+            return quantity
+
+        removed_quantity = await self._run_order_transaction(group_buy_id, order_ref, apply, shard_count)
+        if removed_quantity is not None:
+            self._adjust_cached_order_totals(group_buy_id, -1, -removed_quantity)
+        return removed_quantity
+
+    # --- Auto-close (composite index on groupBuys: status ASC, deadlineAt ASC; see firestore.indexes.json) ---
+    async def close_due_group_buys(self, now: Optional[datetime] = None, batch_size: Optional[int] = None, max_batches: int = 10) -> list:
+        """
+        Closes open buys whose deadlineAt has passed, earliest first, one query + WriteBatch per
+        `batch_size` buys (max 500). The query only reads due buys from the index, so each run costs
+        what is due rather than a scan of groupBuys; closed buys drop out of the next query by
+        themselves. Returns the ids of the buys it closed.
+        """
+        now = now or datetime.now(timezone.utc)
+        batch_size = min(batch_size or self.auto_close_batch_size, 500)
+        FieldFilter = _firestore().FieldFilter
+        query = (
+            self.firestore_client.collection("groupBuys")
+            .where(filter=FieldFilter('status', '==', 'open'))
+            .where(filter=FieldFilter('deadlineAt', '<=', now))
+            .order_by('deadlineAt')
+            .limit(batch_size)
+        )
+        closed_ids = []
+        for _ in range(max_batches):
+            due_docs = await self._stream(query)
+            if not due_docs:
+                break
+            batch = self.firestore_client.batch()
+            for doc_snapshot in due_docs:
+                batch.update(doc_snapshot.reference, {'status': 'closed', 'closedAt': _firestore().SERVER_TIMESTAMP})
+            await self._commit(batch)
+            closed_ids.extend(doc_snapshot.id for doc_snapshot in due_docs)
+            if len(due_docs) < batch_size:
+                break
+        self._auto_close_stats['runs'] += 1
+        self._auto_close_stats['closed'] += len(closed_ids)
+        if closed_ids:
+            logger.info(f"CustomFirestorePersistence: Auto-closed {len(closed_ids)} group buy(s) past their deadline.")
+        return closed_ids
+
+    async def maybe_close_due_group_buys(self) -> list:
+        """Runs close_due_group_buys at most once per auto-close interval on this instance."""
+        now = time.monotonic()
+        if now - self._last_auto_close < self.auto_close_interval_seconds:
+            return []
+        self._last_auto_close = now
+        try:
+            return await self.close_due_group_buys()
+        except Exception as e:
+            self._auto_close_stats['errors'] += 1
+            logger.error(f"CustomFirestorePersistence: Error auto-closing due group buys: {e}", exc_info=True)
+            return []
+
+    # --- Live post edit leases (livePostEdits/{group_buy_id}: notBefore, pending) ---
+    # Kept out of the buy doc so lease writes never contend with order transactions on it.
+    async def claim_live_edit(self, group_buy_id: str, interval_seconds: float) -> float:
+        """
+        Claims the buy's next post edit across all instances. Returns 0 and moves notBefore
+        interval_seconds ahead if the last edit's interval has passed; otherwise returns the seconds
+        left and marks the edit pending, so flush_pending_live_edits makes it once it is due.
+        """
+        lease_ref = self.firestore_client.collection("livePostEdits").document(group_buy_id)
+
+        def apply(transaction, lease_snapshot):
+            lease = (lease_snapshot.to_dict() or {}) if lease_snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            not_before = lease.get('notBefore')
+            if not_before and not_before > now:
+                if not lease.get('pending'):
+                    transaction.set(lease_ref, {'pending': True}, merge=True)
+                return (not_before - now).total_seconds()
+            transaction.set(lease_ref, {'notBefore': now + timedelta(seconds=interval_seconds), 'pending': False})
+            return 0.0
+
+        return await self._run_transaction(lease_ref, apply)
+
+    async def defer_live_edit(self, group_buy_id: str, seconds: float) -> None:
+        """Leaves the buy's post edit pending for at least `seconds` (e.g. Telegram's RetryAfter)."""
+        lease_ref = self.firestore_client.collection("livePostEdits").document(group_buy_id)
+        await self._set_doc(lease_ref, {'notBefore': datetime.now(timezone.utc) + timedelta(seconds=seconds), 'pending': True}, merge=True)
+
+    async def due_live_edits(self, limit: int = 50) -> list:
+        """Ids of buys whose pending post edit is due (composite index on livePostEdits: pending, notBefore)."""
+        FieldFilter = _firestore().FieldFilter
+        query = (
+            self.firestore_client.collection("livePostEdits")
+            .where(filter=FieldFilter('pending', '==', True))
+            .where(filter=FieldFilter('notBefore', '<=', datetime.now(timezone.utc)))
+            .limit(limit)
+        )
+        return [doc_snapshot.id for doc_snapshot in await self._stream(query)]
+
     # --- Skeletons for other BasePersistence methods ---
     async def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         if not self.store_chat_data: return defaultdict(dict)
@@ -287,79 +1189,683 @@ class CustomFirestorePersistence(BasePersistence):
     async def update_callback_data(self, data: Any) -> None: 
         logger.warning("CustomFirestorePersistence: update_callback_data (SKELETON - NOT IMPLEMENTED - passing)")
     async def flush(self) -> None:
-        logger.debug("CustomFirestorePersistence: flush called (no-op for sync client with to_thread).")
-        pass
+        """
+        Commits the write-behind buffer: at most one write per touched userBotStates doc plus the
+        bot_data doc, in as few WriteBatches as possible (max 500 writes each).
+        Existing docs get an update() with only the changed field paths; new or unknown docs get a
+        set() that replaces the written top-level fields.
+        Called by Application.shutdown() after update_persistence().
+        Snapshots advance to the written state only once their batch is committed. A batch that fails
+        keeps its own writes buffered for the next flush; the other batches are unaffected.
+        Updates carry the snapshot's update_time as a precondition. Writes of docs changed since they
+        were read are dropped, never forced: the user is recorded for pop_flush_conflict so the update
+        can be re-run on fresh state. With the user cache enabled, committed docs are cached with their
+        new update_time.
+        """
+        pending_user_writes, self._pending_user_writes = self._pending_user_writes, {}
+        pending_bot_data, self._pending_bot_data = self._pending_bot_data, None
+        await self._flush_writes(pending_user_writes, pending_bot_data)
+
+    async def flush_user(self, user_id: Optional[int]) -> None:
+        """
+        flush() for one update on a long-lived Application, where the UserOrderedScheduler runs other
+        users' updates concurrently: commits only this user's buffered write (plus bot_data), and first
+        waits for any flush that already took this user's write. Once it returns the user's writes are
+        committed or dropped, so pop_flush_conflict(user_id) is final for this update.
+        """
+        while user_id in self._user_flushes_in_flight:
+            await self._user_flushes_in_flight[user_id].wait()
+        entry = self._pending_user_writes.pop(user_id, None) if user_id is not None else None
+        pending_bot_data, self._pending_bot_data = self._pending_bot_data, None
+        await self._flush_writes({user_id: entry} if entry is not None else {}, pending_bot_data)
+
+    async def _flush_writes(self, pending_user_writes: Dict[int, Dict[str, Any]], pending_bot_data: Optional[Dict[Any, Any]]) -> None:
+        in_flight = asyncio.Event()
+        for uid in pending_user_writes:
+            self._user_flushes_in_flight[uid] = in_flight
+        try:
+            await self._commit_flush(pending_user_writes, pending_bot_data)
+        finally:
+            for uid in pending_user_writes:
+                if self._user_flushes_in_flight.get(uid) is in_flight:
+                    del self._user_flushes_in_flight[uid]
+            in_flight.set()
+
+    async def _commit_flush(self, pending_user_writes: Dict[int, Dict[str, Any]], pending_bot_data: Optional[Dict[Any, Any]]) -> None:
+        users_coll_ref = self.firestore_client.collection(self.user_bot_states_collection_name)
+        # (doc_ref, kind, payload, user_id or None for bot_data, base update_time for the precondition)
+        writes = []
+        # Docs as of these writes, the new snapshots once they are committed
+        flushed_snapshots: Dict[int, Dict[str, Any]] = {}
+        for uid, entry in pending_user_writes.items():
+            user_write = self._user_write(uid, entry)
+            if user_write is None:
+                continue
+            kind, payload = user_write
+            writes.append((users_coll_ref.document(str(uid)), kind, payload, uid, self._user_versions.get(uid)))
+            flushed_snapshots[uid] = self._apply_user_write(self._user_snapshots.get(uid), entry)
+        if pending_bot_data is not None:
+            bot_doc_ref = self.firestore_client.collection(self.bot_data_collection_name).document(self._bot_data_doc_id)
+            writes.append((bot_doc_ref, 'replace', pending_bot_data, None, None))
+        if not writes:
+            logger.debug("CustomFirestorePersistence: flush called with nothing to write.")
+            return
+
+        failed_user_writes: Dict[int, Dict[str, Any]] = {}
+        bot_data_failed = False
+        committed = 0
+        for start in range(0, len(writes), 500):
+            chunk = writes[start:start + 500]
+            try:
+                chunk, results = await self._commit_write_chunk(chunk, flushed_snapshots)
+                committed += len(chunk)
+            except Exception as e:
+                logger.error(f"CustomFirestorePersistence: Error in flush, keeping {len(chunk)} write(s) buffered for the next flush: {e}", exc_info=True)
+                for _, _, _, uid, _ in chunk:
+                    if uid is None:
+                        bot_data_failed = True
+                    else:
+                        failed_user_writes[uid] = pending_user_writes[uid]
+                continue
+            for (_, _, _, uid, _), write_result in zip(chunk, results or []):
+                if uid is not None and uid in flushed_snapshots:
+                    self._user_snapshots[uid] = flushed_snapshots[uid]
+                    self._user_versions[uid] = write_result.update_time
+                    if self.user_cache is not None:
+                        self.user_cache.put(uid, flushed_snapshots[uid], write_result.update_time)
+        if failed_user_writes:
+            self._requeue_user_writes(failed_user_writes)
+            if self.user_cache is not None:
+                for uid in failed_user_writes:
+                    self.user_cache.invalidate(uid)
+        if bot_data_failed and self._pending_bot_data is None:
+            self._pending_bot_data = pending_bot_data
+        logger.debug(f"CustomFirestorePersistence: flush committed {committed} of {len(writes)} document write(s).")
+
+    async def _commit_write_chunk(self, chunk: list, flushed_snapshots: Dict[int, Dict[str, Any]]) -> Tuple[list, list]:
+        """
+        Commits up to 500 writes in one WriteBatch and returns (the writes as committed, their results).
+        If the batch fails its last_update_time preconditions, the writes of docs that changed since
+        they were read are dropped (see _drop_conflicting_writes) and the rest is committed again.
+        An update() of a userBotStates doc deleted since it was read (no precondition) fails the batch
+        with NotFound; those writes are turned into a set() of the whole doc.
+        """
+        from google.api_core import exceptions as gcp_exceptions # Already loaded with google.cloud.firestore
+        while chunk:
+            try:
+                return chunk, await self._commit(self._build_write_batch(chunk))
+            except gcp_exceptions.FailedPrecondition:
+                remaining = await self._drop_conflicting_writes(chunk)
+                if len(remaining) == len(chunk):
+                    raise
+                chunk = remaining
+            except gcp_exceptions.NotFound:
+                update_refs = [doc_ref for doc_ref, kind, _, _, _ in chunk if kind == 'update']
+                missing_ids = {doc_snapshot.id for doc_snapshot in await self._get_docs(update_refs) if not doc_snapshot.exists}
+                if not missing_ids:
+                    raise
+                logger.warning(f"CustomFirestorePersistence: userBotStates doc(s) {sorted(missing_ids)} were deleted, rewriting them in full.")
+                chunk = [
+                    (doc_ref, 'replace', {**flushed_snapshots[uid], 'telegramUserId': uid}, uid, None)
+                    if kind == 'update' and doc_ref.id in missing_ids else (doc_ref, kind, payload, uid, base_update_time)
+                    for doc_ref, kind, payload, uid, base_update_time in chunk
+                ]
+        return chunk, []
+
+    async def _drop_conflicting_writes(self, chunk: list) -> list:
+        """
+        Re-reads the docs of the chunk's precondition updates and returns the chunk without the writes
+        whose doc has changed (or gone) since its snapshot. Those users' snapshots and cache entries are
+        dropped and they are recorded as flush conflicts.
+        """
+        guarded = [(doc_ref, uid, base_update_time) for doc_ref, kind, _, uid, base_update_time in chunk if kind == 'update' and base_update_time is not None]
+        current = {doc_snapshot.id: doc_snapshot for doc_snapshot in await self._get_docs([doc_ref for doc_ref, _, _ in guarded])}
+        conflicted = {
+            uid for doc_ref, uid, base_update_time in guarded
+            if doc_ref.id not in current or not current[doc_ref.id].exists or current[doc_ref.id].update_time != base_update_time
+        }
+        for uid in conflicted:
+            self._user_snapshots.pop(uid, None)
+            self._user_versions.pop(uid, None)
+            if self.user_cache is not None:
+                self.user_cache.invalidate(uid)
+                self.user_cache.write_conflicts += 1
+        if conflicted:
+            self._flush_conflicts |= conflicted
+            logger.warning(f"CustomFirestorePersistence: userBotStates of user(s) {sorted(conflicted)} changed since they were read, dropping their writes.")
+        return [write for write in chunk if write[3] not in conflicted]
+
+    def pop_flush_conflict(self, user_id: Optional[int]) -> bool:
+        """True (once) if a flush dropped this user's writes because their doc changed elsewhere."""
+        if user_id is None or user_id not in self._flush_conflicts:
+            return False
+        self._flush_conflicts.discard(user_id)
+        return True
+
+    def _build_write_batch(self, writes: list):
+        batch = self.firestore_client.batch()
+        for doc_ref, kind, payload, _, base_update_time in writes:
+            if kind == 'update':
+                if base_update_time is not None:
+                    batch.update(doc_ref, payload, option=self.firestore_client.write_option(last_update_time=base_update_time))
+                else:
+                    batch.update(doc_ref, payload)
+            elif kind == 'set':
+                batch.set(doc_ref, payload, merge=list(payload.keys()))
+            else:
+                batch.set(doc_ref, payload)
+        return batch
+
+
+class AsyncFirestorePersistence(CustomFirestorePersistence):
+    """
+    Same schema and behavior as CustomFirestorePersistence, but built on firestore.AsyncClient so
+    Firestore calls are awaited directly instead of going through the thread pool.
+    The AsyncClient's gRPC channel is bound to the event loop that first uses it, so each running
+    loop gets its own client (e.g. one asyncio.run per webhook, possibly in parallel threads). Loops
+    that end with the request call close_client() before returning so the channel doesn't leak;
+    the warm loop keeps its client for the life of the process.
+    """
+    # Set by prewarm() and shared by every AsyncClient this object creates
+    _prewarmed_credentials = None
+
+    @property
+    def firestore_client(self):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        with self._client_lock:
+            if running_loop is None or running_loop in self._loop_clients:
+                if running_loop is None:
+                    if self._async_client is None:
+                        self._async_client = self._build_client()
+                    return self._async_client
+                return self._loop_clients[running_loop]
+            # A client built (or set) outside any loop is adopted by the first loop that uses it
+            client, self._async_client = self._async_client, None
+            if client is None:
+                logger.debug("AsyncFirestorePersistence: Creating an AsyncClient for a new event loop.")
+                client = self._build_client()
+            self._loop_clients[running_loop] = client
+            return client
+
+    @firestore_client.setter
+    def firestore_client(self, client) -> None:
+        self._async_client = client
+        self._loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+    async def close_client(self) -> None:
+        """Closes the running loop's AsyncClient channel. Call before a loop that ends with the request returns."""
+        with self._client_lock:
+            client = self._loop_clients.pop(asyncio.get_running_loop(), None)
+        # The transport exists once the client has opened its channel
+        transport = getattr(client, '_transport', None) if getattr(client, '_firestore_api_internal', None) is not None else None
+        if transport is not None:
+            try:
+                await transport.close()
+            except Exception as e:
+                logger.warning(f"AsyncFirestorePersistence: Error closing the AsyncClient channel: {e}")
+
+    def prewarm(self) -> float:
+        """
+        The AsyncClient's channel can only be opened on the loop that will use it, so this prefetches
+        what can be shared across loops: the Firestore import, the credentials and their auth token.
+        """
+        started = time.perf_counter()
+        firestore = _firestore()
+        if not os.environ.get('FIRESTORE_EMULATOR_HOST'): # the emulator uses anonymous credentials
+            import google.auth
+            import google.auth.transport.requests
+            credentials, _ = google.auth.default(scopes=firestore.Client.SCOPE)
+            credentials.refresh(google.auth.transport.requests.Request())
+            self._prewarmed_credentials = credentials
+        return time.perf_counter() - started
+
+    def _create_client(self):
+        return _firestore().AsyncClient(project=self.project_id, database=self.database_id, credentials=self._prewarmed_credentials)
+
+    async def _get_doc(self, doc_ref):
+        return await doc_ref.get()
+
+    async def _get_docs(self, doc_refs) -> list:
+        return [doc_snapshot async for doc_snapshot in self.firestore_client.get_all(doc_refs)]
+
+    async def _stream(self, query) -> list:
+        return [doc_snapshot async for doc_snapshot in query.stream()]
+
+    async def _set_doc(self, doc_ref, payload: Dict[str, Any], **kwargs) -> None:
+        await doc_ref.set(payload, **kwargs)
+
+    async def _delete_doc(self, doc_ref) -> None:
+        await doc_ref.delete()
+
+    async def _create_doc(self, doc_ref, payload: Dict[str, Any]) -> None:
+        await doc_ref.create(payload)
+
+    async def _commit(self, batch):
+        return await batch.commit()
+
+    async def _run_transaction(self, doc_ref, apply, *extra_refs):
+        @_firestore().async_transactional
+        async def run(transaction):
+            return apply(transaction, *[await ref.get(transaction=transaction) for ref in (doc_ref, *extra_refs)])
+        return await run(self.firestore_client.transaction())
+
+
+# === Cached Bot Identity (getMe) ===
+class BotIdentityCache:
+    """
+    Stores the bot's getMe result so Application.initialize() doesn't need a Telegram round trip.
+    Sources, in order: BOT_IDENTITY_JSON env var, a local file (survives warm restarts of the
+    process on the same instance), and a Firestore doc (survives cold starts).
+    Entries are {'user': User.to_dict(), 'cachedAt': epoch seconds}.
+    """
+    def __init__(
+        self,
+        token: str,
+        persistence_obj: Optional[CustomFirestorePersistence] = None,
+        cache_file: str = "/tmp/bot_identity.json",
+        refresh_after_seconds: int = 6 * 3600,
+    ):
+        self.bot_id = int(token.split(':', 1)[0]) if ':' in token else None
+        self.persistence = persistence_obj
+        self.cache_file = cache_file
+        self.refresh_after_seconds = refresh_after_seconds
+
+    def _is_valid(self, entry: Optional[Dict[str, Any]]) -> bool:
+        """Only accept identities that belong to the configured token."""
+        return bool(entry and isinstance(entry.get('user'), dict) and entry['user'].get('id') == self.bot_id)
+
+    def is_stale(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - float(entry.get('cachedAt', 0)) > self.refresh_after_seconds
+
+    async def load(self) -> Optional[Dict[str, Any]]:
+        env_value = os.environ.get('BOT_IDENTITY_JSON')
+        if env_value:
+            try:
+                user_dict = _json_loads(env_value)
+                # The env var holds the plain getMe result; treat it as never stale
+                entry = {'user': user_dict, 'cachedAt': float('inf')}
+                if self._is_valid(entry):
+                    return entry
+                logger.warning("BotIdentityCache: BOT_IDENTITY_JSON does not match BOT_TOKEN, ignoring it.")
+            except ValueError:
+                logger.warning("BotIdentityCache: BOT_IDENTITY_JSON is not valid JSON, ignoring it.")
+        try:
+            with open(self.cache_file, 'rb') as cache_fh:
+                entry = _json_loads(cache_fh.read())
+            if self._is_valid(entry):
+                return entry
+        except (OSError, ValueError):
+            pass
+        if self.persistence:
+            try:
+                entry = await self.persistence.get_bot_identity()
+                if self._is_valid(entry):
+                    self._write_file(entry)
+                    return entry
+            except Exception as e:
+                logger.error(f"BotIdentityCache: Error reading identity from Firestore: {e}", exc_info=True)
+        return None
+
+    def _write_file(self, entry: Dict[str, Any]) -> None:
+        try:
+            with open(self.cache_file, 'w', encoding='utf-8') as cache_fh:
+                cache_fh.write(_json_dumps(entry))
+        except OSError as e:
+            logger.warning(f"BotIdentityCache: Could not write {self.cache_file}: {e}")
+
+    async def save(self, user: User) -> None:
+        entry = {'user': user.to_dict(), 'cachedAt': time.time()}
+        self._write_file(entry)
+        if self.persistence:
+            try:
+                await self.persistence.save_bot_identity(entry)
+            except Exception as e:
+                logger.error(f"BotIdentityCache: Error saving identity to Firestore: {e}", exc_info=True)
+
+
+class CachedIdentityBot(ExtBot):
+    """
+    ExtBot whose plain get_me() (as called by Bot.initialize) is answered from BotIdentityCache.
+    Missing or stale entries are refreshed from Telegram inline, before get_me returns: on GCF the
+    loop ends with the request, which would cancel a background refresh. A stale entry is still
+    served if the refresh fails, and a refresh is only due once per refresh_after_seconds.
+    """
+    __slots__ = ('_identity_cache',)
+
+    def __init__(self, *args, identity_cache: BotIdentityCache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._identity_cache = identity_cache
+
+    async def _refresh_identity(self) -> User:
+        user = await super().get_me()
+        await self._identity_cache.save(user)
+        logger.info(f"CachedIdentityBot: Bot identity refreshed from Telegram (@{user.username}).")
+        return user
+
+    async def get_me(self, *args, **kwargs) -> User:
+        if args or kwargs:
+            return await super().get_me(*args, **kwargs)
+        entry = await self._identity_cache.load()
+        if entry is None:
+            return await self._refresh_identity()
+        if self._identity_cache.is_stale(entry):
+            try:
+                return await self._refresh_identity()
+            except TelegramError as e:
+                logger.warning(f"CachedIdentityBot: Identity refresh failed ({e}), using the stale cached identity.")
+        # Bot.get_me() stores the result in _bot_user, which backs bot.username/bot.id etc.
+        self._bot_user = User.de_json(entry['user'], self)
+        logger.debug(f"CachedIdentityBot: Using cached bot identity (@{self._bot_user.username}), skipped getMe.")
+        return self._bot_user
 
 
 # --- Global variable for the Telegram Application ---
 application = None
 bot = None
 persistence = None # Initialize persistence globally
-
-# --- INITIALIZE BOT USING ApplicationBuilder ---
+conv_handler = None # newbuy_conversation, set by _register_handlers
+
+# --- Runtime modes ---
+# Keep one event loop and one initialized Application alive across webhook invocations on a warm instance
+WARM_APPLICATION = os.environ.get('WARM_APPLICATION', 'false').lower() in ('1', 'true', 'yes')
+# Ack webhooks right after validation and process updates from an in-process queue (implies the warm loop).
+# On GCF/Cloud Run this needs CPU to stay allocated after the response ("CPU always allocated").
+WEBHOOK_FAST_ACK = os.environ.get('WEBHOOK_FAST_ACK', 'false').lower() in ('1', 'true', 'yes')
+UPDATE_QUEUE_MAX_DEPTH = int(os.environ.get('UPDATE_QUEUE_MAX_DEPTH', '1000'))
+# Max updates processed at once in the long-lived modes (same-user updates are always serialized)
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', '16'))
+# Ack redelivered update_ids without processing them again (in-memory LRU + processedUpdates markers).
+# A marker is a lease while its update runs (so a crashed instance's update is retried after
+# UPDATE_DEDUP_LEASE_SECONDS) and is kept for UPDATE_DEDUP_TTL_SECONDS once done; deleting expired
+# markers needs the TTL policy described at CustomFirestorePersistence.claim_update_id
+UPDATE_DEDUP = os.environ.get('UPDATE_DEDUP', 'true').lower() in ('1', 'true', 'yes')
+UPDATE_DEDUP_LEASE_SECONDS = int(os.environ.get('UPDATE_DEDUP_LEASE_SECONDS', '120'))
+UPDATE_DEDUP_TTL_SECONDS = int(os.environ.get('UPDATE_DEDUP_TTL_SECONDS', '86400'))
+# Must match the secret_token passed to setWebhook; requests without it are rejected before the body is read
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN', '')
+if not WEBHOOK_SECRET_TOKEN:
+    logger.warning("WEBHOOK_SECRET_TOKEN is not set: webhook requests are not authenticated.")
+# Answer getMe during Application.initialize() from BotIdentityCache instead of calling Telegram
+BOT_IDENTITY_CACHE = os.environ.get('BOT_IDENTITY_CACHE', 'true').lower() in ('1', 'true', 'yes')
+# Open the Firestore channel and fetch the auth token in a background thread while the Application is built
+FIRESTORE_PREWARM = os.environ.get('FIRESTORE_PREWARM', 'false').lower() in ('1', 'true', 'yes')
+
+# --- Bot configuration (checked at import, so a missing token still fails the deployment fast) ---
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+if not BOT_TOKEN:
+    logger.critical("!!! FATAL ERROR: BOT_TOKEN environment variable not set! Function cannot work. !!!")
+    raise RuntimeError("❌ BOT_TOKEN is not set. Telegram bot cannot start.")
+logger.info(f"Configured with BOT_TOKEN ending: ...{BOT_TOKEN[-4:]}")
+
+GCP_PROJECT_ID = os.environ.get('GCP_PROJECT') 
+FIRESTORE_DATABASE_ID = "garupa-group-buy" 
+# Only load the userBotStates docs of the user(s) in the current update (set to "false" to stream the whole collection)
+LAZY_USER_LOADING = os.environ.get('PERSISTENCE_LAZY_USER_LOADING', 'true').lower() in ('1', 'true', 'yes')
+# "sync": firestore.Client + FirestoreExecutor threads (default), "async": firestore.AsyncClient
+FIRESTORE_CLIENT_MODE = os.environ.get('FIRESTORE_CLIENT_MODE', 'sync').lower()
+# Sync mode: threads for blocking Firestore calls, i.e. max Firestore calls in flight per instance.
+# Size it to the Firestore concurrency you expect (about UPDATE_CONCURRENCY x calls per update), not to
+# TELEGRAM_CONNECTION_POOL_SIZE: Telegram requests are async and never use these threads.
+FIRESTORE_EXECUTOR_WORKERS = int(os.environ.get('FIRESTORE_EXECUTOR_WORKERS', '32'))
+# Cross-update LRU of userBotStates snapshots (0 disables it); entries are re-read after the TTL. Cached
+# entries are not checked against Firestore before use, so only enable it where a single process handles
+# every update (run_polling, or asgi_app with one worker), never on multi-instance GCF
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '0'))
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+# Times an update is re-run when its user's state was changed elsewhere while it ran (flush conflict).
+# A re-run repeats the handler, including its Telegram replies and group posts, so the user may see them
+# twice; with 0 the conflicting state write is dropped and the user just repeats the step
+UPDATE_CONFLICT_RERUNS = int(os.environ.get('UPDATE_CONFLICT_RERUNS', '0'))
+# Order counters of new group buys: one shard per GROUP_BUY_MEMBERS_PER_SHARD group members within
+# [MIN, MAX]; a buy's shard count is doubled (up to MAX) when its order transactions keep contending
+GROUP_BUY_COUNTER_SHARDS_MIN = int(os.environ.get('GROUP_BUY_COUNTER_SHARDS_MIN', '4'))
+GROUP_BUY_COUNTER_SHARDS_MAX = int(os.environ.get('GROUP_BUY_COUNTER_SHARDS_MAX', '64'))
+GROUP_BUY_MEMBERS_PER_SHARD = int(os.environ.get('GROUP_BUY_MEMBERS_PER_SHARD', '50'))
+# Edit group posts with live order progress, at most once per interval per post across instances (lease doc
+# in livePostEdits). On GCF (asyncio.run per request) an update's edits are made before the response, waiting
+# at most LIVE_POST_DRAIN_MAX_WAIT_SECONDS; later ones are left pending for the periodic jobs of a warm
+# instance or the scheduled auto_close_group_buys
+LIVE_POST_UPDATES = os.environ.get('LIVE_POST_UPDATES', 'true').lower() in ('1', 'true', 'yes')
+LIVE_POST_EDIT_INTERVAL_SECONDS = float(os.environ.get('LIVE_POST_EDIT_INTERVAL_SECONDS', '10'))
+LIVE_POST_DRAIN_MAX_WAIT_SECONDS = float(os.environ.get('LIVE_POST_DRAIN_MAX_WAIT_SECONDS', '0'))
+# Closing times such as "Sat 8pm" are read in this timezone and stored as UTC deadlineAt timestamps
+GROUP_BUY_TIMEZONE = os.environ.get('GROUP_BUY_TIMEZONE', 'Asia/Singapore')
 try:
-    BOT_TOKEN = os.environ['BOT_TOKEN']
-    logger.info(f"Attempting init with BOT_TOKEN ending: ...{BOT_TOKEN[-4:] if BOT_TOKEN else 'N/A'}")
-    
-    GCP_PROJECT_ID = os.environ.get('GCP_PROJECT') 
-    FIRESTORE_DATABASE_ID = "garupa-group-buy" 
-
-    if not GCP_PROJECT_ID:
-        logger.error("GCP_PROJECT environment variable not found. Firestore client might use default from credentials if GOOGLE_APPLICATION_CREDENTIALS is set for local testing.")
-
-    # --- Persistence Setup using CustomFirestorePersistence ---
+    GROUP_BUY_TZINFO = ZoneInfo(GROUP_BUY_TIMEZONE)
+except ZoneInfoNotFoundError:
+    logger.error(f"Unknown GROUP_BUY_TIMEZONE '{GROUP_BUY_TIMEZONE}' (is tzdata installed?), reading closing times as UTC.")
+    GROUP_BUY_TZINFO = timezone.utc
+# Close open buys once their deadlineAt passes: every interval on a timer in the long-lived modes (never in
+# the update path); per-request GCF has no loop to run it on, so deploy auto_close_group_buys on a schedule
+AUTO_CLOSE_GROUP_BUYS = os.environ.get('AUTO_CLOSE_GROUP_BUYS', 'true').lower() in ('1', 'true', 'yes')
+AUTO_CLOSE_INTERVAL_SECONDS = float(os.environ.get('AUTO_CLOSE_INTERVAL_SECONDS', '60'))
+AUTO_CLOSE_BATCH_SIZE = int(os.environ.get('AUTO_CLOSE_BATCH_SIZE', '200'))
+# HTTPX connections to the Telegram Bot API shared by all concurrent handlers
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.environ.get('TELEGRAM_CONNECTION_POOL_SIZE', '200'))
+
+if not GCP_PROJECT_ID:
+    logger.error("GCP_PROJECT environment variable not found. Firestore client might use default from credentials if GOOGLE_APPLICATION_CREDENTIALS is set for local testing.")
+
+# --- INITIALIZE BOT USING ApplicationBuilder (lazily) ---
+# Persistence, Application and handlers are built on first use (first relevant webhook, or startup of
+# the long-lived modes) instead of at import, so a cold start only pays for what the request needs.
+_application_lock = threading.Lock()
+_prewarm_stats: Dict[str, Any] = {}
+
+def _prewarm_firestore(persistence_obj: CustomFirestorePersistence) -> None:
+    """Thread target for FIRESTORE_PREWARM; failures only mean the first update opens the channel itself."""
     try:
-        persistence = CustomFirestorePersistence(
-            project_id=GCP_PROJECT_ID, 
-            database_id=FIRESTORE_DATABASE_ID, 
-            store_user_data=True,
-            store_chat_data=False, 
-            store_bot_data=True,   
-            user_bot_states_collection="userBotStates", 
-            bot_data_collection="telegramBotGlobalData" 
+        seconds = persistence_obj.prewarm()
+        _prewarm_stats.update(status='ok', seconds=round(seconds, 3))
+        logger.info(f"Firestore pre-warm finished in {seconds:.3f}s.")
+    except Exception as e:
+        _prewarm_stats.update(status='failed', error=str(e))
+        logger.warning(f"Firestore pre-warm failed ({e}); the first update will set up the channel instead.")
+
+def get_prewarm_metrics() -> Dict[str, Any]:
+    return dict(_prewarm_stats)
+
+def get_firestore_executor_metrics() -> Dict[str, Any]:
+    return persistence.executor.metrics() if isinstance(persistence, CustomFirestorePersistence) else {}
+
+def get_user_cache_metrics() -> Dict[str, Any]:
+    if isinstance(persistence, CustomFirestorePersistence) and persistence.user_cache is not None:
+        return persistence.user_cache.metrics()
+    return {}
+
+def get_auto_close_metrics() -> Dict[str, Any]:
+    return dict(persistence._auto_close_stats) if isinstance(persistence, CustomFirestorePersistence) else {}
+
+def _build_application() -> None:
+    """Builds persistence, the Application and its handlers, then publishes them as globals. Raises on failure."""
+    global application, bot, persistence
+    persistence_class = AsyncFirestorePersistence if FIRESTORE_CLIENT_MODE == 'async' else CustomFirestorePersistence
+    new_persistence = persistence_class(
+        project_id=GCP_PROJECT_ID, 
+        database_id=FIRESTORE_DATABASE_ID, 
+        store_user_data=True,
+        store_chat_data=False, 
+        store_bot_data=True,   
+        user_bot_states_collection="userBotStates", 
+        bot_data_collection="telegramBotGlobalData",
+        lazy_user_loading=LAZY_USER_LOADING,
+        executor_max_workers=FIRESTORE_EXECUTOR_WORKERS,
+        user_cache_max_entries=USER_CACHE_MAX_ENTRIES,
+        user_cache_ttl_seconds=USER_CACHE_TTL_SECONDS,
+        counter_shard_max=GROUP_BUY_COUNTER_SHARDS_MAX,
+        auto_close_interval_seconds=AUTO_CLOSE_INTERVAL_SECONDS,
+        auto_close_batch_size=AUTO_CLOSE_BATCH_SIZE,
+    )
+    logger.info(f"{persistence_class.__name__} configured. User/Conv states in: '{new_persistence.user_bot_states_collection_name}', Bot data in: '{new_persistence.bot_data_collection_name}'.")
+    if FIRESTORE_PREWARM:
+        # Overlaps channel setup and the auth token fetch with the builder below instead of the first update
+        _prewarm_stats['status'] = 'running'
+        threading.Thread(target=_prewarm_firestore, args=(new_persistence,), name="firestore-prewarm", daemon=True).start()
+
+    if BOT_IDENTITY_CACHE:
+        # ApplicationBuilder.bot() can't be combined with token()/pool settings, so the request is built here
+        identity_cache = BotIdentityCache(BOT_TOKEN, persistence_obj=new_persistence)
+        cached_bot = CachedIdentityBot(
+            token=BOT_TOKEN,
+            request=HTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE, pool_timeout=30.0),
+            identity_cache=identity_cache,
         )
-        logger.info(f"CustomFirestorePersistence configured. User/Conv states in: '{persistence.user_bot_states_collection_name}', Bot data in: '{persistence.bot_data_collection_name}'.")
-    except Exception as e_fs:
-        logger.error(f"!!! CRITICAL FAILURE: Failed to initialize CustomFirestorePersistence class: {e_fs}. Bot will not function correctly. !!!", exc_info=True)
-        persistence = None
-    # --- End Persistence Setup ---
-
-    if BOT_TOKEN:
+        builder = Application.builder().bot(cached_bot)
+    else:
         builder = Application.builder().token(BOT_TOKEN)
         builder.pool_timeout(30.0)
-        builder.connection_pool_size(200)
-
-        if persistence:
-            builder.persistence(persistence)
-            logger.info("CustomFirestorePersistence layer added to ApplicationBuilder.")
-        else:
-            logger.critical("!!! CRITICAL: Persistence layer IS NONE. Will not be added to ApplicationBuilder. Conversation state WILL BE LOST. !!!")
-
-        application = builder.build()
-        bot = application.bot
-        logger.info(f"Application object built successfully (Token ending: ...{BOT_TOKEN[-4:]})")
+        builder.connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+    builder.persistence(new_persistence)
+    logger.info("CustomFirestorePersistence layer added to ApplicationBuilder.")
+
+    new_application = builder.build()
+    _register_handlers(new_application)
+    persistence = new_persistence
+    bot = new_application.bot
+    application = new_application
+    logger.info(f"Application object built successfully (Token ending: ...{BOT_TOKEN[-4:]})")
+
+def _ensure_application() -> Optional[Application]:
+    """Returns the Application, building it on first call. None if initialization failed (retried next call)."""
+    if application is not None:
+        return application
+    with _application_lock:
+        if application is None:
+            started = time.perf_counter()
+            try:
+                _build_application()
+            except Exception as e:
+                logger.critical(f"!!! FATAL ERROR during Bot init: {e} !!!", exc_info=True)
+                return None
+            logger.info(f"✅ Cold Start Completed: Application and handlers initialized in {time.perf_counter() - started:.3f}s.")
+    return application
+
+
+def _get_firestore_persistence(context: ContextTypes.DEFAULT_TYPE) -> Optional[CustomFirestorePersistence]:
+    """Returns the application's CustomFirestorePersistence, or None if another/no persistence is used."""
+    persistence_obj = context.application.persistence
+    return persistence_obj if isinstance(persistence_obj, CustomFirestorePersistence) else None
+
+
+# === Closing Times ===
+# The organizer's free-text closing time ("Sat 8pm", "24 Apr 10pm") is kept as typed in 'deadline' and,
+# when it can be read, as a UTC 'deadlineAt' timestamp that the auto-close query runs on.
+_WEEKDAY_NAMES = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+_MONTH_NAMES = ('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december')
+_CLOSING_TIME_OF_DAY_RE = re.compile(r'\b(?:(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm)|(\d{1,2})[:.](\d{2})|(noon|midnight))\b')
+_CLOSING_RELATIVE_DAY_RE = re.compile(r'\b(today|tonight|tomorrow|tmr|tmrw|tml)\b')
+_CLOSING_NUMERIC_DATE_RE = re.compile(r'\b(\d{1,2})([/.])(\d{1,2})(?:\2(\d{4}|\d{2}))?\b')
+_CLOSING_DAY_MONTH_RE = re.compile(r'\b(\d{1,2})(?:st|nd|rd|th)?\s+([a-z]{3,9})\b\.?(?:\s+(\d{4})\b)?')
+_CLOSING_MONTH_DAY_RE = re.compile(r'\b([a-z]{3,9})\.?\s+(\d{1,2})(?:st|nd|rd|th)?\b(?:,?\s+(\d{4})\b)?')
+
+def _name_index(word: str, names: Tuple[str, ...]) -> Optional[int]:
+    """Index of the name `word` abbreviates ("sat", "sept", "thurs"), at least 3 letters; else None."""
+    if len(word) < 3:
+        return None
+    return next((index for index, name in enumerate(names) if name.startswith(word)), None)
+
+def _closing_time_of_day(match: "re.Match") -> Optional[Tuple[int, int]]:
+    """(hour, minute) of a _CLOSING_TIME_OF_DAY_RE match, None if out of range. Midnight is the end of the day."""
+    hour_12, minute_12, meridiem, hour_24, minute_24, named = match.groups()
+    if named:
+        return (12, 0) if named == 'noon' else (23, 59)
+    if meridiem:
+        hour, minute = int(hour_12), int(minute_12 or 0)
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'pm' else 0)
     else:
-        logger.error("Bot init failed: BOT_TOKEN environment variable is empty.")
-        application = None
-        bot = None
+        hour, minute = int(hour_24), int(minute_24)
+    return (hour, minute) if hour <= 23 and minute <= 59 else None
 
-except KeyError:
-    logger.critical("!!! FATAL ERROR: BOT_TOKEN environment variable not set! Function cannot work. !!!")
-    application = None
-    bot = None
-except Exception as e:
-    logger.critical(f"!!! FATAL ERROR during Bot init: {e} !!!", exc_info=True)
-    application = None
-    bot = None
-
-# --- Crash Fast if Bot Init Fails OR Persistence Fails ---
-if application is None:
-    logger.critical("❌ Application object is None after initialization block. Raising RuntimeError to fail GCF startup.")
-    raise RuntimeError("❌ Application failed to initialize. Telegram bot cannot start.")
-if persistence is None: 
-     logger.critical("❌ CustomFirestorePersistence is None. This is critical for GCF stateful conversations. Raising RuntimeError to fail GCF startup.")
-     raise RuntimeError("❌ CustomFirestorePersistence failed to initialize. Bot cannot maintain conversation state reliably.")
-# --- End Crash Fast ---
+def _closing_time_of_day_match(text: str) -> Tuple[Optional["re.Match"], Optional[Tuple[int, int]]]:
+    """
+    The time of day in `text` and its (hour, minute); (None, None) if there is none, (match, None) if
+    it is out of range ("13pm"). "18.30" only counts as a time when nothing else does and it is a valid
+    one, since "24.04" is a date; of several such, the last is taken ("31.12 18.00").
+    """
+    dotted = []
+    for match in _CLOSING_TIME_OF_DAY_RE.finditer(text):
+        if match.group(4) is not None and match.group(0)[len(match.group(4))] == '.':
+            dotted.append(match)
+            continue
+        return match, _closing_time_of_day(match)
+    for match in reversed(dotted):
+        time_of_day = _closing_time_of_day(match)
+        if time_of_day is not None:
+            return match, time_of_day
+    return None, None
+
+def _closing_day(text: str, today: datetime) -> Tuple[Optional[datetime], Optional[str], Optional[Tuple[int, int]]]:
+    """
+    The day named in `text` (midnight, naive), how to move it forward if that time has passed
+    ('year' for dates without a year, 'week' for weekdays, None if fixed) and the span it was read
+    from; (None, None, None) if no day is named. Raises ValueError for impossible dates.
+    """
+    match = _CLOSING_RELATIVE_DAY_RE.search(text)
+    if match:
+        return today + timedelta(days=0 if match.group(1) in ('today', 'tonight') else 1), None, match.span()
+    match = _CLOSING_NUMERIC_DATE_RE.search(text) # day first: 24/4, 24.04
+    if match:
+        day, _, month, year = match.groups()
+        year = int(year) + (2000 if len(year) == 2 else 0) if year else None
+        return datetime(year or today.year, int(month), int(day)), None if year else 'year', match.span()
+    for pattern, day_group, month_group in ((_CLOSING_DAY_MONTH_RE, 1, 2), (_CLOSING_MONTH_DAY_RE, 2, 1)):
+        for match in pattern.finditer(text):
+            month_index = _name_index(match.group(month_group), _MONTH_NAMES)
+            if month_index is not None:
+                year = match.group(3)
+                return datetime(int(year) if year else today.year, month_index + 1, int(match.group(day_group))), None if year else 'year', match.span()
+    for match in re.finditer(r'[a-z]+', text):
+        weekday = _name_index(match.group(0), _WEEKDAY_NAMES)
+        if weekday is not None:
+            return today + timedelta(days=(weekday - today.weekday()) % 7), 'week', match.span()
+    return None, None, None
+
+def parse_closing_time(text: Optional[str], now: Optional[datetime] = None, tz=None) -> Optional[datetime]:
+    """
+    Reads a closing time such as "Sat 8pm", "24 Apr 10pm", "tomorrow 9:30am", "31/12 18:00" or "8pm"
+    in `tz` (default GROUP_BUY_TIMEZONE) and returns it as an aware UTC datetime. Weekdays are the next
+    such day and dates without a year the next such date (unless it was within the last month), a day
+    without a time closes at 23:59, a time without a day is its next occurrence. Returns None if no day
+    or time is found, a number is left unread ("Sunday at 9": 9am or 9pm?) or the result isn't in the future.
+    """
+    tz = tz or GROUP_BUY_TZINFO
+    local_now = (now or datetime.now(timezone.utc)).astimezone(tz)
+    text = (text or '').lower()
+    match, time_of_day = _closing_time_of_day_match(text)
+    if match:
+        if time_of_day is None:
+            return None
+        text = f"{text[:match.start()]} {text[match.end():]}" # so "Apr 10pm" isn't read as 10 April
+    try:
+        day, roll, span = _closing_day(text, datetime(local_now.year, local_now.month, local_now.day))
+        if re.search(r'\d', f"{text[:span[0]]} {text[span[1]:]}" if span else text):
+            return None
+        if day is None:
+            if time_of_day is None:
+                return None
+            day, roll = datetime(local_now.year, local_now.month, local_now.day), 'day'
+        hour, minute = time_of_day or (23, 59)
+        closing = day.replace(hour=hour, minute=minute, tzinfo=tz)
+        if closing <= local_now:
+            if roll == 'day':
+                closing += timedelta(days=1)
+            elif roll == 'week':
+                closing += timedelta(days=7)
+            elif roll == 'year' and closing < local_now - timedelta(days=31): # a recent date is a typo, not next year
+                closing = closing.replace(year=closing.year + 1)
+    except ValueError: # e.g. 31 Feb
+        return None
+    return closing.astimezone(timezone.utc) if closing > local_now else None
+
+def _format_closing_time(closing_at: datetime) -> str:
+    """e.g. "Sat 26 Apr 2025, 8:00 PM" in GROUP_BUY_TIMEZONE."""
+    local = closing_at.astimezone(GROUP_BUY_TZINFO)
+    return f"{local:%a} {local.day} {local:%b %Y}, {local.hour % 12 or 12}:{local:%M} {'AM' if local.hour < 12 else 'PM'}"
 
 
 # === Conversation Handler Functions ===
@@ -371,6 +1877,7 @@ async def handle_unexpected_state(update: Update, context: ContextTypes.DEFAULT_
     if update.message: update_type = "Message"
     elif update.callback_query: update_type = "CallbackQuery"
 
+    import pprint # Only needed on this diagnostic path
     user_data_str = pprint.pformat(context.user_data)
     bot_data_str = pprint.pformat(context.bot_data) 
     logger.warning(
@@ -450,12 +1957,10 @@ async def start_setup_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e_ans:
          logger.error(f"Error answering callback query in start_setup_callback: {e_ans}", exc_info=True)
 
-    # Retrieve group info from bot_data (now persistent) and put it in user_data
-    group_info_key = f'group_info_{user.id}'
-    # Use get() for bot_data as well to avoid KeyError if not found, though pop is fine too.
-    group_info = context.bot_data.get(group_info_key)
-    if group_info:
-        context.bot_data.pop(group_info_key) # Remove after retrieval
+    # Retrieve group info from the user's handoff doc (deleted on retrieval) and put it in user_data.
+    # Handoffs older versions kept in bot_data are moved to handoff docs when bot_data is read.
+    persistence_obj = _get_firestore_persistence(context)
+    group_info = await persistence_obj.pop_group_handoff(user.id) if persistence_obj else None
 
     context.user_data.clear() # Clear user_data before starting this specific conversation flow
     if group_info:
@@ -463,7 +1968,7 @@ async def start_setup_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['group_name'] = group_info.get('group_name')
         logger.info(f"Retrieved and stored group info in user_data: {group_info}")
     else:
-        logger.warning(f"Could not find group info in bot_data for user {user.id} with key {group_info_key}. Starting setup without group context.")
+        logger.warning(f"Could not find group handoff for user {user.id}. Starting setup without group context.")
         context.user_data.pop('group_chat_id', None)
         context.user_data.pop('group_name', None)
     logger.info(f"User_data at start of start_setup_callback (after potential update): {context.user_data}")
@@ -584,9 +2089,16 @@ async def received_closing_time(update: Update, context: ContextTypes.DEFAULT_TY
     logger.info(f"STATE HANDLER: received_closing_time entered for User {user.id}. User data: {context.user_data}")
     closing_time_text = update.message.text
     context.user_data['closing_time'] = closing_time_text
-    logger.info(f"User {user.id} set closing time: {closing_time_text}")
+    closing_time_at = parse_closing_time(closing_time_text)
+    # Stored as text: user_data is persisted as JSON-like pendingData
+    context.user_data['closing_time_at'] = closing_time_at.isoformat() if closing_time_at else None
+    logger.info(f"User {user.id} set closing time: {closing_time_text} (parsed: {closing_time_at})")
+    if closing_time_at:
+        closing_note = f"(closes automatically on {_format_closing_time(closing_time_at)})"
+    else:
+        closing_note = "(I couldn't read a future date/time from this, so it won't close automatically)"
     await update.message.reply_text(
-        f"Closing time: **{closing_time_text}**\n\nWhere is the pickup location?\n(e.g., Lobby A, Sat 4–6pm or I will deliver to units.)",
+        f"Closing time: **{closing_time_text}** {closing_note}\n\nWhere is the pickup location?\n(e.g., Lobby A, Sat 4–6pm or I will deliver to units.)",
         parse_mode=ParseMode.MARKDOWN
     )
     logger.info(f"received_closing_time: Returning state ASKING_PICKUP ({ASKING_PICKUP})")
@@ -671,13 +2183,15 @@ async def show_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_data = context.user_data
     logger.info(f"STATE HANDLER: show_confirmation entered for User {user.id}. User data: {user_data}")
     group_name = user_data.get('group_name', 'the group')
+    closing_time_at = user_data.get('closing_time_at')
+    auto_close_note = f" (auto-closes {_format_closing_time(datetime.fromisoformat(closing_time_at))})" if closing_time_at else ""
     summary = (
         "Okay, let's review your group buy:\n\n"
         f"**Item:** {user_data.get('item_name', 'Not set')}\n"
         f"**Image:** {'Yes' if user_data.get('image_file_id') else 'No'}\n"
         f"**Price:** {user_data.get('price', 'Not set')}\n"
         f"**MOQ:** {user_data.get('moq', 'Not set')}\n"
-        f"**Closing:** {user_data.get('closing_time', 'Not set')}\n"
+        f"**Closing:** {user_data.get('closing_time', 'Not set')}{auto_close_note}\n"
         f"**Pickup:** {user_data.get('pickup', 'Not set')}\n"
         f"**Payment:** {user_data.get('payment_method', 'Not set')}"
     )
@@ -705,6 +2219,21 @@ async def show_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE)
              except Exception as e_send: logger.error(f"Failed to send error message in show_confirmation: {e_send}")
         return ConversationHandler.END
 
+def _group_buy_post_keyboard(group_buy_id: str) -> Optional[InlineKeyboardMarkup]:
+    """Order/view buttons of a group post (also re-sent with every live progress edit)."""
+    order_callback_data = _encode_callback_data({'a': 'order', 'gid': group_buy_id}) 
+    view_callback_data = _encode_callback_data({'a': 'view', 'gid': group_buy_id})
+
+    if len(order_callback_data.encode('utf-8')) > 64 or len(view_callback_data.encode('utf-8')) > 64:
+        logger.error("Callback data for order/view buttons is too long!")
+        return None
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🛒 Order Now", callback_data=order_callback_data),
+            InlineKeyboardButton("👀 See Who Ordered", callback_data=view_callback_data),
+        ]
+    ])
+
 async def received_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the final confirmation: Posts to group and ends conversation."""
     query = update.callback_query
@@ -723,11 +2252,13 @@ async def received_confirmation(update: Update, context: ContextTypes.DEFAULT_TY
         price = user_data.get('price', 'N/A')
         moq = user_data.get('moq', 'N/A')
         closing_time = user_data.get('closing_time', 'N/A')
+        closing_time_at = user_data.get('closing_time_at')
         pickup = user_data.get('pickup', 'N/A')
         payment_method = user_data.get('payment_method', 'N/A')
         payment_details = user_data.get('payment_details', 'N/A')
         payment_qr_file_id = user_data.get('payment_qr_file_id')
         organizer_mention = user.mention_html()
+        import uuid # Only needed when a group buy is posted
         group_buy_id = str(uuid.uuid4()) 
 
         firestore_group_buy_data = {
@@ -739,8 +2270,9 @@ async def received_confirmation(update: Update, context: ContextTypes.DEFAULT_TY
             'imageFileId': image_file_id,
             'initiatorUserId': str(user.id),
             'initiatorUsername': user.username or "",
-            'createdAt': firestore.SERVER_TIMESTAMP,
+            'createdAt': _firestore().SERVER_TIMESTAMP,
             'deadline': closing_time,
+            'deadlineAt': datetime.fromisoformat(closing_time_at) if closing_time_at else None, # UTC, None = closed by hand only
             'status': 'open',
             'minParticipants': user_data.get('moq_numeric', 0 if str(moq).lower() == 'no moq' else moq),
             'maxParticipants': user_data.get('max_participants', 0),
@@ -769,19 +2301,9 @@ async def received_confirmation(update: Update, context: ContextTypes.DEFAULT_TY
         if payment_method == 'Digital': post_caption += f" ({payment_details})"
         post_caption += (f"\n\nOrganized by: {organizer_mention}\n\n👇 Click below to order or see details!")
 
-        order_callback_data = json.dumps({'a': 'order', 'gid': group_buy_id}) 
-        view_callback_data = json.dumps({'a': 'view', 'gid': group_buy_id})
-
-        if len(order_callback_data.encode('utf-8')) > 64 or len(view_callback_data.encode('utf-8')) > 64:
-            logger.error("Callback data for order/view buttons is too long!")
-            post_keyboard = None
-        else:
-            post_keyboard = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("🛒 Order Now", callback_data=order_callback_data),
-                    InlineKeyboardButton("👀 See Who Ordered", callback_data=view_callback_data),
-                ]
-            ])
+        # Kept on the buy doc so LivePostEditor can re-render the post with order progress
+        firestore_group_buy_data_cleaned['postCaption'] = post_caption
+        post_keyboard = _group_buy_post_keyboard(group_buy_id)
 
         if group_chat_id:
             logger.info(f"Attempting to post group buy {group_buy_id} to chat ID: {group_chat_id}")
@@ -873,10 +2395,17 @@ async def newbuy_command_group(update: Update, context: ContextTypes.DEFAULT_TYP
     user_mention = user.mention_html()
     bot_username = context.bot.username
     temp_group_info = {'group_chat_id': group_chat_id, 'group_name': chat.title if chat.title else "this group"}
-    group_info_key = f'group_info_{user_id}'
+    persistence_obj = _get_firestore_persistence(context)
     
-    context.bot_data[group_info_key] = temp_group_info # This will be persisted by FirestorePersistence
-    logger.info(f"Stored temporary group info for user {user.id} in bot_data (key: {group_info_key}): {temp_group_info}")
+    # Stored in the user's own expiring handoff doc rather than the shared bot_data doc
+    try:
+        if persistence_obj:
+            await persistence_obj.save_group_handoff(user_id, group_chat_id, temp_group_info['group_name'])
+            logger.info(f"Stored group handoff for user {user.id}: {temp_group_info}")
+        else:
+            logger.error("newbuy_command_group: CustomFirestorePersistence not available, group handoff not stored.")
+    except Exception as e_handoff:
+        logger.error(f"Error storing group handoff for user {user.id}: {e_handoff}", exc_info=True)
     
     dm_text = (f"Hi {user.first_name}! You started a new group buy in '{temp_group_info['group_name']}'.\n\nClick the button below to start setting it up here.")
     keyboard = [[InlineKeyboardButton("🚀 Start Setup", callback_data='start_setup')]]
@@ -891,49 +2420,580 @@ async def newbuy_command_group(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.info(f"Sent group confirmation (DM success) to {group_chat_id}")
     except Forbidden:
         logger.warning(f"FAILED to send DM to user {user.id} (Forbidden)")
-        context.bot_data.pop(group_info_key, None) # Clean up if DM failed
+        if persistence_obj: await persistence_obj.delete_group_handoff(user_id) # Clean up if DM failed
         await context.bot.send_message(chat_id=group_chat_id, text=group_reply_fail, parse_mode=ParseMode.HTML)
         logger.info(f"Sent group instruction (DM failed) to {group_chat_id}")
     except Exception as e_dm:
         logger.error(f"ERROR sending initial DM to user {user.id}: {e_dm}", exc_info=True)
-        context.bot_data.pop(group_info_key, None) # Clean up
+        if persistence_obj: await persistence_obj.delete_group_handoff(user_id) # Clean up
         await context.bot.send_message(chat_id=group_chat_id, text=f"Sorry {user_mention}, an error occurred trying to contact you privately.", parse_mode=ParseMode.HTML)
 
+    # Handoffs of users who never clicked "Start Setup" expire; clear them out periodically
+    if persistence_obj: await persistence_obj.maybe_sweep_expired_group_handoffs()
+
+# === Orders ("🛒 Order Now" on group posts) ===
+# Tapping the button in the group DMs the member a quantity picker; quantity/cancel taps in the DM
+# write groupBuys/{id}/orders/{user_id} and the buy's counters in one transaction.
+ORDER_QUANTITY_CHOICES = (1, 2, 3, 4, 5, 10)
+# JSON callback data always starts with the action, e.g. {"a":"oq","gid":"...","q":2} (posts made
+# before callback data was compacted have a space after the colon)
+ORDER_CALLBACK_PATTERN = r'^\{"a": ?"(order|oq|oc)"'
+
+def _order_quantity_keyboard(group_buy_id: str, current_quantity: Optional[int] = None) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(f"✅ {quantity}" if quantity == current_quantity else str(quantity),
+                             callback_data=_encode_callback_data({'a': 'oq', 'gid': group_buy_id, 'q': quantity}))
+        for quantity in ORDER_QUANTITY_CHOICES
+    ]
+    rows = [buttons[:3], buttons[3:]]
+    if current_quantity is not None:
+        rows.append([InlineKeyboardButton("❌ Cancel my order", callback_data=_encode_callback_data({'a': 'oc', 'gid': group_buy_id}))])
+    return InlineKeyboardMarkup(rows)
+
+def _order_summary(group_buy: Dict[str, Any]) -> str:
+    return (f"🛒 {group_buy.get('itemName', 'Group buy')}\n"
+            f"Price: {group_buy.get('itemPrice', 'N/A')}\n"
+            f"Pickup/Delivery: {group_buy.get('pickupAddress', 'N/A')}")
+
+GROUP_BUY_CLOSED_MESSAGE = "This group buy is closed and no longer taking orders."
+
+async def _load_open_group_buy(persistence_obj: CustomFirestorePersistence, group_buy_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """(group buy, None) if it can take orders, else (None or the buy, message for the user)."""
+    group_buy = await persistence_obj.get_group_buy(group_buy_id)
+    if not group_buy:
+        return None, "Sorry, I couldn't find this group buy."
+    if not CustomFirestorePersistence.accepts_orders(group_buy):
+        return group_buy, GROUP_BUY_CLOSED_MESSAGE
+    return group_buy, None
+
+async def order_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/start order_<group_buy_id> in DM: the deep link given to members who hadn't started a chat with the bot."""
+    user = update.effective_user
+    group_buy_id = context.args[0][len('order_'):] if context.args else ''
+    persistence_obj = _get_firestore_persistence(context)
+    logger.info(f"order_start_command: User {user.id} opened the order link for group buy {group_buy_id}.")
+    if not persistence_obj:
+        logger.error("order_start_command: CustomFirestorePersistence not available.")
+        await update.message.reply_text("Sorry, ordering is not available right now. Please try again later.")
+        return
+    try:
+        group_buy, problem = await _load_open_group_buy(persistence_obj, group_buy_id)
+    except Exception as e:
+        logger.error(f"order_start_command: Error loading group buy {group_buy_id}: {e}", exc_info=True)
+        await update.message.reply_text("Sorry, something went wrong. Please tap 🛒 Order Now in the group again.")
+        return
+    if problem:
+        await update.message.reply_text(problem)
+        return
+    await update.message.reply_text(f"{_order_summary(group_buy)}\n\nHow many would you like?", reply_markup=_order_quantity_keyboard(group_buy_id))
+
+async def order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles the order buttons: 'order' on the group post (sends the quantity picker by DM), and
+    'oq' (set quantity) / 'oc' (cancel order) in the DM.
+    """
+    query = update.callback_query
+    user = update.effective_user
+    payload = _decode_callback_data(query.data) or {}
+    action = payload.get('a')
+    group_buy_id = payload.get('gid')
+    persistence_obj = _get_firestore_persistence(context)
+    logger.info(f"order_callback: User {user.id} pressed '{action}' for group buy {group_buy_id}.")
+    if not isinstance(group_buy_id, str) or not persistence_obj:
+        await query.answer("Sorry, this button no longer works.", show_alert=True)
+        return
+
+    try:
+        group_buy, problem = await _load_open_group_buy(persistence_obj, group_buy_id)
+    except Exception as e:
+        logger.error(f"order_callback: Error loading group buy {group_buy_id}: {e}", exc_info=True)
+        await query.answer("Sorry, something went wrong. Please try again.", show_alert=True)
+        return
+    if problem:
+        await query.answer(problem, show_alert=True)
+        return
+
+    if action == 'order':
+        try:
+            await context.bot.send_message(chat_id=user.id, text=f"{_order_summary(group_buy)}\n\nHow many would you like?",
+                                           reply_markup=_order_quantity_keyboard(group_buy_id))
+            await query.answer("I've sent you a DM to choose your quantity.")
+        except Forbidden:
+            # No chat with the bot yet: the link opens one and sends /start order_<id> (handled by order_start_command)
+            logger.info(f"order_callback: Can't DM user {user.id}, answering with a deep link.")
+            await query.answer(url=f"https://t.me/{context.bot.username}?start=order_{group_buy_id}")
+        return
+
+    try:
+        if action == 'oq':
+            quantity = payload.get('q')
+            if quantity not in ORDER_QUANTITY_CHOICES:
+                await query.answer("Sorry, that quantity isn't available.", show_alert=True)
+                return
+            order_details = {'username': user.username or '', 'displayName': user.full_name}
+            shard_count = persistence_obj.get_counter_shard_count(group_buy_id, group_buy)
+            previous_quantity = await persistence_obj.place_order(group_buy_id, user.id, quantity, order_details, shard_count=shard_count)
+            logger.info(f"order_callback: User {user.id} ordered {quantity} for group buy {group_buy_id} (previously {previous_quantity}).")
+            await query.answer(f"Order {'updated' if previous_quantity is not None else 'placed'}: {quantity}")
+            if LIVE_POST_UPDATES: _live_post_editor.schedule(context.bot, persistence_obj, group_buy_id)
+            text = f"✅ Your order: {quantity}\n\n{_order_summary(group_buy)}\n\nTap a number to change it."
+            reply_markup = _order_quantity_keyboard(group_buy_id, quantity)
+        else: # 'oc'
+            removed_quantity = await persistence_obj.cancel_order(group_buy_id, user.id, shard_count=persistence_obj.get_counter_shard_count(group_buy_id, group_buy))
+            logger.info(f"order_callback: User {user.id} cancelled their order for group buy {group_buy_id} (quantity {removed_quantity}).")
+            await query.answer("Order cancelled." if removed_quantity is not None else "You have no order for this group buy.")
+            if LIVE_POST_UPDATES and removed_quantity is not None: _live_post_editor.schedule(context.bot, persistence_obj, group_buy_id)
+            text = f"Your order was cancelled.\n\n{_order_summary(group_buy)}\n\nTap a number to order again."
+            reply_markup = _order_quantity_keyboard(group_buy_id)
+    except GroupBuyClosedError: # closed while the user was choosing; the transaction re-checks it
+        logger.info(f"order_callback: Group buy {group_buy_id} closed before user {user.id}'s order was saved.")
+        await query.answer(GROUP_BUY_CLOSED_MESSAGE, show_alert=True)
+        return
+    except Exception as e:
+        logger.error(f"order_callback: Error saving order of user {user.id} for group buy {group_buy_id}: {e}", exc_info=True)
+        await query.answer("Sorry, your order couldn't be saved. Please try again.", show_alert=True)
+        return
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except TelegramError as e_edit: # e.g. "message is not modified" when the same quantity is tapped twice
+        logger.debug(f"order_callback: Could not edit the order message: {e_edit}")
+
+
+# === "👀 See Who Ordered" (paginated order list) ===
+# The list is sent by DM and paged with {"a":"vp","gid":...,"p":n} buttons. Rendered pages are cached
+# per (buy, page) and tagged with the buy's order version (see get_order_totals), so repeated taps
+# re-render, and re-query the orders, only after an order was placed or cancelled.
+ORDER_LIST_PAGE_SIZE = 20
+VIEW_CALLBACK_PATTERN = r'^\{"a": ?"(view|vp)"'
+
+class OrderListPageCache:
+    """LRU of rendered order-list pages: (group_buy_id, page) -> (version, HTML, has next page)."""
+    def __init__(self, max_entries: int = 500):
+        self.max_entries = max_entries
+        self._pages: "OrderedDict[Tuple[str, int], Tuple[int, str, bool]]" = OrderedDict()
+        self._lock = threading.Lock() # concurrent GCF requests share the module-level cache
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, group_buy_id: str, page: int, version: int) -> Optional[Tuple[str, bool]]:
+        with self._lock:
+            entry = self._pages.get((group_buy_id, page))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._pages.move_to_end((group_buy_id, page))
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, group_buy_id: str, page: int, version: int, page_html: str, has_next: bool) -> None:
+        with self._lock:
+            self._pages[(group_buy_id, page)] = (version, page_html, has_next)
+            self._pages.move_to_end((group_buy_id, page))
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {'size': len(self._pages), 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0}
+
+_order_list_page_cache = OrderListPageCache()
+
+def get_order_list_cache_metrics() -> Dict[str, Any]:
+    return _order_list_page_cache.metrics()
+
+def _format_order_list_page(group_buy: Dict[str, Any], totals: Dict[str, int], orders: list, page: int) -> str:
+    lines = [
+        f"👀 <b>Who ordered: {html.escape(str(group_buy.get('itemName', 'Group buy')))}</b>",
+        f"Participants: {totals['participants']} · Total quantity: {totals['quantity']}",
+        "",
+    ]
+    for position, order in enumerate(orders, start=page * ORDER_LIST_PAGE_SIZE + 1):
+        name = html.escape(order.get('displayName') or 'Someone')
+        username = f" (@{html.escape(order['username'])})" if order.get('username') else ""
+        lines.append(f"{position}. {name}{username} × {order.get('quantity', 0)}")
+    if not orders:
+        lines.append("No orders yet." if page == 0 else "No more orders.")
+    return "\n".join(lines)
+
+async def _render_order_list_page(persistence_obj: CustomFirestorePersistence, group_buy_id: str, page: int) -> Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]:
+    """(HTML, pagination keyboard) for one page, from the page cache while the buy's version is unchanged. None if the buy doesn't exist."""
+    group_buy, totals = await persistence_obj.get_group_buy_with_totals(group_buy_id)
+    if not group_buy:
+        return None
+    cached = _order_list_page_cache.get(group_buy_id, page, totals['version'])
+    if cached is None:
+        orders, has_next = await persistence_obj.get_order_page(group_buy_id, page, ORDER_LIST_PAGE_SIZE, totals['version'])
+        cached = (_format_order_list_page(group_buy, totals, orders, page), has_next)
+        _order_list_page_cache.put(group_buy_id, page, totals['version'], *cached)
+    page_html, has_next = cached
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=_encode_callback_data({'a': 'vp', 'gid': group_buy_id, 'p': page - 1})))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=_encode_callback_data({'a': 'vp', 'gid': group_buy_id, 'p': page + 1})))
+    return page_html, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def view_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/start view_<group_buy_id> in DM: deep link for members who hadn't started a chat with the bot."""
+    group_buy_id = context.args[0][len('view_'):] if context.args else ''
+    persistence_obj = _get_firestore_persistence(context)
+    logger.info(f"view_start_command: User {update.effective_user.id} opened the order list link for group buy {group_buy_id}.")
+    try:
+        rendered = await _render_order_list_page(persistence_obj, group_buy_id, 0) if persistence_obj else None
+    except Exception as e:
+        logger.error(f"view_start_command: Error rendering orders of group buy {group_buy_id}: {e}", exc_info=True)
+        rendered = None
+    if rendered is None:
+        await update.message.reply_text("Sorry, I couldn't load the orders for this group buy.")
+        return
+    await update.message.reply_text(rendered[0], parse_mode=ParseMode.HTML, reply_markup=rendered[1])
+
+async def view_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """'view' on the group post sends page 1 by DM; 'vp' in the DM switches the page in place."""
+    query = update.callback_query
+    user = update.effective_user
+    payload = _decode_callback_data(query.data) or {}
+    action = payload.get('a')
+    group_buy_id = payload.get('gid')
+    page = payload.get('p', 0)
+    persistence_obj = _get_firestore_persistence(context)
+    if not isinstance(group_buy_id, str) or not isinstance(page, int) or page < 0 or not persistence_obj:
+        await query.answer("Sorry, this button no longer works.", show_alert=True)
+        return
+    try:
+        rendered = await _render_order_list_page(persistence_obj, group_buy_id, page)
+    except Exception as e:
+        logger.error(f"view_orders_callback: Error rendering orders of group buy {group_buy_id}: {e}", exc_info=True)
+        await query.answer("Sorry, something went wrong. Please try again.", show_alert=True)
+        return
+    if rendered is None:
+        await query.answer("Sorry, I couldn't find this group buy.", show_alert=True)
+        return
+    page_html, reply_markup = rendered
+
+    if action == 'view':
+        try:
+            await context.bot.send_message(chat_id=user.id, text=page_html, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+            await query.answer("I've sent you the list in a DM.")
+        except Forbidden:
+            logger.info(f"view_orders_callback: Can't DM user {user.id}, answering with a deep link.")
+            await query.answer(url=f"https://t.me/{context.bot.username}?start=view_{group_buy_id}")
+        return
+    await query.answer()
+    try:
+        await query.edit_message_text(text=page_html, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except TelegramError as e_edit: # e.g. "message is not modified"
+        logger.debug(f"view_orders_callback: Could not edit the order list message: {e_edit}")
+
+
+# === Live Order Progress on Group Posts ===
+def _live_post_text(group_buy: Dict[str, Any], totals: Dict[str, int]) -> str:
+    """The post's original caption plus the current participant/quantity counts, MOQ progress and closed state."""
+    lines = [group_buy['postCaption'], "", f"📊 <b>Orders so far:</b> {totals['participants']} participant(s), quantity {totals['quantity']}"]
+    moq = group_buy.get('minParticipants')
+    if isinstance(moq, (int, float)) and moq > 0:
+        filled = min(10, int(totals['quantity'] * 10 // moq))
+        status = "✅ MOQ reached!" if totals['quantity'] >= moq else f"{totals['quantity']}/{moq:g}"
+        lines.append(f"MOQ: {'▓' * filled}{'░' * (10 - filled)} {status}")
+    if group_buy.get('status') == 'closed':
+        lines.append("🔒 <b>Closed</b>, no longer taking orders.")
+    return "\n".join(lines)
+
+class LivePostEditor:
+    """
+    Keeps group-buy posts showing live order progress without running into Telegram's per-chat edit
+    limits: order changes to a buy are coalesced into at most one edit per `interval_seconds` per post,
+    edits that wouldn't change the text are skipped, and a RetryAfter pauses every post in that chat.
+    The interval holds across instances through a Firestore lease per buy (claim_live_edit); an edit
+    that isn't allowed yet stays pending on the lease and is made by flush_pending_live_edits.
+    On a long-lived loop a task per buy does the edits; loops that end with the request (GCF
+    asyncio.run) call drain() instead.
+    """
+    def __init__(self, interval_seconds: float = 10.0, max_tracked_posts: int = 1000):
+        self.interval_seconds = interval_seconds
+        self.max_tracked_posts = max_tracked_posts
+        self._dirty: Dict[str, Tuple[Any, CustomFirestorePersistence]] = {} # group_buy_id -> (bot, persistence)
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._last_edit_at: Dict[str, float] = {}
+        self._last_text: Dict[str, str] = {}
+        self._chat_paused_until: Dict[str, float] = {}
+        self.edits = 0
+        self.coalesced = 0
+        self.skipped_no_op = 0
+        self.retry_after = 0
+        self.lease_waits = 0
+        self.deferred = 0
+        self.errors = 0
+
+    def schedule(self, bot, persistence_obj: CustomFirestorePersistence, group_buy_id: str) -> None:
+        """Marks the buy's post for a progress edit; the edit itself happens when the post's interval allows."""
+        if group_buy_id in self._dirty:
+            self.coalesced += 1
+        self._dirty[group_buy_id] = (bot, persistence_obj)
+        task = self._tasks.get(group_buy_id)
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._tasks[group_buy_id] = asyncio.create_task(self._run(group_buy_id))
+
+    def _seconds_until_due(self, group_buy_id: str) -> float:
+        return self._last_edit_at.get(group_buy_id, float('-inf')) + self.interval_seconds - time.monotonic()
+
+    async def _run(self, group_buy_id: str) -> None:
+        try:
+            while group_buy_id in self._dirty:
+                wait = self._seconds_until_due(group_buy_id)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                retry_in = await self._edit_now(group_buy_id)
+                if retry_in:
+                    await asyncio.sleep(retry_in)
+        finally:
+            if self._tasks.get(group_buy_id) is asyncio.current_task():
+                del self._tasks[group_buy_id]
+
+    async def _edit_now(self, group_buy_id: str) -> Optional[float]:
+        """
+        Edits the post if its text changed and the buy's edit lease is free. Returns seconds to wait
+        before retrying (chat paused, or the post was edited within the interval, possibly by another
+        instance), else None.
+        """
+        bot, persistence_obj = self._dirty.pop(group_buy_id)
+        chat_id = None
+        try:
+            group_buy = await persistence_obj.get_group_buy(group_buy_id)
+            # Posts made before the caption was stored on the buy doc can't be re-rendered
+            if not group_buy or not group_buy.get('postCaption') or not group_buy.get('telegramPostMessageID') or not group_buy.get('telegramGroupChatID'):
+                return None
+            chat_id = group_buy['telegramGroupChatID']
+            paused_for = self._chat_paused_until.get(chat_id, 0.0) - time.monotonic()
+            if paused_for > 0:
+                self._dirty.setdefault(group_buy_id, (bot, persistence_obj))
+                return paused_for
+            lease_wait = await persistence_obj.claim_live_edit(group_buy_id, self.interval_seconds)
+            if lease_wait > 0:
+                self.lease_waits += 1
+                self._dirty.setdefault(group_buy_id, (bot, persistence_obj))
+                return lease_wait
+            text = _live_post_text(group_buy, await persistence_obj.get_order_totals(group_buy_id, group_buy))
+            if text == self._last_text.get(group_buy_id):
+                self.skipped_no_op += 1
+                return None
+            edit_kwargs = {'chat_id': int(chat_id), 'message_id': int(group_buy['telegramPostMessageID']),
+                           'parse_mode': ParseMode.HTML, 'reply_markup': _group_buy_post_keyboard(group_buy_id)}
+            try:
+                if group_buy.get('imageFileId'): # posted with send_photo
+                    await bot.edit_message_caption(caption=text, **edit_kwargs)
+                else:
+                    await bot.edit_message_text(text=text, **edit_kwargs)
+                self.edits += 1
+            except BadRequest as e_edit:
+                if 'not modified' not in str(e_edit).lower():
+                    raise
+                self.skipped_no_op += 1
+            self._remember_edit(group_buy_id, text)
+        except asyncio.CancelledError:
+            self._dirty.setdefault(group_buy_id, (bot, persistence_obj)) # drain() picks it up
+            raise
+        except RetryAfter as e_retry:
+            retry_after = e_retry.retry_after
+            wait = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+            self.retry_after += 1
+            self._chat_paused_until[chat_id] = time.monotonic() + wait
+            self._dirty.setdefault(group_buy_id, (bot, persistence_obj))
+            try:
+                await persistence_obj.defer_live_edit(group_buy_id, wait) # other instances back off too
+            except Exception as e_defer:
+                logger.error(f"LivePostEditor: Could not defer the edit of group buy {group_buy_id}: {e_defer}")
+            logger.warning(f"LivePostEditor: RetryAfter {wait:.0f}s editing post of group buy {group_buy_id}, pausing edits in chat {chat_id}.")
+            return wait
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"LivePostEditor: Could not update post of group buy {group_buy_id}: {e}", exc_info=True)
+        return None
+
+    def _remember_edit(self, group_buy_id: str, text: str) -> None:
+        self._last_text[group_buy_id] = text
+        self._last_edit_at[group_buy_id] = time.monotonic()
+        while len(self._last_text) > self.max_tracked_posts:
+            oldest = next(iter(self._last_text))
+            self._last_text.pop(oldest)
+            self._last_edit_at.pop(oldest, None)
+
+    async def drain(self, max_wait_seconds: float = 0.0) -> None:
+        """
+        For loops that end with the request: stops the per-buy tasks, makes the edits the leases allow
+        now and waits up to max_wait_seconds for the rest. Edits that still aren't allowed are left
+        pending on their lease doc for flush_pending_live_edits (the periodic jobs of any warm instance
+        or the scheduled auto_close_group_buys job), not on this instance's memory.
+        """
+        running_loop = asyncio.get_running_loop()
+        for task in list(self._tasks.values()):
+            if task.get_loop() is running_loop and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._tasks.clear()
+        deadline = time.monotonic() + max_wait_seconds
+        waiting: Dict[str, float] = {}
+        while self._dirty:
+            group_buy_id = next(iter(self._dirty))
+            persistence_obj = self._dirty[group_buy_id][1]
+            retry_in = await self._edit_now(group_buy_id)
+            if not retry_in:
+                continue
+            if time.monotonic() + retry_in <= deadline:
+                waiting[group_buy_id] = time.monotonic() + retry_in
+                self._dirty[group_buy_id] = self._dirty.pop(group_buy_id) # to the back of the queue
+                if all(gid in waiting for gid in self._dirty):
+                    await asyncio.sleep(max(0.0, min(waiting.values()) - time.monotonic()))
+                continue
+            self._dirty.pop(group_buy_id, None)
+            self.deferred += 1
+            try:
+                await persistence_obj.defer_live_edit(group_buy_id, retry_in)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"LivePostEditor: Could not leave the edit of group buy {group_buy_id} pending: {e}", exc_info=True)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'pending': len(self._dirty), 'edits': self.edits, 'coalesced': self.coalesced,
+                'skipped_no_op': self.skipped_no_op, 'retry_after': self.retry_after,
+                'lease_waits': self.lease_waits, 'deferred': self.deferred, 'errors': self.errors}
+
+_live_post_editor = LivePostEditor(interval_seconds=LIVE_POST_EDIT_INTERVAL_SECONDS)
+
+def get_live_post_metrics() -> Dict[str, int]:
+    return _live_post_editor.metrics()
+
+_last_pending_live_edit_check = float('-inf')
+
+async def flush_pending_live_edits(force: bool = False) -> list:
+    """
+    Makes the post edits left pending on their lease docs (trailing edits of a burst, RetryAfter), whichever
+    instance deferred them. Checks at most once per edit interval on this instance unless `force`.
+    Returns the buy ids whose edits were queued.
+    """
+    global _last_pending_live_edit_check
+    persistence_obj = application.persistence if application else None
+    if not LIVE_POST_UPDATES or not isinstance(persistence_obj, CustomFirestorePersistence):
+        return []
+    now = time.monotonic()
+    if not force and now - _last_pending_live_edit_check < LIVE_POST_EDIT_INTERVAL_SECONDS:
+        return []
+    _last_pending_live_edit_check = now
+    try:
+        group_buy_ids = await persistence_obj.due_live_edits()
+    except Exception as e:
+        _live_post_editor.errors += 1
+        logger.error(f"LivePostEditor: Could not query pending post edits: {e}", exc_info=True)
+        return []
+    for group_buy_id in group_buy_ids:
+        _live_post_editor.schedule(application.bot, persistence_obj, group_buy_id)
+    return group_buy_ids
+
+
+# === Auto-Closing Buys Past Their Deadline ===
+async def _auto_close_due_group_buys(force: bool = False) -> list:
+    """
+    Closes the buys whose deadlineAt has passed (rate-limited per instance unless `force`) and queues a
+    post edit for each so the group sees it closed. Returns the closed buy ids.
+    """
+    persistence_obj = application.persistence if application else None
+    if not AUTO_CLOSE_GROUP_BUYS or not isinstance(persistence_obj, CustomFirestorePersistence):
+        return []
+    if force:
+        closed_ids = await persistence_obj.close_due_group_buys(max_batches=100)
+    else:
+        closed_ids = await persistence_obj.maybe_close_due_group_buys()
+    if LIVE_POST_UPDATES:
+        for group_buy_id in closed_ids:
+            _live_post_editor.schedule(application.bot, persistence_obj, group_buy_id)
+    return closed_ids
+
+_periodic_jobs_task: Optional[asyncio.Task] = None
+
+async def _periodic_jobs_loop() -> None:
+    """
+    Long-lived modes: closes due buys every AUTO_CLOSE_INTERVAL_SECONDS and makes pending post edits
+    every LIVE_POST_EDIT_INTERVAL_SECONDS, in the background so updates never wait for them.
+    """
+    intervals = [interval for enabled, interval in ((AUTO_CLOSE_GROUP_BUYS, AUTO_CLOSE_INTERVAL_SECONDS),
+                                                    (LIVE_POST_UPDATES, LIVE_POST_EDIT_INTERVAL_SECONDS)) if enabled]
+    while True:
+        await asyncio.sleep(max(1.0, min(intervals)))
+        try:
+            await _auto_close_due_group_buys()
+            await flush_pending_live_edits()
+        except Exception as e:
+            logger.error(f"Periodic jobs loop: {e}", exc_info=True)
+
+def _start_periodic_jobs() -> Optional[asyncio.Task]:
+    """Starts the periodic jobs on the running (long-lived) loop, once; returns the task."""
+    global _periodic_jobs_task
+    if not (AUTO_CLOSE_GROUP_BUYS or LIVE_POST_UPDATES):
+        return None
+    if _periodic_jobs_task is None or _periodic_jobs_task.done():
+        _periodic_jobs_task = asyncio.create_task(_periodic_jobs_loop())
+    return _periodic_jobs_task
+
+
 # --- Function to add Group Buy to Firestore ---
+async def _initial_counter_shard_count(context: ContextTypes.DEFAULT_TYPE, group_chat_id: Optional[str]) -> int:
+    """Counter shards for a new buy, sized to how many members could order at once."""
+    member_count = 0
+    if group_chat_id:
+        try:
+            member_count = await context.bot.get_chat_member_count(chat_id=group_chat_id)
+        except TelegramError as e:
+            logger.warning(f"Could not get the member count of group {group_chat_id} ({e}), using the minimum counter shards.")
+    shards_for_members = -(-member_count // GROUP_BUY_MEMBERS_PER_SHARD) # ceil
+    return max(GROUP_BUY_COUNTER_SHARDS_MIN, min(GROUP_BUY_COUNTER_SHARDS_MAX, shards_for_members))
+
 async def add_group_buy_to_firestore(group_buy_id: str, group_buy_details: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     Adds a new group buy document to the 'groupBuys' collection in Firestore.
     Uses the firestore_client from the application's persistence object if available.
     """
-    logger.info(f"Attempting to add group buy {group_buy_id} to Firestore. Details: {pprint.pformat(group_buy_details)}")
-
-    # Get Firestore client from persistence object if it's our custom one
-    firestore_db_client = None
-    # Ensure persistence and its firestore_client attribute exist
-    if application and application.persistence and hasattr(application.persistence, 'firestore_client') and application.persistence.firestore_client:
-        firestore_db_client = application.persistence.firestore_client
-    else:
-        logger.error("add_group_buy_to_firestore: Could not get Firestore client from application.persistence object or it's None.")
-        # As a fallback, try to initialize a new client, but this is not ideal and might have loop issues
+    # Orders increment groupBuys/{id}/counterShards/{n} instead of this doc (see place_order)
+    if 'counterShardCount' not in group_buy_details:
+        group_buy_details['counterShardCount'] = await _initial_counter_shard_count(context, group_buy_details.get('telegramGroupChatID'))
+    logger.info(f"Attempting to add group buy {group_buy_id} to Firestore. Details: {_json_dumps(group_buy_details, default=str)}")
+
+    # Write through the persistence object if it's our custom one (sync or async client)
+    persistence_obj = _get_firestore_persistence(context)
+    if persistence_obj:
         try:
-            gcp_project = os.environ.get('GCP_PROJECT')
-            db_id = "garupa-group-buy" # Your named database
-            if gcp_project:
-                firestore_db_client = firestore.Client(project=gcp_project, database=db_id) # Use sync client for this helper
-            else:
-                firestore_db_client = firestore.Client(database=db_id)
-            logger.warning("add_group_buy_to_firestore: Initialized a new SYNC Firestore client as it was not found on persistence object.")
-        except Exception as e_fallback_fs:
-            logger.error(f"add_group_buy_to_firestore: Failed to initialize fallback Firestore client: {e_fallback_fs}")
+            await persistence_obj.add_group_buy(group_buy_id, group_buy_details)
+            logger.info(f"Successfully added group buy {group_buy_id} to Firestore collection 'groupBuys'.")
+            return True
+        except Exception as e:
+            logger.error(f"Error adding group buy {group_buy_id} to Firestore: {e}", exc_info=True)
             return False
 
+    firestore_db_client = None
+    logger.error("add_group_buy_to_firestore: application.persistence is not a CustomFirestorePersistence.")
+    # As a fallback, try to initialize a new client, but this is not ideal and might have loop issues
+    try:
+        gcp_project = os.environ.get('GCP_PROJECT')
+        db_id = "garupa-group-buy" # Your named database
+        if gcp_project:
+            firestore_db_client = _firestore().Client(project=gcp_project, database=db_id) # Use sync client for this helper
+        else:
+            firestore_db_client = _firestore().Client(database=db_id)
+        logger.warning("add_group_buy_to_firestore: Initialized a new SYNC Firestore client as it was not found on persistence object.")
+    except Exception as e_fallback_fs:
+        logger.error(f"add_group_buy_to_firestore: Failed to initialize fallback Firestore client: {e_fallback_fs}")
+        return False
+
     if not firestore_db_client:
         logger.error("add_group_buy_to_firestore: Firestore client is not available.")
         return False
 
     try:
         doc_ref = firestore_db_client.collection("groupBuys").document(group_buy_id)
-        # CustomFirestorePersistence uses a sync client, so Firestore operations need to be run in a thread
+        # The fallback client is synchronous, so the write runs in a thread
         await asyncio.to_thread(doc_ref.set, group_buy_details)
         logger.info(f"Successfully added group buy {group_buy_id} to Firestore collection 'groupBuys'.")
         return True
@@ -942,62 +3002,801 @@ async def add_group_buy_to_firestore(group_buy_id: str, group_buy_details: Dict[
         return False
 
 
+# --- Webhook Secret Token ---
+_webhook_stats: Counter = Counter()
+_WEBHOOK_SECRET_TOKEN_BYTES = WEBHOOK_SECRET_TOKEN.encode('utf-8')
+
+def _is_valid_secret_token(header_value: Optional[str]) -> bool:
+    """Constant-time check of X-Telegram-Bot-Api-Secret-Token; always valid if no secret is configured."""
+    if not _WEBHOOK_SECRET_TOKEN_BYTES:
+        return True
+    if not header_value:
+        return False
+    return hmac.compare_digest(header_value.encode('utf-8'), _WEBHOOK_SECRET_TOKEN_BYTES)
+
+def get_webhook_metrics() -> Dict[str, int]:
+    return dict(_webhook_stats)
+
+# --- Raw Update Pre-Router ---
+# Mirrors the registered handlers so updates none of them can match are acked before Update.de_json,
+# Application.initialize() and any persistence I/O. Keep in sync when adding handlers:
+#   - /newbuy CommandHandler for GROUPS (messages, incl. edited ones)
+#   - newbuy_conversation: every private message (its fallbacks catch anything) and callback queries
+#   - order / order-list buttons (callback queries) and /start order_<id>, view_<id> deep links (private messages)
+_HANDLED_UPDATE_TYPES = ('message', 'edited_message', 'callback_query')
+_prefilter_stats: Counter = Counter()
+
+def _is_newbuy_command(message: Dict[str, Any]) -> bool:
+    text = message.get('text') or ''
+    for entity in message.get('entities') or ():
+        if entity.get('type') == 'bot_command' and entity.get('offset') == 0:
+            command = text[:entity.get('length', 0)]
+            return command.split('@', 1)[0].lower() == '/newbuy'
+    return False
+
+def _prefilter_update(update_data: Dict[str, Any]) -> Optional[str]:
+    """Returns why a raw update can be dropped, or None if some handler may want it."""
+    update_type = next((t for t in _HANDLED_UPDATE_TYPES if t in update_data), None)
+    if update_type is None:
+        reason = 'unhandled_update_type'
+    elif update_type == 'callback_query':
+        return None
+    else:
+        message = update_data[update_type] or {}
+        chat_type = (message.get('chat') or {}).get('type')
+        if chat_type == ChatType.PRIVATE:
+            return None
+        if chat_type in (ChatType.GROUP, ChatType.SUPERGROUP):
+            if _is_newbuy_command(message):
+                return None
+            reason = 'group_message_without_newbuy'
+        else:
+            reason = 'unhandled_chat_type'
+    _prefilter_stats[reason] += 1
+    return reason
+
+def get_prefilter_metrics() -> Dict[str, int]:
+    return dict(_prefilter_stats)
+
+# --- Update-ID Deduplication (Telegram webhook retries) ---
+class UpdateDeduplicator:
+    """
+    Recognizes redelivered update_ids: an in-memory LRU answers repeats on a warm instance for free,
+    a TTL'd Firestore marker (created atomically) catches repeats that land on another instance.
+    The marker is a short lease until confirm() marks the update done, and release() drops it when
+    processing fails. Claims happen before any persistence load; if the marker can't be written the
+    update is processed anyway (fail open), as before. Without a persistence only the LRU is used
+    (long polling, where getUpdates offsets already rule out redelivery to another instance).
+    """
+    def __init__(self, persistence_obj: Optional[CustomFirestorePersistence], max_entries: int = 10000,
+                 marker_lease_seconds: int = 120, marker_ttl_seconds: int = 86400):
+        self.persistence = persistence_obj
+        self.max_entries = max_entries
+        self.marker_lease_seconds = marker_lease_seconds
+        self.marker_ttl_seconds = marker_ttl_seconds
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._seen_lock = threading.Lock() # GCF may run several asyncio.run() loops in parallel threads
+        self.duplicates_local = 0
+        self.duplicates_remote = 0
+        self.claimed = 0
+
+    def _remember(self, update_id: int) -> bool:
+        """Adds update_id to the LRU; returns False if it was already there."""
+        with self._seen_lock:
+            if update_id in self._seen:
+                self._seen.move_to_end(update_id)
+                return False
+            self._seen[update_id] = None
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return True
+
+    def _forget(self, update_id: int) -> None:
+        with self._seen_lock:
+            self._seen.pop(update_id, None)
+
+    async def claim(self, update_id: Optional[int]) -> bool:
+        """True if this update should be processed, False if it is a duplicate."""
+        if not isinstance(update_id, int):
+            return True
+        if not self._remember(update_id):
+            self.duplicates_local += 1
+            return False
+        if self.persistence:
+            try:
+                if not await self.persistence.claim_update_id(update_id, self.marker_lease_seconds, self.marker_ttl_seconds):
+                    self.duplicates_remote += 1
+                    return False
+            except Exception as e:
+                logger.error(f"UpdateDeduplicator: Could not write marker for update {update_id}, processing anyway: {e}", exc_info=True)
+        self.claimed += 1
+        return True
+
+    async def confirm(self, update_id: Optional[int]) -> None:
+        if not isinstance(update_id, int) or not self.persistence:
+            return
+        try:
+            await self.persistence.confirm_update_id(update_id)
+        except Exception as e:
+            logger.error(f"UpdateDeduplicator: Could not confirm marker for update {update_id}, a redelivery after its lease may be processed again: {e}", exc_info=True)
+
+    async def release(self, update_id: Optional[int]) -> None:
+        if not isinstance(update_id, int):
+            return
+        self._forget(update_id)
+        if self.persistence:
+            try:
+                await self.persistence.release_update_id(update_id)
+            except Exception as e:
+                logger.error(f"UpdateDeduplicator: Could not release marker for update {update_id}: {e}", exc_info=True)
+
+    def metrics(self) -> Dict[str, int]:
+        return {'claimed': self.claimed, 'duplicates_local': self.duplicates_local, 'duplicates_remote': self.duplicates_remote}
+
+_update_deduplicator: Optional[UpdateDeduplicator] = None
+
+def _get_update_deduplicator(remote_markers: bool = True) -> Optional[UpdateDeduplicator]:
+    """The instance's deduplicator; the first call decides whether it writes processedUpdates markers."""
+    global _update_deduplicator
+    if UPDATE_DEDUP and _update_deduplicator is None:
+        persistence_obj = application.persistence if remote_markers and isinstance(application.persistence, CustomFirestorePersistence) else None
+        _update_deduplicator = UpdateDeduplicator(persistence_obj, marker_lease_seconds=UPDATE_DEDUP_LEASE_SECONDS,
+                                                  marker_ttl_seconds=UPDATE_DEDUP_TTL_SECONDS)
+    return _update_deduplicator
+
+def get_dedup_metrics() -> Dict[str, int]:
+    return _update_deduplicator.metrics() if _update_deduplicator else {}
+
 # --- Asynchronous Logic to Process Updates ---
 async def _async_logic_ext(update_data):
     """Core async logic called by the GCF entry point."""
     logger.info("--- _async_logic_ext entered ---")
-    global application
-    if not application: logger.error("!!! ERROR in async logic: Application not initialized. Check startup logs. !!!"); return "ERROR: Application not initialized", 500
+    if not _ensure_application(): logger.error("!!! ERROR in async logic: Application not initialized. Check startup logs. !!!"); return "ERROR: Application not initialized", 500
+    deduplicator = _get_update_deduplicator()
+    update_id = update_data.get('update_id')
     try:
-        logger.info(f"Attempting to process update_id: {update_data.get('update_id', 'N/A')} via application.process_update...")
+        if deduplicator and not await deduplicator.claim(update_id):
+            logger.info(f"Duplicate update_id {update_id} (webhook retry), acking without processing.")
+            return "ok", 200
+        logger.info(f"Attempting to process update_id: {update_id} via application.process_update...")
         update_obj = Update.de_json(update_data, application.bot)
         update_type = "Unknown"
         if update_obj.message: update_type = "Message"
         elif update_obj.callback_query: update_type = "CallbackQuery"
         elif update_obj.inline_query: update_type = "InlineQuery"
         logger.info(f"Update object created. Type: {update_type}, Update ID: {update_obj.update_id}")
-        user_id = update_obj.effective_user.id if update_obj.effective_user else "N/A"
-        async with application: # This ensures persistence data is loaded before handlers and flushed after
-            await application.process_update(update_obj)
+        user_id = update_obj.effective_user.id if update_obj.effective_user else None
+        persistence_obj = application.persistence if isinstance(application.persistence, CustomFirestorePersistence) else None
+        for attempt in range(1 + UPDATE_CONFLICT_RERUNS):
+            if persistence_obj:
+                # Lazy mode: initialize() only point-reads the docs of the users in this update
+                persistence_obj.set_update_scope({user_id} if user_id else set())
+            async with application: # This ensures persistence data is loaded before handlers and flushed after
+                await application.process_update(update_obj)
+                # The loop ends with this request, so this update's post edits can't run in the background;
+                # the ones that aren't allowed yet stay pending on their lease doc. Due buys and other pending
+                # edits are left to the scheduled auto_close_group_buys, off the update path
+                await _live_post_editor.drain(LIVE_POST_DRAIN_MAX_WAIT_SECONDS)
+            if not (persistence_obj and persistence_obj.pop_flush_conflict(user_id)):
+                break
+            logger.warning(f"User {user_id}'s state changed while update {update_id} ran, re-running it on fresh state.")
+        if deduplicator: await deduplicator.confirm(update_id)
         logger.info("--- Application processed update successfully ---")
     except Exception as e:
         logger.error(f"!!! ERROR during application.process_update: {e} !!!", exc_info=True)
+        if deduplicator: await deduplicator.release(update_id)
     finally:
+        if isinstance(application.persistence, CustomFirestorePersistence):
+            await application.persistence.close_client() # this loop ends with the request
         logger.info("--- _async_logic_ext finished ---")
         return "ok", 200
 
+# --- Warm Application Mode (WARM_APPLICATION) ---
+# The event loop runs forever in a daemon thread; the Application is initialized once (getMe, persistence
+# load) and never shut down, so each update only pays for its own state load, handlers and flush.
+_warm_loop: Optional[asyncio.AbstractEventLoop] = None
+_warm_loop_lock = threading.Lock()
+_warm_app_initialized = False
+_warm_init_lock: Optional[asyncio.Lock] = None
+
+def _get_warm_loop() -> asyncio.AbstractEventLoop:
+    """Returns the long-lived event loop, starting its thread on first use."""
+    global _warm_loop
+    with _warm_loop_lock:
+        if _warm_loop is None:
+            _warm_loop = asyncio.new_event_loop()
+            threading.Thread(target=_warm_loop.run_forever, name="warm-event-loop", daemon=True).start()
+            logger.info("Warm event loop started.")
+    return _warm_loop
+
+def _run_on_warm_loop(coro):
+    """Runs a coroutine on the warm loop and blocks the calling (request) thread until it is done."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_warm_loop()).result()
+
+async def _ensure_warm_application() -> None:
+    """Initializes the Application once per instance; runs on the warm loop."""
+    global _warm_app_initialized, _warm_init_lock
+    if _warm_init_lock is None:
+        _warm_init_lock = asyncio.Lock()
+    if _warm_app_initialized:
+        return
+    if not _ensure_application():
+        raise RuntimeError("Application failed to initialize. Telegram bot cannot start.")
+    async with _warm_init_lock:
+        if not _warm_app_initialized:
+            started = time.perf_counter()
+            await application.initialize()
+            # _load_user_state writes conversation states through ConversationHandler internals, which
+            # PTB has no public API for; requirements.txt pins the version they were checked against
+            if conv_handler.persistent and not hasattr(getattr(conv_handler, '_conversations', None), 'update_no_track'):
+                raise RuntimeError(f"python-telegram-bot {telegram.__version__}: ConversationHandler internals used by _load_user_state changed, use the version pinned in requirements.txt.")
+            _warm_app_initialized = True
+            _start_periodic_jobs() # auto-close and pending post edits, off the update path
+            logger.info(f"Warm Application initialized in {time.perf_counter() - started:.3f}s.")
+
+async def _load_user_state(user_id: Optional[int]) -> None:
+    """
+    Starts a per-user persistence update cycle and loads the user's conversation state into
+    conv_handler. Needed on warm instances because ConversationHandler only loads states during
+    initialize(), and another instance may have advanced this user's conversation since.
+    user_data is refreshed by PTB itself (refresh_user_data) from the same snapshot.
+    """
+    persistence_obj = application.persistence
+    if not isinstance(persistence_obj, CustomFirestorePersistence):
+        return
+    persistence_obj.begin_user_update(user_id)
+    if not user_id or not conv_handler.persistent:
+        return
+    state = await persistence_obj.get_user_conversation_state(user_id)
+    key = CustomFirestorePersistence._conversation_key(user_id)
+    # Private TrackingDict (no public setter; checked in _ensure_warm_application, PTB version pinned):
+    # set/remove without marking the key for a persistence write
+    if state is not None:
+        conv_handler._conversations.update_no_track({key: state})
+    else:
+        conv_handler._conversations.data.pop(key, None)
+
+async def _process_update_warm(update_data) -> Tuple[str, int]:
+    """
+    Warm-mode counterpart of _async_logic_ext: no initialize()/shutdown() per update.
+    Must be called through the UserOrderedScheduler so a user's updates never overlap.
+    Accepts raw update dicts (webhooks) or Update objects (getUpdates).
+    """
+    update_id = update_data.update_id if isinstance(update_data, Update) else update_data.get('update_id')
+    deduplicator = None
+    try:
+        await _ensure_warm_application()
+        deduplicator = _get_update_deduplicator()
+        if deduplicator and not await deduplicator.claim(update_id):
+            logger.info(f"Duplicate update_id {update_id} (webhook retry), acking without processing.")
+            return "ok", 200
+        update_obj = update_data if isinstance(update_data, Update) else Update.de_json(update_data, application.bot)
+        user_id = update_obj.effective_user.id if update_obj.effective_user else None
+        persistence_obj = application.persistence if isinstance(application.persistence, CustomFirestorePersistence) else None
+        for attempt in range(1 + UPDATE_CONFLICT_RERUNS):
+            await _load_user_state(user_id)
+            await application.process_update(update_obj)
+            # update_persistence() buffers every user PTB has marked since the last call, which can include
+            # users of other lanes; flush_user commits only this update's user and waits until it is written
+            await application.update_persistence()
+            if persistence_obj:
+                await persistence_obj.flush_user(user_id)
+            elif application.persistence:
+                await application.persistence.flush()
+            if not (persistence_obj and persistence_obj.pop_flush_conflict(user_id)):
+                break
+            logger.warning(f"User {user_id}'s state changed while update {update_id} ran, re-running it on fresh state.")
+        if deduplicator: await deduplicator.confirm(update_id)
+        logger.info(f"--- Warm application processed update {update_obj.update_id} ---")
+    except Exception as e:
+        logger.error(f"!!! ERROR during warm application.process_update: {e} !!!", exc_info=True)
+        if deduplicator: await deduplicator.release(update_id)
+    return "ok", 200
+
+# --- Per-User Ordered Scheduler ---
+def _raw_update_user_id(update_data: Any) -> Optional[int]:
+    """Sender id straight from the raw update dict (no Update.de_json needed), or from an Update."""
+    if isinstance(update_data, Update):
+        return update_data.effective_user.id if update_data.effective_user else None
+    for payload in update_data.values():
+        if isinstance(payload, dict):
+            sender = payload.get('from') or payload.get('user')
+            if isinstance(sender, dict) and isinstance(sender.get('id'), int):
+                return sender['id']
+    return None
+
+class UserOrderedScheduler:
+    """
+    Runs updates from different users concurrently (at most max_concurrency at a time) while
+    updates from the same user run strictly one after another, in submission order, so
+    newbuy_conversation state transitions and the per-user persistence cycle stay consistent.
+    Updates without a sender get their own lane.
+    """
+    def __init__(self, handler, max_concurrency: int = 16, max_pending: int = 1000):
+        self._handler = handler
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # Submissions beyond max_pending wait in submit() (back-pressure for the caller)
+        self._pending_slots = asyncio.Semaphore(max_pending)
+        self.max_pending = max_pending
+        self._lanes: Dict[Any, list] = {}
+        self._lane_tasks: Set[asyncio.Task] = set()
+        self.pending = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_lag_seconds = 0.0
+        self._total_lag_seconds = 0.0
+
+    async def submit(self, update_data: Dict[str, Any]) -> asyncio.Future:
+        """Queues an update on its user's lane; the returned future resolves when it was processed."""
+        await self._pending_slots.acquire()
+        user_id = _raw_update_user_id(update_data)
+        lane_key = user_id if user_id is not None else ('update', id(update_data))
+        done: asyncio.Future = asyncio.get_running_loop().create_future()
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            lane = self._lanes[lane_key] = []
+            lane.append((time.monotonic(), update_data, done))
+            lane_task = asyncio.create_task(self._drain_lane(lane_key, lane))
+            self._lane_tasks.add(lane_task)
+            lane_task.add_done_callback(self._lane_tasks.discard)
+        else:
+            lane.append((time.monotonic(), update_data, done))
+        self.pending += 1
+        return done
+
+    async def _drain_lane(self, lane_key: Any, lane: list) -> None:
+        while lane:
+            submitted_at, update_data, done = lane[0]
+            async with self._semaphore:
+                lag = time.monotonic() - submitted_at
+                self.max_lag_seconds = max(self.max_lag_seconds, lag)
+                self._total_lag_seconds += lag
+                self.pending -= 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    result = await self._handler(update_data)
+                    self.processed += 1
+                    if not done.done(): done.set_result(result)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"UserOrderedScheduler: Error processing update: {e}", exc_info=True)
+                    if not done.done(): done.set_result(("Internal Server Error", 500))
+                finally:
+                    self.in_flight -= 1
+                    self._pending_slots.release()
+            lane.pop(0)
+        del self._lanes[lane_key]
+
+    async def join(self) -> None:
+        """Waits until every submitted update has been processed."""
+        while self._lane_tasks:
+            await asyncio.gather(*list(self._lane_tasks), return_exceptions=True)
+
+    def metrics(self) -> Dict[str, Any]:
+        started = self.processed + self.failed
+        return {
+            'max_concurrency': self.max_concurrency,
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'active_users': len(self._lanes),
+            'processed': self.processed,
+            'failed': self.failed,
+            'max_lag_seconds': round(self.max_lag_seconds, 4),
+            'avg_lag_seconds': round(self._total_lag_seconds / started, 4) if started else 0.0,
+        }
+
+_update_scheduler: Optional[UserOrderedScheduler] = None
+
+def _get_update_scheduler() -> UserOrderedScheduler:
+    """The warm loop's scheduler in front of _process_update_warm (created on first use, on the loop)."""
+    global _update_scheduler
+    if _update_scheduler is None:
+        _update_scheduler = UserOrderedScheduler(_process_update_warm, max_concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_QUEUE_MAX_DEPTH)
+    return _update_scheduler
+
+async def _schedule_update_and_wait(update_data: Dict[str, Any]) -> Tuple[str, int]:
+    return await (await _get_update_scheduler().submit(update_data))
+
+def get_update_scheduler_metrics() -> Dict[str, Any]:
+    return _update_scheduler.metrics() if _update_scheduler else {}
+
+# --- Fast-Ack Update Queue (WEBHOOK_FAST_ACK) ---
+class UpdateQueue:
+    """
+    In-process stand-in for a task queue: the webhook enqueues validated updates and returns 200,
+    a single worker on the warm loop hands them to `handler` in arrival order. With the
+    UserOrderedScheduler as handler, per-user ordering is kept while users run concurrently.
+    Exposes depth and enqueue-to-dispatch lag via metrics().
+    """
+    def __init__(self, handler, max_depth: int = 1000):
+        self._handler = handler
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_depth)
+        self._worker_task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self._total_lag_seconds = 0.0
+
+    def start(self) -> None:
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._worker())
+
+    def enqueue(self, update_data: Dict[str, Any]) -> bool:
+        """Returns False (and counts a rejection) when the queue is full."""
+        try:
+            self._queue.put_nowait((time.monotonic(), update_data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            enqueued_at, update_data = await self._queue.get()
+            lag = time.monotonic() - enqueued_at
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            self._total_lag_seconds += lag
+            try:
+                await self._handler(update_data)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"UpdateQueue: Error processing update {update_data.get('update_id', 'N/A')}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def metrics(self) -> Dict[str, Any]:
+        started = self.processed + self.failed
+        return {
+            'depth': self._queue.qsize(),
+            'max_depth': self._queue.maxsize,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'last_lag_seconds': round(self.last_lag_seconds, 4),
+            'max_lag_seconds': round(self.max_lag_seconds, 4),
+            'avg_lag_seconds': round(self._total_lag_seconds / started, 4) if started else 0.0,
+        }
+
+_update_queue: Optional[UpdateQueue] = None
+
+async def _enqueue_update(update_data: Dict[str, Any]) -> bool:
+    """Runs on the warm loop: creates/starts the queue on first use and enqueues one update."""
+    global _update_queue
+    if _update_queue is None:
+        # The worker only dispatches; scheduler.submit() blocks it when too many updates are pending
+        _update_queue = UpdateQueue(_get_update_scheduler().submit, max_depth=UPDATE_QUEUE_MAX_DEPTH)
+    _update_queue.start()
+    return _update_queue.enqueue(update_data)
+
+def get_update_queue_metrics() -> Dict[str, Any]:
+    return _update_queue.metrics() if _update_queue else {}
+
+def get_metrics() -> Dict[str, Any]:
+    """Body of GET .../metrics (GCF and ASGI), which requires the same secret token header as webhook POSTs."""
+    return {'update_queue': get_update_queue_metrics(), 'scheduler': get_update_scheduler_metrics(), 'prefilter_dropped': get_prefilter_metrics(),
+            'dedup': get_dedup_metrics(), 'webhook': get_webhook_metrics(), 'firestore_prewarm': get_prewarm_metrics(),
+            'firestore_executor': get_firestore_executor_metrics(), 'user_cache': get_user_cache_metrics(),
+            'order_list_cache': get_order_list_cache_metrics(), 'live_posts': get_live_post_metrics(), 'auto_close': get_auto_close_metrics()}
+
+# --- Long-Polling Runner (self-hosted: `python main.py`) ---
+async def _complete_unless_stopped(future: asyncio.Future, stop_event: asyncio.Event) -> bool:
+    """Waits for `future` unless stop_event is set first, in which case it is cancelled. True if it completed."""
+    stop_wait = asyncio.ensure_future(stop_event.wait())
+    try:
+        await asyncio.wait({future, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop_wait.cancel()
+    if future.done():
+        return True
+    future.cancel()
+    try:
+        await future
+    except (asyncio.CancelledError, Exception):
+        pass
+    return False
+
+async def _sleep_unless_stopped(seconds: float, stop_event: asyncio.Event) -> None:
+    try:
+        await asyncio.wait_for(stop_event.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def _run_polling(poll_timeout: int = 50, batch_limit: int = 100) -> None:
+    """
+    Same Application and handlers as the webhook, fed by getUpdates long polling on a persistent
+    process: batches of up to `batch_limit` updates go to the UserOrderedScheduler, which bounds
+    concurrency; when UPDATE_QUEUE_MAX_DEPTH updates are pending, polling pauses until workers catch up.
+    All Telegram calls share the bot's long-lived HTTPX connection pools.
+    """
+    await _ensure_warm_application()
+    # getUpdates offsets already keep other instances from seeing these updates, so no Firestore markers
+    _get_update_deduplicator(remote_markers=False)
+    scheduler = _get_update_scheduler()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass # e.g. Windows, or not running in the main thread
+
+    # getUpdates doesn't work while a webhook is set; pending updates are kept and polled below
+    await application.bot.delete_webhook(drop_pending_updates=False)
+    periodic_task = _start_periodic_jobs()
+    logger.info(f"Long polling started (timeout {poll_timeout}s, batch {batch_limit}, concurrency {scheduler.max_concurrency}).")
+    offset: Optional[int] = None
+    backoff = 1.0
+    try:
+        while not stop_event.is_set():
+            # allowed_updates is the server-side equivalent of the webhook pre-router
+            poll = asyncio.ensure_future(application.bot.get_updates(offset=offset, timeout=poll_timeout, limit=batch_limit, allowed_updates=list(_HANDLED_UPDATE_TYPES)))
+            if not await _complete_unless_stopped(poll, stop_event):
+                break # SIGTERM mid-poll; the unconfirmed batch is redelivered on the next start
+            try:
+                updates = poll.result()
+                backoff = 1.0
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                wait = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"getUpdates rate-limited, retrying in {wait:.0f}s.")
+                await _sleep_unless_stopped(wait, stop_event)
+                continue
+            except TelegramError as e: # NetworkError, TimedOut, Conflict (another poller), server errors
+                logger.warning(f"getUpdates failed ({e!r}), retrying in {backoff:.0f}s.")
+                await _sleep_unless_stopped(backoff, stop_event)
+                backoff = min(backoff * 2, 60.0)
+                continue
+            for update_obj in updates:
+                offset = update_obj.update_id + 1
+                if _prefilter_update(update_obj.to_dict()):
+                    continue # skips the per-user persistence load/flush
+                await scheduler.submit(update_obj)
+            if updates:
+                logger.debug(f"Polled {len(updates)} update(s). Scheduler: {scheduler.metrics()}")
+    finally:
+        logger.info("Long polling stopping, waiting for in-flight updates...")
+        if periodic_task:
+            periodic_task.cancel()
+        try:
+            await scheduler.join()
+            if offset is not None:
+                try:
+                    # Confirm the last batch so it isn't redelivered on the next start
+                    await application.bot.get_updates(offset=offset, timeout=0, limit=1)
+                except TelegramError as e:
+                    logger.warning(f"Could not confirm polled updates up to offset {offset} ({e!r}), they may be redelivered.")
+            await _live_post_editor.drain(LIVE_POST_EDIT_INTERVAL_SECONDS) # last progress edits
+        finally:
+            await application.shutdown() # update_persistence() + flush()
+    logger.info(f"Long polling stopped. Scheduler: {scheduler.metrics()}")
+
+def run_polling() -> None:
+    """Entry point for self-hosted deployments."""
+    if not _ensure_application():
+        raise RuntimeError("Application failed to initialize. Telegram bot cannot start.")
+    asyncio.run(_run_polling(
+        poll_timeout=int(os.environ.get('POLL_TIMEOUT', '50')),
+        batch_limit=int(os.environ.get('POLL_BATCH_LIMIT', '100')),
+    ))
+
+# --- ASGI Webhook Server (`uvicorn main:asgi_app`) ---
+async def _asgi_read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def _asgi_send(send, status: int, payload: Any) -> None:
+    body = _json_dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def asgi_app(scope, receive, send) -> None:
+    """
+    Same webhook as telegram_webhook, served by any ASGI server with keep-alive. One loop, one
+    initialized Application and one persistence instance are shared by all requests (no
+    asyncio.run or nest_asyncio per request). POST accepts a single update or a JSON array of
+    updates (replay/bulk ingest); arrays go through the UserOrderedScheduler together, so users
+    run concurrently while each user's updates keep their order.
+    """
+    if scope["type"] == "lifespan":
+        periodic_task = None
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await _ensure_warm_application()
+                    periodic_task = _start_periodic_jobs()
+                    await send({"type": "lifespan.startup.complete"})
+                except Exception as e:
+                    logger.critical(f"ASGI startup failed: {e}", exc_info=True)
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+            elif message["type"] == "lifespan.shutdown":
+                if periodic_task:
+                    periodic_task.cancel()
+                if _update_scheduler:
+                    await _update_scheduler.join()
+                if _warm_app_initialized:
+                    await _live_post_editor.drain(LIVE_POST_EDIT_INTERVAL_SECONDS) # last progress edits
+                    await application.shutdown() # update_persistence() + flush()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    is_metrics = scope["method"] == "GET" and scope["path"].rstrip("/").endswith("/metrics")
+    if scope["method"] != "POST" and not is_metrics:
+        await _asgi_send(send, 405, {"error": "Method Not Allowed"})
+        return
+    secret_header = next((v for k, v in scope.get("headers", ()) if k == b"x-telegram-bot-api-secret-token"), None)
+    if not _is_valid_secret_token(secret_header.decode('latin-1') if secret_header is not None else None):
+        _webhook_stats['rejected_secret_token'] += 1
+        await _asgi_send(send, 401, {"error": "Unauthorized"})
+        return
+    if is_metrics:
+        await _asgi_send(send, 200, get_metrics())
+        return
+    try:
+        payload = _json_loads(await _asgi_read_body(receive))
+    except ValueError:
+        await _asgi_send(send, 400, {"error": "Invalid JSON"})
+        return
+    updates = payload if isinstance(payload, list) else [payload]
+    if not all(isinstance(u, dict) and isinstance(u.get('update_id'), int) for u in updates):
+        await _asgi_send(send, 400, {"error": "Expected an update or a list of updates"})
+        return
+
+    relevant_updates = [update_data for update_data in updates if not _prefilter_update(update_data)]
+    if relevant_updates:
+        await _ensure_warm_application()
+        scheduler = _get_update_scheduler()
+        futures = [await scheduler.submit(update_data) for update_data in relevant_updates]
+        await asyncio.gather(*futures)
+    await _asgi_send(send, 200, {"ok": True, "processed": len(relevant_updates), "dropped": len(updates) - len(relevant_updates)})
+
 # --- Synchronous Google Cloud Function Entry Point ---
+_nest_asyncio_applied = False
+
+def _ensure_nest_asyncio() -> None:
+    """asyncio.run per request needs nest_asyncio on GCF; only this wrapper applies it."""
+    global _nest_asyncio_applied
+    if not _nest_asyncio_applied:
+        import nest_asyncio # To handle asyncio loops in environments like GCF
+        nest_asyncio.apply()
+        _nest_asyncio_applied = True
+
 def telegram_webhook(request):
     """Synchronous GCF entry point for Google Cloud Functions."""
     logger.info("--- Sync telegram_webhook entry point called ---")
-    global application
-    if not application: logger.critical("!!! ERROR in sync wrapper: Application not initialized. Check GCF cold start logs. !!!"); return "ERROR: Bot not initialized", 500
     if request.method == "POST":
+        # Checked before the body is parsed, so junk traffic costs no JSON parsing, loop work or Firestore reads
+        if not _is_valid_secret_token(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            _webhook_stats['rejected_secret_token'] += 1
+            logger.warning(f"Rejected webhook POST with missing/invalid secret token (total: {_webhook_stats['rejected_secret_token']}).")
+            return "Unauthorized", 401
         logger.info("--- Received POST request ---")
         try:
-            update_data = request.get_json(force=True)
+            try:
+                update_data = _json_loads(request.get_data())
+            except ValueError:
+                logger.warning("Received POST body that is not valid JSON.")
+                return "Bad Request", 400
             logger.info(f"Received update data (keys): {list(update_data.keys()) if isinstance(update_data, dict) else 'N/A'}")
-            # --- Use asyncio.run for cleaner loop management with nest_asyncio ---
-            result, status_code = asyncio.run(_async_logic_ext(update_data))
-            # ---
+            drop_reason = _prefilter_update(update_data) if isinstance(update_data, dict) else None
+            if drop_reason:
+                logger.info(f"Pre-router dropped update {update_data.get('update_id', 'N/A')} ({drop_reason}). Totals: {get_prefilter_metrics()}")
+                return "ok", 200
+            # First relevant update on this instance builds the Application (dropped ones never do)
+            if not _ensure_application(): logger.critical("!!! ERROR in sync wrapper: Application not initialized. Check GCF cold start logs. !!!"); return "ERROR: Bot not initialized", 500
+            if WEBHOOK_FAST_ACK:
+                if not isinstance(update_data, dict) or not isinstance(update_data.get('update_id'), int):
+                    logger.warning("Fast-ack: rejecting payload without an integer update_id.")
+                    return "Bad Request", 400
+                if not _run_on_warm_loop(_enqueue_update(update_data)):
+                    # Telegram will redeliver later; that is our back-pressure
+                    logger.warning(f"Fast-ack: update queue full, rejecting update {update_data['update_id']}. Metrics: {get_update_queue_metrics()}")
+                    return "Update queue full", 503
+                logger.info(f"Fast-ack: queued update {update_data['update_id']}. Queue: {get_update_queue_metrics()}")
+                return "ok", 200
+            if WARM_APPLICATION:
+                result, status_code = _run_on_warm_loop(_schedule_update_and_wait(update_data))
+            else:
+                # --- Use asyncio.run for cleaner loop management with nest_asyncio ---
+                _ensure_nest_asyncio()
+                result, status_code = asyncio.run(_async_logic_ext(update_data))
+                # ---
             logger.info(f"Async logic finished, sync wrapper returning result: '{result}', status: {status_code}")
             return result, status_code
         except Exception as e:
             logger.critical(f"!!! FATAL ERROR during JSON parsing or run_until_complete/asyncio.run: {e} !!!", exc_info=True)
             return "Internal Server Error", 500
+    elif request.method == "GET" and request.path.rstrip('/').endswith('/metrics'):
+        if not _is_valid_secret_token(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            _webhook_stats['rejected_secret_token'] += 1
+            return "Unauthorized", 401
+        return _json_dumps(get_metrics()), 200, {'Content-Type': 'application/json'}
     else:
         logger.warning(f"Received non-POST request ({request.method}), returning Method Not Allowed")
         return "Method Not Allowed", 405
 
+async def _auto_close_job() -> list:
+    if isinstance(application.persistence, CustomFirestorePersistence):
+        application.persistence.set_update_scope(set()) # no user's state is needed
+    try:
+        async with application: # initialize() + shutdown(), so the closing post edits are sent before returning
+            closed_ids = await _auto_close_due_group_buys(force=True)
+            await flush_pending_live_edits(force=True)
+            await _live_post_editor.drain(LIVE_POST_DRAIN_MAX_WAIT_SECONDS)
+    finally:
+        if isinstance(application.persistence, CustomFirestorePersistence):
+            await application.persistence.close_client() # this loop ends with the request
+    return closed_ids
+
+async def _auto_close_job_warm() -> list:
+    await _ensure_warm_application()
+    closed_ids = await _auto_close_due_group_buys(force=True)
+    await flush_pending_live_edits(force=True) # post edits run on the warm loop
+    return closed_ids
+
+def auto_close_group_buys(request):
+    """
+    GCF entry point for Cloud Scheduler (e.g. every minute): closes every buy past its deadlineAt and makes
+    the post edits left pending (e.g. the last edit of an order burst). Webhook requests never run these, so in
+    the default per-request mode this job is the only thing that does; warm instances also run them on a timer.
+    Send the webhook secret in X-Telegram-Bot-Api-Secret-Token.
+    """
+    if request.method != "POST":
+        return "Method Not Allowed", 405
+    if not _is_valid_secret_token(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        _webhook_stats['rejected_secret_token'] += 1
+        return "Unauthorized", 401
+    if not _ensure_application():
+        return "ERROR: Bot not initialized", 500
+    try:
+        if WARM_APPLICATION or WEBHOOK_FAST_ACK:
+            closed_ids = _run_on_warm_loop(_auto_close_job_warm())
+        else:
+            _ensure_nest_asyncio()
+            closed_ids = asyncio.run(_auto_close_job())
+    except Exception as e:
+        logger.error(f"auto_close_group_buys failed: {e}", exc_info=True)
+        return "Internal Server Error", 500
+    return _json_dumps({'closed': len(closed_ids)}), 200, {'Content-Type': 'application/json'}
+
 # --- Add Handlers to the Application ---
-if application:
+def _register_handlers(application: Application) -> None:
+    """Adds all handlers to a freshly built Application (called from _build_application)."""
+    global conv_handler
     logger.info("--- Adding handlers to application ---")
 
     # 1. Handler for /newbuy in GROUPS (starts DM process)
     application.add_handler(CommandHandler("newbuy", newbuy_command_group, filters=filters.ChatType.GROUPS))
     logger.info("Added: /newbuy Command handler for GROUPS")
 
-    # 2. Conversation Handler for the multi-step setup in DMs
+    # 2. Order buttons and the order deep link; before the conversation so its catch-all fallbacks
+    #    don't swallow them while the user is in the middle of setting up a buy
+    application.add_handler(CallbackQueryHandler(order_callback, pattern=ORDER_CALLBACK_PATTERN))
+    application.add_handler(CommandHandler("start", order_start_command, filters=filters.ChatType.PRIVATE & filters.Regex(r'^/start order_')))
+    application.add_handler(CallbackQueryHandler(view_orders_callback, pattern=VIEW_CALLBACK_PATTERN))
+    application.add_handler(CommandHandler("start", view_start_command, filters=filters.ChatType.PRIVATE & filters.Regex(r'^/start view_')))
+    logger.info("Added: Order / order-list button and /start order_, view_ handlers")
+
+    # 3. Conversation Handler for the multi-step setup in DMs
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("newbuy", newbuy_start_dm, filters=filters.ChatType.PRIVATE),
@@ -1029,17 +3828,15 @@ if application:
             CallbackQueryHandler(handle_unexpected_state)
             ],
         name="newbuy_conversation", # Name is required for persistence
-        persistent=True if persistence else False, 
+        persistent=application.persistence is not None, 
     )
     application.add_handler(conv_handler)
-    logger.info(f"Added: Conversation handler for PRIVATE setup (persistent={conv_handler.persistent})")
+    logger.info(f"Added: Conversation handler for PRIVATE setup (persistent={conv_handler.persistent}, warm application: {WARM_APPLICATION})")
 
 
     # --- Handler Count Logging ---
     logger.info(f"Handler count in application.handlers[0]: {len(application.handlers.get(0, []))}")
 
-    # --- Cold Start Logging ---
-    logger.info("✅ GCF Cold Start Completed: Application handlers initialized and ready.")
 
-else:
-    logger.warning("--- Skipping handler setup because Application initialization failed ---")
\ No newline at end of file
+if __name__ == "__main__":
+    run_polling()
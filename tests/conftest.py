@@ -0,0 +1,204 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+# main.py requires BOT_TOKEN at import (the Application itself is built lazily); no network is used here
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("GCP_PROJECT", "test-project")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from google.api_core import exceptions as gcp_exceptions  # noqa: E402
+from google.cloud import firestore  # noqa: E402
+
+_clock = itertools.count(1)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocRef:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def get(self, transaction=None):
+        data, update_time = self._client.docs.get(self.path, (None, None))
+        return FakeSnapshot(self, data, update_time)
+
+    def set(self, payload, merge=False):
+        self._client.apply([("set", self, payload, merge, None)])
+
+    def update(self, payload):
+        self._client.apply([("update", self, payload, None, None)])
+
+    def delete(self):
+        self._client.docs.pop(self.path, None)
+
+    def create(self, payload):
+        if self.path in self._client.docs:
+            raise gcp_exceptions.AlreadyExists(self.path)
+        self.set(payload)
+
+    def collection(self, name):
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+
+class FakeCollection:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocRef(self._client, f"{self.path}/{doc_id}")
+
+    def stream(self):
+        prefix = self.path + "/"
+        return [FakeDocRef(self._client, path).get() for path in sorted(self._client.docs)
+                if path.startswith(prefix) and "/" not in path[len(prefix):]]
+
+    def order_by(self, field):
+        return FakeQuery(self, field)
+
+
+class FakeQuery:
+    """order_by(field).start_after(snapshot).limit(n); every stream() is logged in client.queries."""
+    def __init__(self, collection, field, after=None, count=None):
+        self._collection = collection
+        self._field = field
+        self._after = after
+        self._count = count
+
+    def start_after(self, snapshot):
+        return FakeQuery(self._collection, self._field, snapshot, self._count)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._field, self._after, count)
+
+    def stream(self):
+        self._collection._client.queries.append((self._collection.path, self._after.id if self._after else None, self._count))
+        docs = sorted(self._collection.stream(), key=lambda doc: (doc.to_dict()[self._field], doc.id))
+        if self._after is not None:
+            after_key = (self._after.to_dict()[self._field], self._after.id)
+            docs = [doc for doc in docs if (doc.to_dict()[self._field], doc.id) > after_key]
+        return docs[:self._count] if self._count is not None else docs
+
+
+class FakeWriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, doc_ref, payload, merge=False):
+        self._ops.append(("set", doc_ref, payload, merge, None))
+
+    def update(self, doc_ref, payload, option=None):
+        self._ops.append(("update", doc_ref, payload, None, option))
+
+    def delete(self, doc_ref):
+        self._ops.append(("delete", doc_ref, None, None, None))
+
+    def commit(self):
+        self._client.commits += 1
+        return self._client.apply(self._ops)
+
+
+class FakeFirestoreClient:
+    """Just enough of firestore.Client for the persistence's user state, dedup, live post and order paths."""
+    field_path = staticmethod(firestore.Client.field_path)
+
+    def __init__(self):
+        self.docs = {}  # path -> (data, update_time)
+        self.commits = 0
+        self.queries = []
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, doc_refs):
+        return [doc_ref.get() for doc_ref in doc_refs]
+
+    def write_option(self, last_update_time):
+        return ("last_update_time", last_update_time)
+
+    async def run_transaction(self, doc_ref, apply, *extra_refs):
+        """Stands in for the persistence's _run_transaction: apply's writes commit together, no contention."""
+        transaction = FakeBatch(self)
+        result = apply(transaction, *[ref.get() for ref in (doc_ref, *extra_refs)])
+        self.apply(transaction._ops)
+        return result
+
+    def put(self, path, data):
+        self.docs[path] = (data, next(_clock))
+
+    def apply(self, ops):
+        """Applies the writes atomically, like a WriteBatch commit."""
+        for kind, doc_ref, _, _, option in ops:
+            current = self.docs.get(doc_ref.path)
+            if kind == "update" and option is not None and (current is None or current[1] != option[1]):
+                raise gcp_exceptions.FailedPrecondition(doc_ref.path)
+            if kind == "update" and current is None:
+                raise gcp_exceptions.NotFound(doc_ref.path)
+        results = []
+        for kind, doc_ref, payload, merge, _ in ops:
+            current = dict(self.docs.get(doc_ref.path, (None, None))[0] or {})
+            if kind == "delete":
+                self.docs.pop(doc_ref.path, None)
+                results.append(FakeWriteResult(None))
+                continue
+            if kind == "set" and not merge:
+                current = {}
+            for key, value in payload.items():
+                parts = key.split(".", 1) if kind == "update" else [key]
+                target = current
+                if len(parts) == 2:
+                    target = current.setdefault(parts[0], {})
+                    key = parts[1].strip("`")
+                if value is firestore.DELETE_FIELD:
+                    target.pop(key, None)
+                elif isinstance(value, firestore.Increment):
+                    target[key] = target.get(key, 0) + value.value
+                elif value is firestore.SERVER_TIMESTAMP:
+                    target[key] = next(_clock)
+                else:
+                    target[key] = value
+            update_time = next(_clock)
+            self.docs[doc_ref.path] = (current, update_time)
+            results.append(FakeWriteResult(update_time))
+        return results
+
+
+@pytest.fixture
+def fake_client():
+    return FakeFirestoreClient()
+
+
+@pytest.fixture
+def make_persistence(fake_client):
+    def factory(**kwargs):
+        persistence_obj = main.CustomFirestorePersistence(project_id="test-project", database_id="test", lazy_user_loading=True, **kwargs)
+        persistence_obj.firestore_client = fake_client
+        persistence_obj._run_transaction = fake_client.run_transaction
+        return persistence_obj
+    return factory
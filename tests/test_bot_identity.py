@@ -0,0 +1,46 @@
+import asyncio
+import json
+import time
+
+from telegram import User
+from telegram.error import NetworkError
+
+import main
+
+TOKEN = "123456:test-token"
+
+
+def _bot(tmp_path, cached_at, monkeypatch, refresh_error=None):
+    (tmp_path / "identity.json").write_text(json.dumps({
+        "user": {"id": 123456, "is_bot": True, "first_name": "Garu", "username": "OldGaruBot"}, "cachedAt": cached_at,
+    }))
+    calls = []
+
+    async def get_me(self, *args, **kwargs):
+        calls.append(1)
+        if refresh_error:
+            raise refresh_error
+        self._bot_user = User(123456, "Garu", True, username="GaruBot")
+        return self._bot_user
+
+    monkeypatch.setattr(main.ExtBot, "get_me", get_me)
+    monkeypatch.delenv("BOT_IDENTITY_JSON", raising=False)
+    cache = main.BotIdentityCache(TOKEN, cache_file=str(tmp_path / "identity.json"), refresh_after_seconds=60)
+    return main.CachedIdentityBot(TOKEN, identity_cache=cache), calls
+
+
+def test_fresh_identity_is_served_without_get_me(tmp_path, monkeypatch):
+    bot, calls = _bot(tmp_path, time.time(), monkeypatch)
+    assert asyncio.run(bot.get_me()).username == "OldGaruBot" and calls == []
+
+
+def test_stale_identity_is_refreshed_before_get_me_returns(tmp_path, monkeypatch):
+    bot, calls = _bot(tmp_path, time.time() - 120, monkeypatch)
+
+    assert asyncio.run(bot.get_me()).username == "GaruBot" and calls == [1]
+    assert json.loads((tmp_path / "identity.json").read_text())["user"]["username"] == "GaruBot"
+
+
+def test_stale_identity_is_served_when_the_refresh_fails(tmp_path, monkeypatch):
+    bot, calls = _bot(tmp_path, time.time() - 120, monkeypatch, refresh_error=NetworkError("down"))
+    assert asyncio.run(bot.get_me()).username == "OldGaruBot" and calls == [1]
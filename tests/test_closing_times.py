@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+SGT = ZoneInfo("Asia/Singapore")
+NOW = datetime(2025, 4, 23, 12, 0, tzinfo=SGT)  # a Wednesday
+
+
+def _parse(text):
+    closing_at = main.parse_closing_time(text, now=NOW, tz=SGT)
+    return closing_at.astimezone(SGT).replace(tzinfo=None) if closing_at else None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Sat 8pm", datetime(2025, 4, 26, 20, 0)),
+    ("24 Apr 10pm", datetime(2025, 4, 24, 22, 0)),
+    ("tomorrow 9:30am", datetime(2025, 4, 24, 9, 30)),
+    ("31/12 18:00", datetime(2025, 12, 31, 18, 0)),
+    ("8pm", datetime(2025, 4, 23, 20, 0)),
+    ("10am", datetime(2025, 4, 24, 10, 0)),  # already past today
+    ("Sunday", datetime(2025, 4, 27, 23, 59)),
+    ("24.04 10pm", datetime(2025, 4, 24, 22, 0)),
+    ("31.12 18.00", datetime(2025, 12, 31, 18, 0)),
+    ("May 1st, 2025 noon", datetime(2025, 5, 1, 12, 0)),
+    ("Sat 26 Apr 2025, 8:00 PM", datetime(2025, 4, 26, 20, 0)),
+])
+def test_parses_closing_times(text, expected):
+    assert _parse(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "Sunday at 9",  # 9am or 9pm?
+    "Sunday 9",
+    "13pm",
+    "31 Feb 8pm",
+    "20 Apr",  # a few days ago
+    "whenever",
+    "",
+])
+def test_rejects_unreadable_or_past_closing_times(text):
+    assert _parse(text) is None
+
+
+def test_returns_utc():
+    assert main.parse_closing_time("Sat 8pm", now=NOW, tz=SGT) == datetime(2025, 4, 26, 12, 0, tzinfo=timezone.utc)
@@ -0,0 +1,21 @@
+import asyncio
+
+
+def test_legacy_bot_data_handoffs_are_moved_to_handoff_docs(make_persistence, fake_client):
+    fake_client.put("telegramBotGlobalData/shared_bot_data", {
+        "group_info_7": {"group_chat_id": -1001, "group_name": "Durian Lovers"},
+        "group_info_8": {"group_chat_id": -1002, "group_name": "Old group"},
+        "stats": 1,
+    })
+    fake_client.put("groupSetupHandoffs/8", {"telegramUserId": 8, "groupChatId": -1003, "groupName": "New group"})
+    persistence_obj = make_persistence()
+
+    assert asyncio.run(persistence_obj.get_bot_data()) == {"stats": 1}
+
+    assert fake_client.docs["telegramBotGlobalData/shared_bot_data"][0] == {"stats": 1}
+    assert fake_client.docs["groupSetupHandoffs/8"][0]["groupName"] == "New group"  # the newer handoff is kept
+    assert asyncio.run(persistence_obj.pop_group_handoff(7)) == {"group_chat_id": -1001, "group_name": "Durian Lovers"}
+    commits = fake_client.commits
+    persistence_obj.set_update_scope(set())
+    asyncio.run(persistence_obj.get_bot_data())
+    assert fake_client.commits == commits
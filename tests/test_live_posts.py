@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timezone
+
+from telegram.error import RetryAfter
+
+import main
+
+
+class FakeBot:
+    def __init__(self, retry_after=None):
+        self.edits = []
+        self.retry_after = retry_after
+
+    async def edit_message_text(self, text, **kwargs):
+        if self.retry_after:
+            raise RetryAfter(self.retry_after)
+        self.edits.append(text)
+
+
+def _open_buy(fake_client, group_buy_id="gb1"):
+    fake_client.put(f"groupBuys/{group_buy_id}", {
+        "status": "open", "postCaption": "Durian", "telegramPostMessageID": 7, "telegramGroupChatID": "-100", "counterShardCount": 1,
+    })
+    fake_client.put(f"groupBuys/{group_buy_id}/counterShards/0", {"participants": 2, "quantity": 5, "writes": 2})
+
+
+async def _schedule_and_drain(editor, bot, persistence_obj, times=1, max_wait_seconds=0.0):
+    for _ in range(times):
+        editor.schedule(bot, persistence_obj, "gb1")
+    await editor.drain(max_wait_seconds)
+
+
+def test_burst_is_coalesced_into_one_edit(make_persistence, fake_client):
+    _open_buy(fake_client)
+    editor, bot = main.LivePostEditor(interval_seconds=10), FakeBot()
+
+    asyncio.run(_schedule_and_drain(editor, bot, make_persistence(), times=3))
+
+    assert len(bot.edits) == 1 and "2 participant(s), quantity 5" in bot.edits[0]
+    assert editor.metrics()["coalesced"] == 2
+    lease = fake_client.docs["livePostEdits/gb1"][0]
+    assert lease["pending"] is False and lease["notBefore"] > datetime.now(timezone.utc)
+
+
+def test_edit_within_the_interval_is_left_pending_on_the_lease(make_persistence, fake_client):
+    _open_buy(fake_client)
+    persistence_obj = make_persistence()
+    first, second, bot = main.LivePostEditor(interval_seconds=10), main.LivePostEditor(interval_seconds=10), FakeBot()
+    asyncio.run(_schedule_and_drain(first, bot, persistence_obj))
+
+    asyncio.run(_schedule_and_drain(second, bot, persistence_obj))  # another instance, same interval
+
+    assert len(bot.edits) == 1
+    assert fake_client.docs["livePostEdits/gb1"][0]["pending"] is True
+    assert second.metrics()["pending"] == 0 and second.metrics()["deferred"] == 1
+
+
+def test_pending_edit_is_made_once_due(make_persistence, fake_client):
+    _open_buy(fake_client)
+    fake_client.put("livePostEdits/gb1", {"notBefore": datetime(2000, 1, 1, tzinfo=timezone.utc), "pending": True})
+    editor, bot = main.LivePostEditor(interval_seconds=10), FakeBot()
+    asyncio.run(_schedule_and_drain(editor, bot, make_persistence()))
+
+    assert len(bot.edits) == 1 and fake_client.docs["livePostEdits/gb1"][0]["pending"] is False
+
+
+def test_retry_after_pauses_the_chat_and_defers_the_edit(make_persistence, fake_client):
+    _open_buy(fake_client)
+    editor, bot = main.LivePostEditor(interval_seconds=10), FakeBot(retry_after=30)
+
+    asyncio.run(_schedule_and_drain(editor, bot, make_persistence()))
+
+    assert bot.edits == [] and editor.metrics()["retry_after"] == 1
+    lease = fake_client.docs["livePostEdits/gb1"][0]
+    assert lease["pending"] is True
+    assert (lease["notBefore"] - datetime.now(timezone.utc)).total_seconds() > 20
+
+
+def test_periodic_jobs_start_once_per_loop(monkeypatch):
+    monkeypatch.setattr(main, "_periodic_jobs_task", None)
+
+    async def run():
+        first, second = main._start_periodic_jobs(), main._start_periodic_jobs()
+        first.cancel()
+        return first is second
+
+    assert asyncio.run(run())
@@ -0,0 +1,158 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+
+
+def _buy(fake_client, group_buy_id="gb1", **fields):
+    fake_client.put(f"groupBuys/{group_buy_id}", {"status": "open", **fields})
+
+
+def _doc(fake_client, path):
+    return fake_client.docs.get(path, (None, None))[0]
+
+
+def test_place_and_cancel_move_a_shard_by_the_difference(make_persistence, fake_client):
+    _buy(fake_client, counterShardCount=1)
+    persistence_obj = make_persistence()
+
+    assert asyncio.run(persistence_obj.place_order("gb1", 7, 3, {"userName": "Ann"}, shard_count=1)) is None
+    assert asyncio.run(persistence_obj.place_order("gb1", 7, 5, {"userName": "Ann"}, shard_count=1)) == 3
+    assert _doc(fake_client, "groupBuys/gb1/counterShards/0") == {"participants": 1, "quantity": 5, "writes": 2}
+    assert _doc(fake_client, "groupBuys/gb1/orders/7")["quantity"] == 5
+
+    assert asyncio.run(persistence_obj.cancel_order("gb1", 7, shard_count=1)) == 5
+    assert asyncio.run(persistence_obj.cancel_order("gb1", 7, shard_count=1)) is None
+    assert _doc(fake_client, "groupBuys/gb1/counterShards/0") == {"participants": 0, "quantity": 0, "writes": 3}
+    assert _doc(fake_client, "groupBuys/gb1/orders/7") is None
+
+
+def test_orders_on_a_buy_without_shards_move_the_buy_doc(make_persistence, fake_client):
+    _buy(fake_client, currentParticipantCount=2, currentQuantityCount=4)
+    persistence_obj = make_persistence()
+
+    asyncio.run(persistence_obj.place_order("gb1", 7, 3, {}))
+    asyncio.run(persistence_obj.place_order("gb1", 8, 1, {}))
+    asyncio.run(persistence_obj.cancel_order("gb1", 8))
+
+    buy = _doc(fake_client, "groupBuys/gb1")
+    assert (buy["currentParticipantCount"], buy["currentQuantityCount"], buy["orderVersion"]) == (3, 7, 3)
+    assert "groupBuys/gb1/counterShards/0" not in fake_client.docs
+
+
+@pytest.mark.parametrize("fields", [
+    {"status": "closed"},
+    {"status": "open", "deadlineAt": datetime.now(timezone.utc) - timedelta(minutes=1)},  # auto-close hasn't run yet
+])
+def test_orders_on_a_closed_buy_are_refused(make_persistence, fake_client, fields):
+    fake_client.put("groupBuys/gb1", fields)
+    persistence_obj = make_persistence()
+
+    with pytest.raises(main.GroupBuyClosedError):
+        asyncio.run(persistence_obj.place_order("gb1", 7, 3, {}))
+    with pytest.raises(main.GroupBuyClosedError):
+        asyncio.run(persistence_obj.place_order("missing", 7, 3, {}))
+    assert _doc(fake_client, "groupBuys/gb1/orders/7") is None
+
+
+def test_accepts_orders_until_the_deadline():
+    deadline_at = datetime(2025, 4, 26, 12, 0, tzinfo=timezone.utc)
+    buy = {"status": "open", "deadlineAt": deadline_at}
+    assert main.CustomFirestorePersistence.accepts_orders(buy, now=deadline_at - timedelta(seconds=1))
+    assert not main.CustomFirestorePersistence.accepts_orders(buy, now=deadline_at)
+    assert main.CustomFirestorePersistence.accepts_orders({"status": "open"})
+
+
+def test_orders_spread_over_the_buys_shards(make_persistence, fake_client):
+    _buy(fake_client, counterShardCount=4)
+    persistence_obj = make_persistence()
+
+    for user_id in range(40):
+        asyncio.run(persistence_obj.place_order("gb1", user_id, 2, {}, shard_count=4))
+
+    shards = {path.rsplit("/", 1)[-1]: data for path, (data, _) in fake_client.docs.items() if "/counterShards/" in path}
+    assert set(shards) <= {"0", "1", "2", "3"} and len(shards) > 1
+    assert sum(shard["participants"] for shard in shards.values()) == 40
+    assert asyncio.run(persistence_obj.get_order_totals("gb1")) == {"participants": 40, "quantity": 80, "version": 40}
+
+
+def test_contended_order_transactions_double_the_shards(make_persistence, fake_client):
+    _buy(fake_client, counterShardCount=4)
+    persistence_obj = make_persistence(counter_contention_threshold=2, counter_shard_max=6)
+
+    async def contended_transaction(doc_ref, apply, *extra_refs):
+        apply(fake_client.batch(), *[ref.get() for ref in (doc_ref, *extra_refs)])  # an attempt lost to contention
+        return await fake_client.run_transaction(doc_ref, apply, *extra_refs)
+
+    persistence_obj._run_transaction = contended_transaction
+    asyncio.run(persistence_obj.place_order("gb1", 1, 1, {}, shard_count=4))
+    assert _doc(fake_client, "groupBuys/gb1")["counterShardCount"] == 4
+    asyncio.run(persistence_obj.place_order("gb1", 2, 1, {}, shard_count=4))
+
+    assert _doc(fake_client, "groupBuys/gb1")["counterShardCount"] == 6  # doubled, capped at counter_shard_max
+    assert persistence_obj.get_counter_shard_count("gb1", {"counterShardCount": 4}) == 6
+    asyncio.run(persistence_obj.place_order("gb1", 3, 1, {}, shard_count=6))
+    asyncio.run(persistence_obj.place_order("gb1", 4, 1, {}, shard_count=6))
+    assert _doc(fake_client, "groupBuys/gb1")["counterShardCount"] == 6
+
+
+def test_raise_counter_shards_never_lowers_the_count(make_persistence, fake_client):
+    _buy(fake_client, counterShardCount=16)
+    persistence_obj = make_persistence()
+    assert asyncio.run(persistence_obj.raise_counter_shards("gb1", 8)) == 16
+    assert _doc(fake_client, "groupBuys/gb1")["counterShardCount"] == 16
+
+
+def _orders(fake_client, count, group_buy_id="gb1"):
+    for user_id in range(count):
+        fake_client.put(f"groupBuys/{group_buy_id}/orders/{user_id}", {"userId": str(user_id), "quantity": 1, "createdAt": user_id})
+
+
+def test_order_pages_follow_the_previous_pages_cursor(make_persistence, fake_client):
+    _buy(fake_client)
+    _orders(fake_client, 5)
+    persistence_obj = make_persistence()
+
+    page, has_more = asyncio.run(persistence_obj.get_order_page("gb1", 0, 2, version=1))
+    assert [order["userId"] for order in page] == ["0", "1"] and has_more
+    page, has_more = asyncio.run(persistence_obj.get_order_page("gb1", 1, 2, version=1))
+    assert [order["userId"] for order in page] == ["2", "3"] and has_more
+    page, has_more = asyncio.run(persistence_obj.get_order_page("gb1", 2, 2, version=1))
+    assert [order["userId"] for order in page] == ["4"] and not has_more
+    assert fake_client.queries == [("groupBuys/gb1/orders", None, 3), ("groupBuys/gb1/orders", "1", 3), ("groupBuys/gb1/orders", "3", 3)]
+
+    assert asyncio.run(persistence_obj.get_order_page("gb1", 5, 2, version=1)) == ([], False)
+
+
+def test_a_new_version_drops_the_page_cursors(make_persistence, fake_client):
+    _buy(fake_client)
+    _orders(fake_client, 5)
+    persistence_obj = make_persistence()
+    asyncio.run(persistence_obj.get_order_page("gb1", 0, 2, version=1))
+    del fake_client.docs["groupBuys/gb1/orders/0"]  # cancelled: the pages shift
+    fake_client.queries.clear()
+
+    page, _ = asyncio.run(persistence_obj.get_order_page("gb1", 1, 2, version=2))
+
+    assert [order["userId"] for order in page] == ["3", "4"]
+    assert fake_client.queries == [("groupBuys/gb1/orders", None, 3), ("groupBuys/gb1/orders", "2", 3)]
+
+
+def test_buy_and_totals_are_read_once_per_ttl(make_persistence, fake_client):
+    _buy(fake_client, counterShardCount=1, postCaption="Durian")
+    persistence_obj = make_persistence(order_totals_ttl_seconds=60)
+    reads = []
+    get_doc = persistence_obj._get_doc
+    persistence_obj._get_doc = lambda doc_ref: reads.append(doc_ref.path) or get_doc(doc_ref)
+
+    buy, totals = asyncio.run(persistence_obj.get_group_buy_with_totals("gb1"))
+    asyncio.run(persistence_obj.place_order("gb1", 7, 3, {}, shard_count=1))
+    cached_buy, cached_totals = asyncio.run(persistence_obj.get_group_buy_with_totals("gb1"))
+
+    assert buy["postCaption"] == "Durian" and cached_buy == buy
+    assert totals == {"participants": 0, "quantity": 0, "version": 0}
+    assert cached_totals == {"participants": 1, "quantity": 3, "version": 1}  # this instance's order applied
+    assert reads == ["groupBuys/gb1"]
+    assert asyncio.run(persistence_obj.get_group_buy_with_totals("missing")) == (None, {"participants": 0, "quantity": 0, "version": 0})
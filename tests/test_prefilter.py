@@ -0,0 +1,18 @@
+import main
+
+
+def _message_update(update_id, user_id, chat_type="private", text="x", entities=None):
+    message = {"from": {"id": user_id}, "chat": {"id": user_id, "type": chat_type}, "text": text}
+    if entities:
+        message["entities"] = entities
+    return {"update_id": update_id, "message": message}
+
+
+def test_prefilter_drops_only_updates_no_handler_wants():
+    newbuy = [{"type": "bot_command", "offset": 0, "length": 14}]
+    assert main._prefilter_update(_message_update(1, 5)) is None
+    assert main._prefilter_update({"update_id": 2, "callback_query": {"from": {"id": 5}}}) is None
+    assert main._prefilter_update(_message_update(3, 5, "supergroup", "/newbuy@GaruBot", newbuy)) is None
+    assert main._prefilter_update(_message_update(4, 5, "group", "hello")) == "group_message_without_newbuy"
+    assert main._prefilter_update(_message_update(5, 5, "channel")) == "unhandled_chat_type"
+    assert main._prefilter_update({"update_id": 6, "channel_post": {}}) == "unhandled_update_type"
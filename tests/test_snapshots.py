@@ -0,0 +1,25 @@
+import asyncio
+
+
+def test_warm_updates_keep_other_users_and_bot_data_snapshots(make_persistence, fake_client):
+    fake_client.put("telegramBotGlobalData/shared_bot_data", {"stats": 1})
+    for user_id in (1, 2):
+        fake_client.put(f"userBotStates/{user_id}", {"telegramUserId": user_id, "currentState": user_id, "pendingData": {}})
+    persistence_obj = make_persistence()
+    persistence_obj.set_update_scope({1, 2})
+    asyncio.run(persistence_obj._get_user_snapshots({1, 2}))
+    asyncio.run(persistence_obj.get_bot_data())
+    reads = []
+    get_doc = persistence_obj._get_doc
+    persistence_obj._get_doc = lambda doc_ref: reads.append(doc_ref.path) or get_doc(doc_ref)
+
+    persistence_obj.begin_user_update(1)
+    bot_data = {}
+    asyncio.run(persistence_obj.refresh_bot_data(bot_data))
+
+    assert bot_data == {"stats": 1} and reads == []
+    assert 1 not in persistence_obj._user_snapshots and persistence_obj._user_snapshots[2]["currentState"] == 2
+    asyncio.run(persistence_obj.update_bot_data({"stats": 2}))
+    persistence_obj.begin_user_update(2)
+    assert asyncio.run(persistence_obj.get_bot_data()) == {"stats": 2}  # the written value, still without a read
+    assert reads == []
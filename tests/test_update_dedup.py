@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import main
+
+
+def _deduplicator(make_persistence):
+    return main.UpdateDeduplicator(make_persistence(), marker_lease_seconds=60, marker_ttl_seconds=3600)
+
+
+def test_dedup_acks_repeats_locally_and_across_instances(make_persistence, fake_client):
+    first, second = _deduplicator(make_persistence), _deduplicator(make_persistence)
+
+    assert asyncio.run(first.claim(100))
+    assert not asyncio.run(first.claim(100))  # same instance: LRU
+    assert not asyncio.run(second.claim(100))  # other instance: lease held
+    asyncio.run(first.confirm(100))
+    assert fake_client.docs["processedUpdates/100"][0]["status"] == "done"
+    assert first.metrics() == {"claimed": 1, "duplicates_local": 1, "duplicates_remote": 0}
+    assert second.metrics()["duplicates_remote"] == 1
+
+
+def test_dedup_release_lets_the_redelivery_through(make_persistence, fake_client):
+    first, second = _deduplicator(make_persistence), _deduplicator(make_persistence)
+    assert asyncio.run(first.claim(101))
+
+    asyncio.run(first.release(101))
+
+    assert "processedUpdates/101" not in fake_client.docs
+    assert asyncio.run(second.claim(101))
+
+
+def test_dedup_takes_over_an_expired_lease_but_not_a_done_marker(make_persistence, fake_client):
+    expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+    fake_client.put("processedUpdates/102", {"updateId": 102, "status": "processing", "leaseUntil": expired})
+    fake_client.put("processedUpdates/103", {"updateId": 103, "status": "done", "leaseUntil": expired})
+    fake_client.put("processedUpdates/104", {"updateId": 104})  # written before markers had a status
+    deduplicator = _deduplicator(make_persistence)
+
+    assert asyncio.run(deduplicator.claim(102))  # the instance processing it died
+    assert fake_client.docs["processedUpdates/102"][0]["leaseUntil"] > datetime.now(timezone.utc)
+    assert not asyncio.run(deduplicator.claim(103))
+    assert not asyncio.run(deduplicator.claim(104))
+
+
+def test_dedup_without_persistence_uses_only_the_lru():
+    deduplicator = main.UpdateDeduplicator(None)
+    assert asyncio.run(deduplicator.claim(1))
+    assert not asyncio.run(deduplicator.claim(1))
+    asyncio.run(deduplicator.confirm(1))
+    assert asyncio.run(deduplicator.claim(None))
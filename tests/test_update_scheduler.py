@@ -0,0 +1,82 @@
+import asyncio
+import random
+
+import main
+
+
+def _message_update(update_id, user_id):
+    return {"update_id": update_id, "message": {"from": {"id": user_id}, "chat": {"id": user_id, "type": "private"}, "text": "x"}}
+
+
+def test_scheduler_keeps_each_users_updates_in_order():
+    completed = {}
+
+    async def handler(update_data):
+        await asyncio.sleep(random.uniform(0, 0.005))
+        completed.setdefault(update_data["message"]["from"]["id"], []).append(update_data["update_id"])
+        return "ok", 200
+
+    async def run():
+        scheduler = main.UserOrderedScheduler(handler, max_concurrency=8, max_pending=500)
+        futures = [await scheduler.submit(_message_update(i, i % 10)) for i in range(200)]
+        results = await asyncio.gather(*futures)
+        await scheduler.join()
+        return scheduler, results
+
+    scheduler, results = asyncio.run(run())
+    assert results == [("ok", 200)] * 200
+    assert all(ids == sorted(ids) and len(ids) == 20 for ids in completed.values())
+    assert 1 < scheduler.metrics()["max_in_flight"] <= 8
+    assert scheduler.metrics()["active_users"] == 0
+
+
+def test_scheduler_failure_does_not_block_the_users_lane():
+    seen = []
+
+    async def handler(update_data):
+        seen.append(update_data["update_id"])
+        if update_data["update_id"] == 1:
+            raise RuntimeError("boom")
+        return "ok", 200
+
+    async def run():
+        scheduler = main.UserOrderedScheduler(handler)
+        futures = [await scheduler.submit(_message_update(i, 42)) for i in range(3)]
+        return await asyncio.gather(*futures), scheduler.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert seen == [0, 1, 2]
+    assert results[1] == ("Internal Server Error", 500)
+    assert metrics["failed"] == 1 and metrics["processed"] == 2
+
+
+def test_flush_user_commits_only_its_user_and_waits_for_a_running_flush(make_persistence, fake_client):
+    for user_id in (1, 2):
+        fake_client.put(f"userBotStates/{user_id}", {"telegramUserId": user_id, "currentState": 0, "pendingData": {}})
+    persistence_obj = make_persistence()
+    persistence_obj.set_update_scope({1, 2})
+    asyncio.run(persistence_obj._get_user_snapshots({1, 2}))
+
+    async def run():
+        release = asyncio.Event()
+        commit = persistence_obj._commit
+
+        async def gated_commit(batch):
+            await release.wait()
+            return await commit(batch)
+
+        persistence_obj._commit = gated_commit
+        persistence_obj._buffer_user_write(1, fields={"currentState": 1})
+        other_lane = asyncio.create_task(persistence_obj.flush())  # takes user 1's write
+        await asyncio.sleep(0)
+        persistence_obj._buffer_user_write(2, fields={"currentState": 2})
+        this_lane = asyncio.create_task(persistence_obj.flush_user(1))
+        await asyncio.sleep(0.01)
+        assert not this_lane.done()  # user 1's write isn't committed yet
+        release.set()
+        await asyncio.gather(other_lane, this_lane)
+
+    asyncio.run(run())
+    assert fake_client.docs["userBotStates/1"][0]["currentState"] == 1
+    assert fake_client.docs["userBotStates/2"][0]["currentState"] == 0
+    assert list(persistence_obj._pending_user_writes) == [2]  # left for user 2's own flush_user
@@ -0,0 +1,78 @@
+import asyncio
+
+import main
+
+
+def _user_doc(fake_client, user_id):
+    return fake_client.docs.get(f"userBotStates/{user_id}", (None, None))[0]
+
+
+def _load(persistence_obj, *user_ids):
+    persistence_obj.set_update_scope(set(user_ids))
+    return asyncio.run(persistence_obj._get_user_snapshots(set(user_ids)))
+
+
+def test_snapshot_cache_evicts_expires_and_copies(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    cache = main.UserSnapshotCache(max_entries=2, ttl_seconds=60)
+    snapshot = {"currentState": 1, "pendingData": {"price": "$18"}}
+    cache.put(1, snapshot, "v1")
+    cache.put(2, None, None)
+    snapshot["pendingData"]["price"] = "$20"  # the cache keeps its own copy
+
+    assert cache.get(1) == ({"currentState": 1, "pendingData": {"price": "$18"}}, "v1")
+    cache.put(3, {}, "v3")  # evicts 2, the least recently used
+    assert cache.get(2) is None
+    clock[0] += 61
+    assert cache.get(1) is None and cache.get(3) is None
+    assert cache.metrics()["evictions"] == 1 and cache.metrics()["expired"] == 2
+
+
+def test_cached_snapshot_saves_the_read_on_the_next_update(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {}})
+    persistence_obj = make_persistence(user_cache_max_entries=10)
+    _load(persistence_obj, 1)
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    asyncio.run(persistence_obj.flush())
+    reads = []
+    persistence_obj._get_docs = lambda doc_refs: reads.append(doc_refs)
+
+    persistence_obj.begin_user_update(1)
+    assert asyncio.run(persistence_obj.get_user_conversation_state(1)) == 3
+    assert reads == []
+
+
+def test_conflicting_write_is_dropped_and_surfaced(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {}})
+    fake_client.put("userBotStates/2", {"telegramUserId": 2, "currentState": 5, "pendingData": {}})
+    persistence_obj = make_persistence(user_cache_max_entries=10)
+    _load(persistence_obj, 1, 2)
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 4, "pendingData": {"x": 1}})  # another instance
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    persistence_obj._buffer_user_write(2, fields={"currentState": 6})
+    asyncio.run(persistence_obj.flush())
+
+    assert _user_doc(fake_client, 1)["currentState"] == 4  # the newer write is not overwritten
+    assert _user_doc(fake_client, 2)["currentState"] == 6
+    assert persistence_obj.pop_flush_conflict(1) and not persistence_obj.pop_flush_conflict(1)
+    assert not persistence_obj.pop_flush_conflict(2)
+    assert persistence_obj._pending_user_writes == {}
+    assert persistence_obj.user_cache.metrics()["write_conflicts"] == 1
+    assert asyncio.run(persistence_obj.get_user_conversation_state(1)) == 4  # re-read on fresh state
+
+
+def test_deleted_doc_with_precondition_is_a_conflict(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {}})
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1)
+    del fake_client.docs["userBotStates/1"]
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    persistence_obj._pending_bot_data = {"stats": 1}
+    asyncio.run(persistence_obj.flush())
+
+    assert _user_doc(fake_client, 1) is None
+    assert persistence_obj.pop_flush_conflict(1)
+    assert fake_client.docs["telegramBotGlobalData/shared_bot_data"][0] == {"stats": 1}
@@ -0,0 +1,128 @@
+import asyncio
+
+from google.cloud import firestore
+
+
+def _user_doc(fake_client, user_id):
+    return fake_client.docs.get(f"userBotStates/{user_id}", (None, None))[0]
+
+
+def _load(persistence_obj, *user_ids):
+    persistence_obj.set_update_scope(set(user_ids))
+    return asyncio.run(persistence_obj._get_user_snapshots(set(user_ids)))
+
+
+def _fail_commits(persistence_obj, message="Firestore unavailable"):
+    async def failing_commit(batch):
+        raise RuntimeError(message)
+    persistence_obj._commit = failing_commit
+
+
+def test_flush_commits_every_buffered_write_in_one_batch(make_persistence, fake_client):
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1, 2)
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 1})
+    persistence_obj._buffer_user_write(1, pending_data={"item_name": "Durian"})  # merged with the write above
+    persistence_obj._buffer_user_write(2, fields={"currentState": 4})
+    persistence_obj._pending_bot_data = {"stats": 1}
+    asyncio.run(persistence_obj.flush())
+
+    assert fake_client.commits == 1
+    assert _user_doc(fake_client, 1) == {"telegramUserId": 1, "currentState": 1, "pendingData": {"item_name": "Durian"}}
+    assert _user_doc(fake_client, 2) == {"telegramUserId": 2, "currentState": 4}
+    assert fake_client.docs["telegramBotGlobalData/shared_bot_data"][0] == {"stats": 1}
+
+
+def test_readers_see_requeued_writes(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {}})
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1)
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    _fail_commits(persistence_obj)
+    asyncio.run(persistence_obj.flush())
+
+    persistence_obj.begin_user_update(1)
+    assert asyncio.run(persistence_obj.get_user_conversation_state(1)) == 3
+
+
+def test_update_writes_only_changed_fields(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {"item_name": "Durian", "price": "$18"}})
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1)
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 2}, pending_data={"item_name": "Durian", "moq": "10"})
+    kind, payload = persistence_obj._user_write(1, persistence_obj._pending_user_writes[1])
+
+    assert kind == "update"
+    assert payload == {"pendingData.moq": "10", "pendingData.price": firestore.DELETE_FIELD}
+
+
+def test_unchanged_write_is_skipped(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {"price": "$18"}})
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1)
+    commits = fake_client.commits
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3}, pending_data={"price": "$20"})
+    persistence_obj._buffer_user_write(1, fields={"currentState": 2}, pending_data={"price": "$18"})
+    asyncio.run(persistence_obj.flush())
+
+    assert fake_client.commits == commits
+
+
+def test_new_doc_is_set_with_full_pending_data(make_persistence, fake_client):
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 7)
+
+    persistence_obj._buffer_user_write(7, fields={"currentState": 0}, pending_data={"group_chat_id": -100})
+    asyncio.run(persistence_obj.flush())
+
+    assert _user_doc(fake_client, 7) == {"telegramUserId": 7, "currentState": 0, "pendingData": {"group_chat_id": -100}}
+    assert persistence_obj._user_snapshots[7]["pendingData"] == {"group_chat_id": -100}
+
+
+def test_failed_set_keeps_newer_pending_data(make_persistence, fake_client):
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 7)
+    persistence_obj._buffer_user_write(7, fields={"currentState": 0}, pending_data={"item_name": "Durian"})
+
+    original_commit = persistence_obj._commit
+    _fail_commits(persistence_obj)
+    asyncio.run(persistence_obj.flush())
+    assert persistence_obj._user_snapshots[7] is None  # not advanced by the failed flush
+
+    persistence_obj._buffer_user_write(7, fields={"currentState": 1}, pending_data={"item_name": "Durian", "price": "$18"})
+    persistence_obj._commit = original_commit
+    asyncio.run(persistence_obj.flush())
+
+    assert _user_doc(fake_client, 7) == {"telegramUserId": 7, "currentState": 1, "pendingData": {"item_name": "Durian", "price": "$18"}}
+    assert persistence_obj._pending_user_writes == {}
+
+
+def test_deleted_doc_is_rewritten_in_full(make_persistence, fake_client):
+    fake_client.put("userBotStates/1", {"telegramUserId": 1, "currentState": 2, "pendingData": {"price": "$18"}})
+    persistence_obj = make_persistence()
+    _load(persistence_obj, 1)
+    persistence_obj._user_versions.pop(1)  # no base version, so the update goes without a precondition
+    del fake_client.docs["userBotStates/1"]  # e.g. removed by hand while the update ran
+
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    persistence_obj._pending_bot_data = {"stats": 1}
+    asyncio.run(persistence_obj.flush())
+
+    assert _user_doc(fake_client, 1) == {"telegramUserId": 1, "currentState": 3, "pendingData": {"price": "$18"}}
+    assert fake_client.docs["telegramBotGlobalData/shared_bot_data"][0] == {"stats": 1}
+    assert persistence_obj._pending_user_writes == {} and persistence_obj._pending_bot_data is None
+
+
+def test_failing_write_is_dropped_after_max_attempts(make_persistence, fake_client):
+    persistence_obj = make_persistence(max_flush_attempts=2)
+    _load(persistence_obj, 1)
+    persistence_obj._buffer_user_write(1, fields={"currentState": 3})
+    _fail_commits(persistence_obj, "permanently rejected")
+
+    asyncio.run(persistence_obj.flush())
+    assert 1 in persistence_obj._pending_user_writes
+    asyncio.run(persistence_obj.flush())
+    assert persistence_obj._pending_user_writes == {}